@@ -0,0 +1,93 @@
+'''Benchmark of the clue renderers.
+
+Compares, for every clue of an image:
+
+- sequential: the previous generate_step_images loop, which draws one more
+  rectangle on the same image before each frame, so frames depend on each
+  other
+- draw: render_frames with ImageDraw, one copy of the base image per frame
+
+Each renderer is timed alone and followed by the encoding of the frames with
+the given format, which is what the bot actually pays per clue.
+
+Usage:
+
+    python3 -m bot.bench_rendering ./dataset/stray.jpg --repeat=20
+'''
+
+import argparse
+import random
+import time
+
+from PIL import ImageDraw
+
+from .image_generation import (
+    COLOR,
+    EXPECTED_WIDTH,
+    IMAGE_FORMATS,
+    RenderOptions,
+    _shuffled_chunks,
+    encode_image,
+    load_image,
+    render_frames,
+)
+
+
+def sequential_frames(base_image, chunks):
+    '''Frames drawn like the previous generate_step_images, without saving.'''
+
+    image = base_image.copy()
+    draw_context = ImageDraw.Draw(image)
+    frames = []
+    for chunk in reversed(chunks):
+        draw_context.rectangle(chunk, fill=COLOR)
+        frames.append(image.copy())
+    return list(reversed(frames))
+
+
+def measure(function, repeat):
+    '''Returns the best time of repeat calls, in milliseconds.'''
+
+    best = None
+    for _ in range(repeat):
+        start = time.perf_counter()
+        function()
+        elapsed = time.perf_counter() - start
+        best = elapsed if best is None else min(best, elapsed)
+    return best * 1000
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Benchmark of the clue renderers')
+    parser.add_argument('image')
+    parser.add_argument('--repeat', default=10, type=int)
+    parser.add_argument('--width', default=EXPECTED_WIDTH, type=int)
+    parser.add_argument(
+        '--format', default='png', choices=[f.lower() for f in IMAGE_FORMATS]
+    )
+    args = parser.parse_args()
+
+    options = RenderOptions(args.format, width=args.width)
+    base_image = load_image(args.image, options).convert('RGB')
+    chunks = _shuffled_chunks(base_image, random.Random(0))
+
+    renderers = {
+        'sequential': lambda: sequential_frames(base_image, chunks),
+        'draw': lambda: render_frames(base_image, chunks),
+    }
+
+    print(
+        f'{len(chunks)} frames of {base_image.size[0]} x {base_image.size[1]}, '
+        f'best of {args.repeat}'
+    )
+    print(f'{"renderer":<12}{"render ms":>12}{"+ encode ms":>14}')
+    for name, render in renderers.items():
+        render_ms = measure(render, args.repeat)
+        total_ms = measure(
+            lambda: [encode_image(frame, options) for frame in render()], args.repeat
+        )
+        print(f'{name:<12}{render_ms:>12.2f}{total_ms:>14.2f}')
+
+
+if __name__ == '__main__':
+    main()
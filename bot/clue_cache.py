@@ -0,0 +1,237 @@
+'''Disk cache of scaled images and rendered clues.
+
+Entries are addressed by the hash of the source image plus everything that
+changes the result (render options, grid, color and chunk order), so a
+question that comes back after HISTORY_SIZE rounds reuses the work done the
+last time it was played.
+
+Each entry is a directory with the scaled base image and the clues rendered
+so far. When the total size goes over the budget the least recently used
+entries are deleted, except the ones pinned by the clue sets still in play,
+whose files may be about to be published.
+
+Entries can also be written by other processes, like the workers of
+compiler.compile_dataset, with write_base and clue_filename, and then
+registered with ClueCache.add_entry.
+'''
+
+import hashlib
+import json
+import logging
+import os
+import shutil
+import threading
+import time
+
+logger = logging.getLogger(__name__)
+
+DEFAULT_CACHE_PATH = './cache/'
+DEFAULT_MAX_BYTES = 500 * 1024 * 1024
+
+BASE_FILENAME = 'base.png'
+CHUNKS_FILENAME = 'chunks.json'
+
+
+def write_base(entry_path, image, chunks):
+    '''Writes the scaled image and the chunk order of an entry.'''
+
+    os.makedirs(entry_path, exist_ok=True)
+    image.save(os.path.join(entry_path, BASE_FILENAME), 'PNG')
+    with open(os.path.join(entry_path, CHUNKS_FILENAME), 'w') as fout:
+        json.dump(chunks, fout)
+
+
+def clue_filename(idx, extension):
+    return f'{idx+1}.{extension}'
+
+
+class ClueCache:
+    '''Content-addressed cache of clue sets with LRU eviction.'''
+
+    def __init__(self, path=DEFAULT_CACHE_PATH, max_bytes=DEFAULT_MAX_BYTES):
+        '''Opens the cache, creating the directory if needed.
+
+        Arguments:
+            - path: directory of the cache
+            - max_bytes: disk budget. Older entries are evicted to stay under it.
+        '''
+
+        self.path = path
+        self.max_bytes = max_bytes
+        self.lock = threading.Lock()
+
+        os.makedirs(path, exist_ok=True)
+
+        # key: [size in bytes, last access time]
+        self.entries = {}
+        # key: number of users that need the entry, see pin
+        self.pinned = {}
+        self._scan()
+
+    def key(self, image_hash, options, rows, cols, color, seed):
+        '''Returns the key of the entry for the given parameters.'''
+
+        params = [image_hash, repr(options), rows, cols, color, seed]
+        return hashlib.sha256(json.dumps(params).encode('utf-8')).hexdigest()
+
+    def get_base(self, key):
+        '''Returns (scaled image, chunks) of an entry, or None if missing.'''
+
+        # The cache is managed without PIL, it is only needed for the images
+        from PIL import Image
+
+        entry_path = self._entry_path(key)
+        try:
+            with open(os.path.join(entry_path, CHUNKS_FILENAME)) as fin:
+                chunks = [tuple(c) for c in json.load(fin)]
+            image = Image.open(os.path.join(entry_path, BASE_FILENAME))
+            image.load()
+        except (OSError, ValueError):
+            return None
+
+        self._touch(key)
+        logger.debug('Clue cache hit for %s', key)
+        return image, chunks
+
+    def put_base(self, key, image, chunks):
+        '''Stores the scaled image and the chunk order of an entry.'''
+
+        write_base(self._entry_path(key), image, chunks)
+        self._add(key, BASE_FILENAME, CHUNKS_FILENAME)
+
+    def has_base(self, key):
+        '''Returns True if the scaled image of an entry is stored.'''
+
+        entry_path = self._entry_path(key)
+        return all(
+            os.path.exists(os.path.join(entry_path, f))
+            for f in (BASE_FILENAME, CHUNKS_FILENAME)
+        )
+
+    def add_entry(self, key):
+        '''Accounts for an entry written by another process.'''
+
+        size = 0
+        with os.scandir(self._entry_path(key)) as files:
+            for f in files:
+                size += f.stat().st_size
+
+        with self.lock:
+            self.entries[key] = [size, 0]
+        self._touch(key)
+        self._evict(keep=key)
+
+    def pin(self, key):
+        '''Keeps an entry from being evicted until it is unpinned.'''
+
+        with self.lock:
+            self.pinned[key] = self.pinned.get(key, 0) + 1
+
+    def unpin(self, key):
+        '''Releases an entry pinned with pin.'''
+
+        with self.lock:
+            count = self.pinned.pop(key, 0) - 1
+            if count > 0:
+                self.pinned[key] = count
+        self._evict()
+
+    def clue_path(self, key, idx, extension):
+        '''Returns the path of a clue, whether or not it exists.'''
+
+        return os.path.join(self._entry_path(key), clue_filename(idx, extension))
+
+    def get_clue(self, key, idx, extension):
+        '''Returns the bytes of a clue, or None if it is not cached.'''
+
+        try:
+            with open(self.clue_path(key, idx, extension), 'rb') as fin:
+                data = fin.read()
+        except OSError:
+            return None
+
+        self._touch(key)
+        return data
+
+    def put_clue(self, key, idx, extension, data):
+        '''Stores a rendered clue.'''
+
+        path = self.clue_path(key, idx, extension)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        with open(path, 'wb') as fout:
+            fout.write(data)
+
+        self._add(key, os.path.basename(path))
+
+    def size(self):
+        '''Returns the total size of the cache in bytes.'''
+
+        with self.lock:
+            return sum(size for size, _ in self.entries.values())
+
+    def _entry_path(self, key):
+        return os.path.join(self.path, key)
+
+    def _scan(self):
+        '''Loads size and access time of the entries already on disk.'''
+
+        with os.scandir(self.path) as it:
+            for entry in it:
+                if not entry.is_dir():
+                    continue
+                size = 0
+                with os.scandir(entry.path) as files:
+                    for f in files:
+                        size += f.stat().st_size
+                self.entries[entry.name] = [size, entry.stat().st_mtime]
+
+        logger.info(
+            'Clue cache has %d entries, %d bytes', len(self.entries), self.size()
+        )
+
+    def _touch(self, key):
+        '''Marks an entry as recently used.'''
+
+        now = time.time()
+        with self.lock:
+            if key in self.entries:
+                self.entries[key][1] = now
+        try:
+            # The mtime keeps the LRU order across restarts
+            os.utime(self._entry_path(key), (now, now))
+        except OSError:
+            pass
+
+    def _add(self, key, *filenames):
+        '''Accounts for new files in an entry and evicts if needed.'''
+
+        entry_path = self._entry_path(key)
+        added = sum(os.path.getsize(os.path.join(entry_path, f)) for f in filenames)
+
+        with self.lock:
+            entry = self.entries.setdefault(key, [0, 0])
+            entry[0] += added
+        self._touch(key)
+        self._evict(keep=key)
+
+    def _evict(self, keep=None):
+        '''Deletes least recently used entries until the cache fits its budget.'''
+
+        with self.lock:
+            total = sum(size for size, _ in self.entries.values())
+            if total <= self.max_bytes:
+                return
+
+            victims = []
+            for key, (size, _) in sorted(self.entries.items(), key=lambda e: e[1][1]):
+                if total <= self.max_bytes:
+                    break
+                if key == keep or key in self.pinned:
+                    continue
+                victims.append(key)
+                total -= size
+                del self.entries[key]
+
+        for key in victims:
+            logger.debug('Evicting %s from the clue cache', key)
+            shutil.rmtree(self._entry_path(key), ignore_errors=True)
@@ -0,0 +1,170 @@
+'''Offline compilation of a dataset into a ready-to-serve artifact.
+
+compile_dataset does ahead of time the image work that the bot would
+otherwise do when a question is picked. It validates every question and
+hashes its image. It scales the image and shuffles its chunks in each of the
+CLUE_SEEDS orders the bot picks from. It can also render all the clues. The results are stored in a ClueCache. The valid
+questions are written to a manifest together with the hash of each image.
+
+A bot run with that manifest as its dataset, the same cache and the same
+render options only reads files from the cache.
+
+The images are processed by a pool of processes. The cache entries are
+addressed by content, so compiling again only processes new or modified
+images.
+'''
+
+import concurrent.futures
+import logging
+import os
+
+from .clue_cache import clue_filename, write_base
+from .dataset import ValidationCache, validate_dataset
+from .image_generation import (
+    CLUE_SEEDS,
+    clue_cache_key,
+    encode_image,
+    load_image,
+    render_frames,
+    seeded_chunks,
+)
+from .manifest import MANIFEST_FILENAME, write_manifest
+
+logger = logging.getLogger(__name__)
+
+
+def _compile_image(job):
+    '''Writes the scaled image, chunks and clues of an image to its cache entries.
+
+    The image is scaled once for all the entries, one per chunk order.
+    '''
+
+    filepath, image_hash, options, entries, render_clues = job
+    try:
+        base_image = load_image(filepath, options)
+        for seed, entry_path in entries:
+            chunks = seeded_chunks(base_image, image_hash, seed)
+            write_base(entry_path, base_image, chunks)
+
+            if not render_clues:
+                continue
+            frames = render_frames(base_image, chunks)
+            for idx, frame in enumerate(frames):
+                path = os.path.join(entry_path, clue_filename(idx, options.extension()))
+                with open(path, 'wb') as fout:
+                    fout.write(encode_image(frame, options))
+    except Exception as e:
+        return f'{filepath}: {e}'
+    return None
+
+
+def _is_compiled(clue_cache, key, options, render_clues):
+    if not clue_cache.has_base(key):
+        return False
+    if not render_clues:
+        return True
+
+    # The number of clues is only known from the chunks, check the first one
+    return os.path.exists(clue_cache.clue_path(key, 0, options.extension()))
+
+
+def compile_dataset(
+    index,
+    output,
+    options,
+    clue_cache,
+    processes=None,
+    validation_cache=None,
+    render_clues=False,
+):
+    '''Compiles the questions of a dataset index.
+
+    Arguments:
+        - index: DatasetIndex or ManifestIndex, refreshed
+        - output: directory for the compiled manifest
+        - options: RenderOptions the bot will use
+        - clue_cache: ClueCache where the images are stored. It must be big
+          enough for the whole dataset, or the oldest images are evicted.
+        - processes: number of worker processes. None uses all the CPUs.
+        - validation_cache: optional ValidationCache, see validate_dataset.
+          It is loaded from disk first, so only new or modified questions
+          are validated and hashed again.
+        - render_clues: also render all the clues of every image
+
+    Returns:
+        (number of questions in the manifest, list of problems found)
+    '''
+
+    if processes is None:
+        processes = os.cpu_count() or 1
+    if validation_cache is None:
+        validation_cache = ValidationCache()
+    validation_cache.loadFromDisk()
+
+    errors = validate_dataset(index, processes, validation_cache)
+
+    # The validation cache has the hash of every valid image
+    valid = []
+    pending = {}
+    for content in index.contents():
+        if not validation_cache.is_valid(content):
+            continue
+
+        filepath = content['filepath']
+        image_hash = validation_cache.info(content)['sha256']
+        keys = [
+            clue_cache_key(clue_cache, image_hash, options, seed)
+            for seed in range(CLUE_SEEDS)
+        ]
+        valid.append((dict(content, sha256=image_hash), keys))
+
+        entries = [
+            (seed, os.path.join(clue_cache.path, key))
+            for seed, key in enumerate(keys)
+            if not _is_compiled(clue_cache, key, options, render_clues)
+        ]
+        if entries and image_hash not in pending:
+            pending[image_hash] = (filepath, image_hash, options, entries, render_clues)
+
+    logger.info(
+        '%d valid questions, %d images to compile with %d processes',
+        len(valid),
+        len(pending),
+        processes,
+    )
+
+    failed = set()
+    if pending:
+        hashes = list(pending)
+        chunksize = max(1, len(hashes) // (processes * 4))
+        with concurrent.futures.ProcessPoolExecutor(max_workers=processes) as executor:
+            results = executor.map(
+                _compile_image, [pending[h] for h in hashes], chunksize=chunksize
+            )
+            for image_hash, error in zip(hashes, results):
+                if error is not None:
+                    errors.append(error)
+                    failed.add(image_hash)
+                    continue
+                for _, entry_path in pending[image_hash][3]:
+                    clue_cache.add_entry(os.path.basename(entry_path))
+
+    evicted = {
+        key
+        for content, keys in valid
+        if content['sha256'] not in failed
+        for key in keys
+        if not clue_cache.has_base(key)
+    }
+    if evicted:
+        logger.warning(
+            '%d compiled images did not fit in the clue cache. Increase its size.',
+            len(evicted),
+        )
+
+    os.makedirs(output, exist_ok=True)
+    count = write_manifest(
+        os.path.join(output, MANIFEST_FILENAME),
+        (content for content, _ in valid if content['sha256'] not in failed),
+    )
+    return count, errors
@@ -0,0 +1,512 @@
+'''Persistent index of the quiz questions available in a dataset folder.
+
+DatasetIndex remembers the modification time and size of every definition
+file, so refreshing it only parses the definitions that are new or changed
+since the last scan and forgets the ones that were deleted.
+
+The index can be stored on disk to make restarts cheap, and DatasetWatcher
+can keep it up to date in the background.
+
+validate_dataset checks that the images of the questions are usable without
+rendering any clue. With a ValidationCache only the questions that changed
+since the last validation are checked again.
+'''
+
+import concurrent.futures
+import hashlib
+import json
+import logging
+import os
+import threading
+
+from .render_options import ROWS, COLS
+from .image_quiz import load_definition_from_file, question_from_dict, question_to_dict
+from .util import hash_file, save_json_atomically
+
+logger = logging.getLogger(__name__)
+
+DEFAULT_INDEX_FILENAME = 'dataset_index.json'
+INDEX_VERSION = 1
+
+DEFAULT_VALIDATION_CACHE_FILENAME = 'validation_cache.json'
+VALIDATION_CACHE_VERSION = 3
+
+DEFINITION_EXTENSION = '.json'
+
+SUPPORTED_IMAGE_FORMATS = {'JPEG', 'PNG', 'GIF', 'WEBP'}
+
+
+def _same_stat(entry, mtime, size):
+    return entry is not None and entry['mtime'] == mtime and entry['size'] == size
+
+
+class DatasetIndex:
+    '''Incrementally updated index of the definitions in a directory.'''
+
+    def __init__(self, path, filename=None):
+        '''Creates an empty index.
+
+        Arguments:
+            - path: dataset directory with the JSON definitions
+            - filename: where the index is stored. None keeps it in memory.
+        '''
+
+        self.path = path
+        self.filename = filename
+        self.entries = {}
+        self.questions = []
+        self.errors = {}
+        self.lock = threading.Lock()
+
+    def loadFromDisk(self):
+        '''Loads a previously saved index. Returns False if there is none.'''
+
+        if self.filename is None:
+            return False
+
+        try:
+            with open(self.filename) as fin:
+                content = json.load(fin)
+            if 'format' in content:
+                raise ValueError(f'{self.filename} does not index definitions')
+            if content.get('version') != INDEX_VERSION:
+                raise ValueError(f'Unknown index version in {self.filename}')
+            if content.get('path') != self.path:
+                raise ValueError(f'{self.filename} indexes a different dataset')
+        except FileNotFoundError:
+            logger.info('No dataset index found in %s', self.filename)
+            return False
+        except Exception as e:
+            logger.error('Failed to load %s. Rebuilding the index...', self.filename)
+            logger.error(e, exc_info=True)
+            return False
+
+        with self.lock:
+            self.entries = content['definitions']
+            self._rebuild_questions()
+        logger.info('Dataset index loaded: %d definitions', len(self.entries))
+        return True
+
+    def saveToDisk(self):
+        '''Stores the index in self.filename, if any.'''
+
+        if self.filename is None:
+            return
+
+        with self.lock:
+            content = {
+                'version': INDEX_VERSION,
+                'path': self.path,
+                'definitions': self.entries,
+            }
+            save_json_atomically(self.filename, content)
+        logger.debug('Dataset index saved')
+
+    def refresh(self):
+        '''Updates the index with the current contents of the directory.
+
+        Only the definitions whose mtime or size changed are parsed again.
+        Definitions that fail to parse are left out of the index and
+        reported in self.errors until they are modified again.
+
+        Returns True if anything changed.
+        '''
+
+        current = self._scan()
+
+        with self.lock:
+            previous = self.entries
+            entries = {}
+            errors = {}
+            changed = False
+
+            for filepath, (mtime, size) in current.items():
+                entry = previous.get(filepath)
+                if _same_stat(entry, mtime, size):
+                    entries[filepath] = entry
+                    continue
+
+                error = self.errors.get(filepath)
+                if _same_stat(error, mtime, size):
+                    errors[filepath] = error
+                    continue
+
+                changed = True
+                try:
+                    logger.debug('Parsing %s...', filepath)
+                    questions = load_definition_from_file(filepath)
+                except Exception as e:
+                    logger.error('Unable to parse %s', filepath)
+                    logger.error(e, exc_info=True)
+                    errors[filepath] = {'mtime': mtime, 'size': size, 'error': str(e)}
+                    continue
+
+                entries[filepath] = {
+                    'mtime': mtime,
+                    'size': size,
+                    'questions': [question_to_dict(q) for q in questions],
+                }
+
+            changed = changed or previous.keys() != entries.keys()
+            self.entries = entries
+            self.errors = errors
+            if changed:
+                self._rebuild_questions()
+
+        if changed:
+            logger.info(
+                'Dataset index updated: %d definitions, %d questions',
+                len(self.entries),
+                len(self.questions),
+            )
+            self.saveToDisk()
+        return changed
+
+    def getQuestions(self):
+        '''Returns the list of ImageData in the index.'''
+
+        return self.questions
+
+    def load(self, question):
+        '''Returns the ImageData of a question. They are all in memory.'''
+
+        return question
+
+    def contents(self):
+        '''Yields the dictionary of every question in the index.'''
+
+        for filepath in sorted(self.entries):
+            yield from self.entries[filepath]['questions']
+
+    def _scan(self):
+        '''Returns {definition path: (mtime, size)} for the directory.'''
+
+        found = {}
+        with os.scandir(self.path) as it:
+            for entry in it:
+                if entry.name.startswith('.'):
+                    continue
+                if not entry.name.endswith(DEFINITION_EXTENSION):
+                    continue
+                if not entry.is_file():
+                    continue
+                stat = entry.stat()
+                found[entry.path] = (stat.st_mtime_ns, stat.st_size)
+        return found
+
+    def _rebuild_questions(self):
+        self.questions = [
+            question_from_dict(q)
+            for filepath in sorted(self.entries)
+            for q in self.entries[filepath]['questions']
+        ]
+
+
+class DatasetWatcher:
+    '''Keeps a DatasetIndex up to date from a background thread.
+
+    The directory mtime is checked every poll_seconds, which catches files
+    being added, removed or renamed into place. A full incremental refresh
+    also runs every refresh_seconds to catch definitions edited in place.
+    '''
+
+    def __init__(self, index, refresh_seconds, poll_seconds=1):
+        self.index = index
+        self.refresh_seconds = refresh_seconds
+        self.poll_seconds = min(poll_seconds, refresh_seconds)
+        self.stopEvent = threading.Event()
+        self.thread = None
+
+    def start(self):
+        '''Starts watching the dataset directory.'''
+
+        self.thread = threading.Thread(
+            target=self._run, name='dataset-watcher', daemon=True
+        )
+        self.thread.start()
+        logger.info('Watching %s for changes', self.index.path)
+
+    def stop(self):
+        '''Stops the background thread.'''
+
+        self.stopEvent.set()
+        if self.thread is not None:
+            self.thread.join()
+            self.thread = None
+
+    def is_running(self):
+        return self.thread is not None and self.thread.is_alive()
+
+    def _run(self):
+        last_mtime = self._directory_mtime()
+        waited = 0
+        while not self.stopEvent.wait(self.poll_seconds):
+            waited += self.poll_seconds
+            mtime = self._directory_mtime()
+            if mtime == last_mtime and waited < self.refresh_seconds:
+                continue
+
+            last_mtime = mtime
+            waited = 0
+            try:
+                self.index.refresh()
+            except Exception as e:
+                logger.error('Unable to refresh the dataset index')
+                logger.error(e, exc_info=True)
+
+    def _directory_mtime(self):
+        try:
+            return os.stat(self.index.path).st_mtime_ns
+        except OSError:
+            return None
+
+
+def validate_question(content):
+    '''Checks that a question can be used in the game.
+
+    Only the image headers are read, and verify() checks the file structure
+    without decoding the pixels.
+
+    Arguments:
+        - content: question as returned by question_to_dict
+
+    Returns:
+        List of error messages. Empty if the question is fine.
+    '''
+
+    # PIL is only needed when the validation cache is cold
+    from PIL import Image
+
+    errors = []
+    filepath = content['filepath']
+
+    if not content['title'].strip():
+        errors.append(f'{filepath}: empty title')
+
+    if not content['valid_responses']:
+        errors.append(f'{filepath}: no valid responses')
+
+    try:
+        with Image.open(filepath) as image:
+            if image.format not in SUPPORTED_IMAGE_FORMATS:
+                errors.append(f'{filepath}: unsupported format {image.format}')
+
+            width, height = image.size
+            if width < COLS or height < ROWS:
+                errors.append(f'{filepath}: image too small ({width} x {height})')
+
+            image.verify()
+    except Exception as e:
+        errors.append(f'{filepath}: {e}')
+
+    return errors
+
+
+def _file_info(filepath):
+    '''Returns the stat and content hash of filepath.'''
+
+    stat = os.stat(filepath)
+    return {
+        'mtime': stat.st_mtime_ns,
+        'size': stat.st_size,
+        'sha256': hash_file(filepath),
+    }
+
+
+def _check_question(content):
+    '''Validates a question and hashes its image if it is fine.'''
+
+    errors = validate_question(content)
+    info = None
+    if not errors:
+        try:
+            info = _file_info(content['filepath'])
+        except OSError as e:
+            errors.append(f'{content["filepath"]}: {e}')
+    return content, errors, info
+
+
+def _cached_fields(content):
+    '''Returns the fields of a question that identify it in the cache.
+
+    The image path is absolute, so a question is found whether it comes from
+    the definitions, a manifest or a compiled manifest somewhere else, and
+    extra fields like the sha256 of compiled manifests are left out.
+    '''
+
+    return {
+        'title': content['title'],
+        'filepath': os.path.abspath(content['filepath']),
+        'valid_responses': sorted(content['valid_responses']),
+    }
+
+
+class ValidationCache:
+    '''Remembers the questions that passed validation.
+
+    A question is identified by the content hash of its image plus the
+    fields parsed from its definition, so any change to either invalidates
+    it. The hash of each image is memoized by mtime and size, so checking a
+    warm cache only needs a stat per image.
+
+    Several datasets can share the cache. Each one only replaces its own
+    questions when it is validated again.
+    '''
+
+    def __init__(self, filename=None):
+        self.filename = filename
+        # image path: {'mtime', 'size', 'sha256'}
+        self.files = {}
+        # question key: image path
+        self.valid = {}
+        # dataset path: question keys
+        self.datasets = {}
+
+    def loadFromDisk(self):
+        '''Loads the cache from self.filename, if it exists.'''
+
+        if self.filename is None:
+            return
+
+        try:
+            with open(self.filename) as fin:
+                content = json.load(fin)
+            if content.get('version') != VALIDATION_CACHE_VERSION:
+                raise ValueError(f'Unknown cache version in {self.filename}')
+            self.files = content['files']
+            self.valid = content['valid']
+            self.datasets = content['datasets']
+            logger.info('Validation cache loaded: %d questions', len(self.valid))
+        except FileNotFoundError:
+            logger.info('No validation cache found in %s', self.filename)
+        except Exception as e:
+            logger.error('Failed to load %s. Using empty cache...', self.filename)
+            logger.error(e, exc_info=True)
+
+    def saveToDisk(self):
+        '''Stores the cache in self.filename, if any.'''
+
+        if self.filename is None:
+            return
+
+        content = {
+            'version': VALIDATION_CACHE_VERSION,
+            'files': self.files,
+            'valid': self.valid,
+            'datasets': self.datasets,
+        }
+        save_json_atomically(self.filename, content)
+
+    def is_valid(self, content):
+        '''Returns True if content was validated and has not changed since.'''
+
+        info = self.info(content)
+        if info is None:
+            return False
+
+        try:
+            stat = os.stat(content['filepath'])
+        except OSError:
+            return False
+
+        if not _same_stat(info, stat.st_mtime_ns, stat.st_size):
+            return False
+        return self.key(content, info['sha256']) in self.valid
+
+    def info(self, content):
+        '''Returns the stat and hash of the image of content, if known.'''
+
+        return self.files.get(os.path.abspath(content['filepath']))
+
+    def key(self, content, image_hash):
+        '''Returns the cache key of a question.'''
+
+        serialized = json.dumps([_cached_fields(content), image_hash], sort_keys=True)
+        return hashlib.sha256(serialized.encode('utf-8')).hexdigest()
+
+    def update(self, dataset, validated):
+        '''Replaces the questions of a dataset. Returns True if they changed.
+
+        The questions of the other datasets are kept, and the entries no
+        dataset refers to anymore are removed.
+
+        Arguments:
+            - dataset: path of the dataset
+            - validated: list of (question content, file info) of all the
+              questions of the dataset currently known to be valid
+        '''
+
+        dataset = os.path.abspath(dataset)
+        keys = {}
+        files = {}
+        for content, info in validated:
+            filepath = os.path.abspath(content['filepath'])
+            keys[self.key(content, info['sha256'])] = filepath
+            files[filepath] = info
+
+        if set(keys) == set(self.datasets.get(dataset, ())) and all(
+            self.files.get(f) == info for f, info in files.items()
+        ):
+            return False
+
+        self.datasets[dataset] = sorted(keys)
+        self.valid.update(keys)
+        self.files.update(files)
+
+        live = set().union(*self.datasets.values())
+        self.valid = {k: f for k, f in self.valid.items() if k in live}
+        live_files = set(self.valid.values())
+        self.files = {f: info for f, info in self.files.items() if f in live_files}
+        return True
+
+
+def validate_dataset(index, processes=None, cache=None):
+    '''Checks all the questions of index using a pool of processes.
+
+    Arguments:
+        - index: a refreshed DatasetIndex or ManifestIndex
+        - processes: number of worker processes. None uses all the CPUs.
+        - cache: optional ValidationCache. Questions that are still valid
+          in the cache are not checked again, and the cache is updated.
+
+    Returns:
+        List with all the problems found, including the definitions that
+        could not be parsed.
+    '''
+
+    errors = [
+        f'{filepath}: {error["error"]}' for filepath, error in index.errors.items()
+    ]
+
+    validated = []
+    pending = []
+    for content in index.contents():
+        if cache is not None and cache.is_valid(content):
+            validated.append((content, cache.info(content)))
+        else:
+            pending.append(content)
+
+    if validated:
+        logger.info('%d questions found in the validation cache', len(validated))
+
+    if pending:
+        if processes is None:
+            processes = os.cpu_count() or 1
+        chunksize = max(1, len(pending) // (processes * 4))
+
+        logger.info(
+            'Validating %d questions with %d processes...', len(pending), processes
+        )
+        with concurrent.futures.ProcessPoolExecutor(max_workers=processes) as executor:
+            for content, question_errors, info in executor.map(
+                _check_question, pending, chunksize=chunksize
+            ):
+                if question_errors:
+                    errors.extend(question_errors)
+                else:
+                    validated.append((content, info))
+
+    if cache is not None and cache.update(index.path, validated):
+        cache.saveToDisk()
+
+    return errors
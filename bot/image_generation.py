@@ -5,8 +5,19 @@ creates images where one by one each of the regions is covered.
 
 Returns the list of generated images in reversed order to simulate that it is
 revealing the image.
+
+generate_clues prepares the same clues but only renders each of them the first
+time it is requested. Without an output path the clues are kept in memory as
+EncodedImage instances instead of being written to files. RenderOptions selects
+how the clues are encoded, and an optional clue_cache.ClueCache keeps them
+between rounds. RenderOptions and the layout constants are defined in
+render_options, which can be imported without PIL.
+
+render_frames draws any subset of the clues of an image, each one
+independently of the others.
 '''
 
+import io
 import logging
 import os
 import uuid
@@ -14,14 +25,79 @@ import random
 
 from PIL import Image, ImageDraw
 
+from .render_options import (
+    COLS,
+    DEFAULT_RESAMPLE,
+    EXPECTED_WIDTH,
+    IMAGE_FORMATS,
+    OUTPUT_PATH,
+    RESAMPLING_FILTER_NAMES,
+    ROWS,
+    RenderOptions,
+)
+from .util import hash_file
+
 logger = logging.getLogger(__name__)
 
-OUTPUT_PATH = './output/'
-ROWS = 3
-COLS = 4
 COLOR = 'black'
 
-EXPECTED_WIDTH = 600
+# Chunk orders of an image with a clue cache. Each round picks one of them,
+# so a repeated question is revealed differently but is still likely cached.
+CLUE_SEEDS = 4
+
+LOSSY_FORMATS = {'JPEG', 'WEBP'}
+
+DEFAULT_QUALITY = 85
+MIN_QUALITY = 10
+
+RESAMPLING_FILTERS = {
+    name: getattr(Image.Resampling, name.upper()) for name in RESAMPLING_FILTER_NAMES
+}
+
+# Image modes that can be reduced and resized with any filter
+SCALABLE_MODES = ('L', 'LA', 'RGB', 'RGBA')
+
+
+def _save(image, image_format, **params):
+    buffer = io.BytesIO()
+    if image_format == 'JPEG' and image.mode not in ('RGB', 'L'):
+        image = image.convert('RGB')
+    image.save(buffer, image_format, **params)
+    return buffer.getvalue()
+
+
+def encode_image(image, options):
+    '''Encodes image following options. Returns the bytes.'''
+
+    if options.image_format not in LOSSY_FORMATS:
+        data = _save(image, options.image_format)
+        if options.max_bytes is not None and len(data) > options.max_bytes:
+            data = _save(image, options.image_format, optimize=True)
+        if options.max_bytes is not None and len(data) > options.max_bytes:
+            logger.warning('Clue of %d bytes exceeds the byte budget', len(data))
+        return data
+
+    quality = options.quality or DEFAULT_QUALITY
+    data = _save(image, options.image_format, quality=quality)
+    if options.max_bytes is None or len(data) <= options.max_bytes:
+        return data
+
+    # Binary search of the highest quality that fits in the budget
+    best = None
+    low, high = MIN_QUALITY, quality - 1
+    while low <= high:
+        middle = (low + high) // 2
+        candidate = _save(image, options.image_format, quality=middle)
+        if len(candidate) <= options.max_bytes:
+            best = candidate
+            low = middle + 1
+        else:
+            high = middle - 1
+
+    if best is None:
+        logger.warning('Unable to fit the clue in %d bytes', options.max_bytes)
+        best = _save(image, options.image_format, quality=MIN_QUALITY)
+    return best
 
 
 def scale_image(image, expected_width=EXPECTED_WIDTH):
@@ -38,12 +114,53 @@ def scale_image(image, expected_width=EXPECTED_WIDTH):
     return image.resize((width, height))
 
 
+def load_image(filepath, options=None):
+    '''Opens filepath and scales it to the width in options.
+
+    Large images are not decoded at full resolution: JPEG files are decoded
+    directly at 1/2, 1/4 or 1/8 of their size (draft mode) as long as they
+    stay wider than the target, and other formats are reduced by an integer
+    factor before the final resize. Peak memory for JPEG stays close to the
+    target size whatever the size of the source.
+    '''
+
+    if options is None:
+        options = RenderOptions()
+
+    image = Image.open(filepath)
+    width, height = image.size
+
+    # Same size as scale_image, computed from the original dimensions
+    factor = options.width / width
+    target_size = (int(width * factor), int(height * factor))
+    if image.size == target_size:
+        return image
+
+    if factor < 1:
+        image.draft(None, target_size)
+
+    # reduce and resize don't support palette (GIF), bilevel or 16-bit modes
+    if image.mode not in SCALABLE_MODES:
+        has_alpha = 'A' in image.mode or 'transparency' in image.info
+        image = image.convert('RGBA' if has_alpha else 'RGB')
+
+    if factor < 1:
+        reduce_factor = min(
+            image.size[0] // target_size[0], image.size[1] // target_size[1]
+        )
+        if reduce_factor > 1:
+            logger.debug('Reducing the image by a factor of %d', reduce_factor)
+            image = image.reduce(reduce_factor)
+
+    logger.info(f'Scaling the image by a factor of {factor}')
+    logger.info(f'New image size: {target_size[0]} x {target_size[1]}')
+    return image.resize(target_size, RESAMPLING_FILTERS[options.resample])
+
+
 def generate_images(key, output_path=OUTPUT_PATH):
     '''Generates n images based on the starting. Returns the list of images.'''
 
-    base_image_path = key
-    base_image = Image.open(base_image_path)
-    base_image = scale_image(base_image)
+    base_image = load_image(key)
     width, height = base_image.size
 
     chunks = compute_chunks(height, width, ROWS, COLS)
@@ -57,6 +174,265 @@ def generate_images(key, output_path=OUTPUT_PATH):
     return image_paths
 
 
+class EncodedImage:
+    '''Image encoded in memory, ready to be uploaded.'''
+
+    def __init__(self, data, mime_type, file_name):
+        self.data = data
+        self.mime_type = mime_type
+        self.file_name = file_name
+
+    def __repr__(self):
+        return (
+            f'EncodedImage({self.file_name}, {self.mime_type}, {len(self.data)} bytes)'
+        )
+
+
+def clue_cache_key(cache, image_hash, options, seed):
+    '''Returns the key of the clues of an image in a ClueCache.'''
+
+    return cache.key(image_hash, options, ROWS, COLS, COLOR, seed)
+
+
+def seeded_chunks(base_image, image_hash, seed):
+    '''Returns the chunk order given by seed, one of range(CLUE_SEEDS).'''
+
+    return _shuffled_chunks(base_image, random.Random(f'{image_hash}:{seed}'))
+
+
+def generate_clues(
+    key, output_path=OUTPUT_PATH, options=None, cache=None, image_hash=None, seed=None
+):
+    '''Prepares the clues for an image without rendering them. Returns a ClueSet.
+
+    If output_path is None the clues are not written to disk. options is a
+    RenderOptions, PNG by default.
+
+    With a ClueCache the scaled image and the clues are reused from previous
+    rounds with the same image. The chunk order is then one of CLUE_SEEDS,
+    given by seed or picked at random. image_hash saves hashing the image
+    when it is already known, like in compiled datasets.
+    '''
+
+    if options is None:
+        options = RenderOptions()
+
+    if cache is None:
+        base_image = load_image(key, options)
+        chunks = _shuffled_chunks(base_image, random)
+        return ClueSet(uuid.uuid4(), base_image, chunks, output_path, options)
+
+    if image_hash is None:
+        image_hash = hash_file(key)
+    if seed is None:
+        seed = random.randrange(CLUE_SEEDS)
+    cache_key = clue_cache_key(cache, image_hash, options, seed)
+
+    cached = cache.get_base(cache_key)
+    if cached is None:
+        base_image = load_image(key, options)
+        chunks = seeded_chunks(base_image, image_hash, seed)
+        cache.put_base(cache_key, base_image, chunks)
+    else:
+        base_image, chunks = cached
+
+    return ClueSet(
+        uuid.uuid4(),
+        base_image,
+        chunks,
+        output_path,
+        options,
+        cache,
+        cache_key,
+        seed,
+    )
+
+
+def restore_clues(key, content, output_path=OUTPUT_PATH, options=None, cache=None):
+    '''Recreates a ClueSet saved with ClueSet.to_dict.
+
+    The chunk order is the saved one, so the clues match the ones already
+    published. Clue files that are still on disk are reused.
+
+    Raises ValueError if the image doesn't have the saved size anymore.
+    '''
+
+    if options is None:
+        options = RenderOptions()
+
+    cache_key = content.get('cache_key')
+    cached = None
+    if cache is not None and cache_key is not None:
+        cached = cache.get_base(cache_key)
+
+    if cached is None:
+        base_image = load_image(key, options)
+        cache = cache_key = None
+    else:
+        base_image = cached[0]
+
+    if list(base_image.size) != content['size']:
+        raise ValueError(
+            f'{key} is {base_image.size} but the saved clues are {content["size"]}'
+        )
+
+    chunks = [tuple(c) for c in content['chunks']]
+    clues = ClueSet(
+        content['key'],
+        base_image,
+        chunks,
+        output_path,
+        options,
+        cache,
+        cache_key,
+        content.get('seed'),
+    )
+
+    if output_path is not None:
+        for idx, path in content['files'].items():
+            if os.path.exists(path):
+                clues.paths[int(idx)] = path
+                if path in content['temporary_files']:
+                    clues.temporary_files.append(path)
+    return clues
+
+
+def _shuffled_chunks(base_image, rng):
+    '''Returns the chunks to cover in the order they will be revealed.'''
+
+    width, height = base_image.size
+
+    chunks = compute_chunks(height, width, ROWS, COLS)
+    logger.debug(chunks)
+    rng.shuffle(chunks)
+    chunks.pop()
+    return chunks
+
+
+class ClueSet:
+    '''Sequence of clue images rendered on demand.
+
+    Clue i covers chunks[i:], so the first clue is the most hidden one and each
+    of the following reveals one more chunk, as in generate_step_images.
+    '''
+
+    def __init__(
+        self,
+        key,
+        base_image,
+        chunks,
+        output_path,
+        options=None,
+        cache=None,
+        cache_key=None,
+        seed=None,
+    ):
+        if options is None:
+            options = RenderOptions()
+
+        self.key = key
+        self.base_image = base_image
+        self.chunks = chunks
+        self.output_path = output_path
+        self.options = options
+        self.cache = cache
+        self.cache_key = cache_key
+        self.seed = seed
+        self.paths = {}
+        self.temporary_files = []
+
+        # The clue paths point into the cache entry until the round ends
+        self.pinned = cache is not None
+        if self.pinned:
+            cache.pin(cache_key)
+
+    def __len__(self):
+        return len(self.chunks)
+
+    def __repr__(self):
+        return f'ClueSet({self.key}, {len(self)} clues, rendered: {self.paths})'
+
+    def to_dict(self):
+        '''Returns what restore_clues needs to recreate the clues.'''
+
+        files = {}
+        if self.output_path is not None:
+            files = {str(idx): path for idx, path in self.paths.items()}
+
+        return {
+            'key': str(self.key),
+            'size': list(self.base_image.size),
+            'chunks': self.chunks,
+            'cache_key': self.cache_key,
+            'seed': self.seed,
+            'files': files,
+            'temporary_files': self.temporary_files,
+        }
+
+    def __getitem__(self, idx):
+        '''Returns clue idx, rendering it if needed.
+
+        The clue is a file path, or an EncodedImage if there is no output path.
+        '''
+
+        if not 0 <= idx < len(self.chunks):
+            raise IndexError(idx)
+
+        if idx not in self.paths:
+            self.paths[idx] = self.render(idx)
+        return self.paths[idx]
+
+    def render(self, idx):
+        '''Gets clue idx from the cache or draws it, in a file or in memory.'''
+
+        extension = self.options.extension()
+
+        data = None
+        if self.cache is not None:
+            data = self.cache.get_clue(self.cache_key, idx, extension)
+
+        if data is None:
+            data = self.draw(idx)
+            if self.cache is not None:
+                self.cache.put_clue(self.cache_key, idx, extension, data)
+
+        filename = f'{self.key}.{idx+1}.{extension}'
+        if self.output_path is None:
+            return EncodedImage(data, self.options.mime_type(), filename)
+
+        # Cached clues are already files, owned by the cache
+        if self.cache is not None:
+            return self.cache.clue_path(self.cache_key, idx, extension)
+
+        filepath = os.path.join(self.output_path, filename)
+        with open(filepath, 'wb') as fout:
+            fout.write(data)
+        self.temporary_files.append(filepath)
+        return filepath
+
+    def draw(self, idx):
+        '''Draws clue idx and encodes it. Returns the bytes.'''
+
+        logger.debug('Rendering clue %d', idx)
+        return encode_image(draw_frame(self.base_image, self.chunks, idx), self.options)
+
+    def clean(self):
+        '''Deletes the temporary files of the clues rendered so far.
+
+        The cache entry is released, so it can be evicted again.
+        '''
+
+        for path in self.temporary_files:
+            logger.debug('Deleting %s', path)
+            os.remove(path)
+        self.temporary_files = []
+        self.paths = {}
+
+        if self.pinned:
+            self.cache.unpin(self.cache_key)
+            self.pinned = False
+
+
 def compute_chunks(height, width, rows, cols):
     '''Returns retangle positions to cover the image.'''
 
@@ -73,16 +449,45 @@ def compute_chunks(height, width, rows, cols):
     return chunks
 
 
+def draw_frame(base_image, chunks, idx):
+    '''Returns a copy of base_image with chunks[idx:] covered.'''
+
+    image = base_image.copy()
+    draw_context = ImageDraw.Draw(image)
+    for chunk in chunks[idx:]:
+        draw_context.rectangle(chunk, fill=COLOR)
+    return image
+
+
+def render_frames(base_image, chunks, indexes=None):
+    '''Renders clues of base_image. Frame i has chunks[i:] covered.
+
+    Every frame is built from the base image alone, so any of them can be
+    rendered without the previous ones.
+
+    Arguments:
+        - base_image: scaled PIL image
+        - chunks: rectangles in the order they are revealed
+        - indexes: clues to render. All of them by default.
+
+    Returns:
+        List of PIL images, one per index.
+    '''
+
+    if indexes is None:
+        indexes = range(len(chunks))
+
+    return [draw_frame(base_image, chunks, idx) for idx in indexes]
+
+
 def generate_step_images(key, base_image, chunks, output_path):
     '''Writes the images to files.'''
 
     paths = []
-    draw_context = ImageDraw.Draw(base_image)
-    for i, chunk in reversed(list(enumerate(chunks))):
-        logger.debug('%d %s', i, chunk)
-        draw_context.rectangle(chunk, fill=COLOR)
+    for i, frame in enumerate(render_frames(base_image, chunks)):
+        logger.debug('%d %s', i, chunks[i])
         filename = f'{key}.{i+1}.png'
         filepath = os.path.join(output_path, filename)
-        base_image.save(filepath, 'PNG')
+        frame.save(filepath, 'PNG')
         paths.append(filepath)
-    return list(reversed(paths))
+    return paths
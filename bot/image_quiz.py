@@ -5,21 +5,42 @@ import logging
 import os
 import random
 
-from .image_generation import generate_images
+from .matcher import AnswerMatcher, FuzzyMatcher, normalize_response, normalize_text
+from .render_options import OUTPUT_PATH
 
 logger = logging.getLogger(__name__)
 
 
+def generate_clues(*args):
+    '''See image_generation.generate_clues.'''
+
+    # PIL is only loaded when the first clues are prepared
+    from .image_generation import generate_clues
+
+    return generate_clues(*args)
+
+
+def restore_clues(*args):
+    '''See image_generation.restore_clues.'''
+
+    from .image_generation import restore_clues
+
+    return restore_clues(*args)
+
+
 class ImageData:
     '''Information about an image for the game.'''
 
-    def __init__(self, title=None, filepath=None, valid_responses=None):
+    def __init__(
+        self, title=None, filepath=None, valid_responses=None, image_hash=None
+    ):
         '''Stores information about an image for the game.
 
         Arguments:
             - title: Full title of the game
             - filepath: path to the screenshot file
             - valid_resposes: iterable of valid responses for the quiz
+            - image_hash: SHA-256 of the file, if known in advance
 
         Example:
             ImageData(
@@ -30,25 +51,51 @@ class ImageData:
 
         self.title = title
         self.filepath = filepath
+        self.image_hash = image_hash
 
         if valid_responses is None:
             self.valid_responses = set()
         else:
             self.valid_responses = set(map(self._normalize, valid_responses))
 
-    def check(self, response):
-        '''Checks if response contains any of the valid responses.'''
+        # Compiled on the first check, most questions are never played
+        self._matcher = None
+        self._fuzzy_matcher = None
+
+    def check(self, response, max_edit_distance=0):
+        '''Checks if response contains any of the valid responses.
+
+        Arguments:
+            - response: HTML content of the response post
+            - max_edit_distance: number of typos tolerated. 0 only accepts
+              exact matches.
+        '''
+
+        if self._matcher is None:
+            self._matcher = AnswerMatcher(self.valid_responses)
+
+        text = normalize_response(response)
+        if self._matcher.search(text) is not None:
+            return True
 
-        response = self._normalize(response)
-        for vr in self.valid_responses:
-            if vr in response:
-                return True
-        return False
+        if max_edit_distance <= 0:
+            return False
+
+        if (
+            self._fuzzy_matcher is None
+            or self._fuzzy_matcher.max_distance != max_edit_distance
+        ):
+            self._fuzzy_matcher = FuzzyMatcher(self.valid_responses, max_edit_distance)
+
+        match = self._fuzzy_matcher.search(text)
+        if match is not None:
+            logger.info('Accepted "%s" as a typo of "%s"', text, match)
+        return match is not None
 
     def _normalize(self, value):
         '''Cleans a bit the string.'''
 
-        return value.lower().strip()
+        return normalize_text(value)
 
     def __repr__(self):
         return 'ImageData({}, {}, {})'.format(
@@ -56,6 +103,22 @@ class ImageData:
         )
 
 
+def question_to_dict(question):
+    '''Converts an ImageData into a JSON-serializable dictionary.'''
+
+    return {
+        'title': question.title,
+        'filepath': question.filepath,
+        'valid_responses': sorted(question.valid_responses),
+    }
+
+
+def question_from_dict(content):
+    '''Inverse of question_to_dict.'''
+
+    return ImageData(content['title'], content['filepath'], content['valid_responses'])
+
+
 def _validate_fields_exist(fields, dictionary):
     '''Checks that the needed fields are present in the dictionary.'''
 
@@ -64,6 +127,25 @@ def _validate_fields_exist(fields, dictionary):
             raise ValueError(f'Missing "{f}" field in "{dictionary}"')
 
 
+def _validate_field_types(dictionary):
+    '''Checks that the definition fields have the expected types.'''
+
+    title = dictionary['title']
+    if not isinstance(title, str) or not title.strip():
+        raise ValueError(f'"title" must be a non-empty string in "{dictionary}"')
+
+    for f in ['filepaths', 'valid_responses']:
+        values = dictionary[f]
+        if (
+            not isinstance(values, list)
+            or not values
+            or not all(isinstance(v, str) and v.strip() for v in values)
+        ):
+            raise ValueError(
+                f'"{f}" must be a non-empty list of strings in "{dictionary}"'
+            )
+
+
 def load_definition_from_file(filepath):
     '''Reads filepath and creates a ImageData object.'''
 
@@ -71,6 +153,7 @@ def load_definition_from_file(filepath):
         json_content = json.load(fin)
 
     _validate_fields_exist(['title', 'filepaths', 'valid_responses'], json_content)
+    _validate_field_types(json_content)
 
     base_path = os.path.dirname(filepath)
 
@@ -85,21 +168,144 @@ def load_definition_from_file(filepath):
     ]
 
 
+class Evaluation:
+    '''Result of ImageGame.evaluate.'''
+
+    def __init__(self, received=0):
+        self.winner = None
+        self.received = received
+        self.ignored = 0
+        self.checked = 0
+
+    def __str__(self):
+        winner = self.winner.creator if self.winner is not None else None
+        return (
+            f'Evaluation(winner: {winner}, received: {self.received}, '
+            f'ignored: {self.ignored}, checked: {self.checked})'
+        )
+
+
+def _post_order(response):
+    '''Sorts responses by post id, which grows with the publication time.'''
+
+    try:
+        return (0, int(response.post_id))
+    except (TypeError, ValueError):
+        return (1, 0)
+
+
 class ImageGame:
     '''Image-guesing game.'''
 
-    def __init__(self, definition):
+    def __init__(
+        self,
+        definition,
+        output_path=OUTPUT_PATH,
+        render_options=None,
+        clue_cache=None,
+        max_edit_distance=0,
+        clues=None,
+    ):
+        '''Prepares the clues of the game.
+
+        Arguments:
+            - definition: ImageData of the image to guess
+            - output_path: directory for the clue images. If None, clues are
+              kept in memory as EncodedImage instances.
+            - render_options: RenderOptions for the clues
+            - clue_cache: optional ClueCache to reuse clues between rounds
+            - max_edit_distance: typos tolerated in the responses
+            - clues: ClueSet to use instead of preparing new clues
+        '''
+
         self.definition = definition
+        self.max_edit_distance = max_edit_distance
 
         self.clue_idx = 0
 
-        logger.info('Generating clues...')
-        self.clues = generate_images(definition.filepath)
+        if clues is None:
+            logger.info('Preparing clues...')
+            clues = generate_clues(
+                definition.filepath,
+                output_path,
+                render_options,
+                clue_cache,
+                definition.image_hash,
+            )
+        self.clues = clues
+
+    @classmethod
+    def from_dict(
+        cls,
+        content,
+        output_path=OUTPUT_PATH,
+        render_options=None,
+        clue_cache=None,
+        max_edit_distance=0,
+    ):
+        '''Recreates a game saved with to_dict, at the same clue.'''
+
+        definition = question_from_dict(content['question'])
+        clues = restore_clues(
+            definition.filepath,
+            content['clues'],
+            output_path,
+            render_options,
+            clue_cache,
+        )
+        game = cls(
+            definition,
+            output_path,
+            render_options,
+            clue_cache,
+            max_edit_distance,
+            clues,
+        )
+        game.clue_idx = content['clue_idx']
+        return game
+
+    def to_dict(self):
+        '''Returns a JSON-serializable description of the game.'''
+
+        return {
+            'question': question_to_dict(self.definition),
+            'clue_idx': self.clue_idx,
+            'clues': self.clues.to_dict(),
+        }
 
     def is_valid(self, response):
         '''Returns True if the response is correct.'''
 
-        return self.definition.check(response)
+        return self.definition.check(response, self.max_edit_distance)
+
+    def evaluate(self, responses, post_ids):
+        '''Finds the first correct response among a batch of responses.
+
+        Responses are checked in the order they were posted, and the check
+        stops as soon as one of them is correct.
+
+        Arguments:
+            - responses: list of Response instances
+            - post_ids: ids of the posts of the game. Responses to other
+              posts are ignored.
+
+        Returns:
+            An Evaluation with the winner, if any, and some counters.
+        '''
+
+        evaluation = Evaluation(len(responses))
+        for r in sorted(responses, key=_post_order):
+            if r.in_reply_to_id not in post_ids:
+                evaluation.ignored += 1
+                continue
+
+            evaluation.checked += 1
+            if self.is_valid(r.content):
+                evaluation.winner = r
+                break
+
+        logger.info('%s', evaluation)
+        return evaluation
 
     def next_clue(self):
         '''Returns the next image clue for the game or None.'''
@@ -116,6 +322,12 @@ class ImageGame:
         self.clue_idx += 1
         return clue
 
+    def prerender(self):
+        '''Renders the next clue ahead of time.'''
+
+        if self.clue_idx < len(self.clues):
+            self.clues[self.clue_idx]
+
     def get_solution(self):
         '''Returns the correct solution title.'''
         return self.definition.title
@@ -125,12 +337,10 @@ class ImageGame:
         return self.definition.filepath
 
     def clean(self):
-        '''Deletes all clue images.'''
+        '''Deletes the clue images rendered for the game.'''
 
         logger.info('Deleting clue images...')
-        for path in self.clues:
-            logger.debug('Deleting %s', path)
-            os.remove(path)
+        self.clues.clean()
 
     def __str__(self):
         return f'ImageGame title: "{self.get_solution()}" clues: {self.clues}'
@@ -9,12 +9,11 @@ Usage:
 3) Start the bot with the run() method.
 '''
 
+import concurrent.futures
 import enum
-import glob
 import logging
 import os
 import os.path
-import random
 import sys
 import time
 
@@ -22,8 +21,13 @@ from datetime import datetime
 
 from . import strings
 from .util import enough_delay
-from .state import State
-from .image_quiz import ImageGame, load_definition_from_file
+from .state import DEFAULT_STATE_FILENAME, State
+from .dataset import DatasetWatcher, ValidationCache, validate_dataset
+from .render_options import OUTPUT_PATH
+from .image_quiz import ImageGame
+from .manifest import is_manifest, open_dataset
+from .scheduler import Scheduler
+from .selection import DECK_SUFFIX, DeckSelector, WeightedSelector
 
 
 logger = logging.getLogger(__name__)
@@ -58,15 +62,38 @@ class BotManager:
         history_size=HISTORY_SIZE,
         clueDelaySeconds=DEFAULT_CLUE_DELAY_SECONDS,
         checkDelaySeconds=DEFAULT_CHECK_DELAY_SECONDS,
+        datasetIndexFilename=None,
+        watchDatasetSeconds=0,
+        validationProcesses=None,
+        validationCacheFilename=None,
+        startTime=None,
+        prefetch=False,
+        outputPath=OUTPUT_PATH,
+        renderOptions=None,
+        clueCache=None,
+        maxEditDistance=0,
+        stateFilename=DEFAULT_STATE_FILENAME,
+        datasetIndex=None,
+        minCheckDelaySeconds=None,
+        selection='deck',
     ):
+        '''Creates the bot.
+
+        Most arguments are documented in main.py. When several bots run in
+        the same process (see runner.py) each one needs its own
+        stateFilename, and datasetIndex can be a dataset index shared by all
+        of them. A shared index is loaded and validated by its owner, so
+        datasetIndexFilename and watchDatasetSeconds are ignored.
+        '''
+
         if mastodon_client is None:
             raise ValueError('Mastodon client required')
 
         if datasetPath is None:
             raise ValueError('dataset path required')
 
-        if not os.path.isdir(datasetPath):
-            raise ValueError('dataset path must be a directory')
+        if not os.path.isdir(datasetPath) and not is_manifest(datasetPath):
+            raise ValueError('dataset path must be a directory or a manifest')
 
         self.mastodon_client = mastodon_client
         self.owner = owner
@@ -74,9 +101,45 @@ class BotManager:
         self.history_size = history_size
         self.checkDelaySeconds = checkDelaySeconds
         self.clueDelaySeconds = clueDelaySeconds
+        self.scheduler = Scheduler(
+            clueDelaySeconds, checkDelaySeconds, minCheckDelaySeconds
+        )
+        # None keeps the clues in memory
+        self.outputPath = outputPath
+        self.renderOptions = renderOptions
+        self.clueCache = clueCache
+        self.maxEditDistance = maxEditDistance
+        self.validationProcesses = validationProcesses
+        self.validationCache = ValidationCache(validationCacheFilename)
+
+        # Used to measure the time until the first clue is published
+        if startTime is None:
+            startTime = time.monotonic()
+        self.startTime = startTime
+        self.firstPostLogged = False
+
+        self.stateFilename = stateFilename
+        # 'deck' or 'weighted', see selection.py
+        self.selection = selection
+        self.selector = None
+
+        self.ownsDataset = datasetIndex is None
+        self.dataset = datasetIndex
+        if self.ownsDataset:
+            self.dataset = open_dataset(datasetPath, datasetIndexFilename)
+        self.datasetWatcher = None
+        if self.ownsDataset and watchDatasetSeconds > 0:
+            self.datasetWatcher = DatasetWatcher(self.dataset, watchDatasetSeconds)
+
+        # Renders the next round in the background while the current one runs
+        self.prefetch = prefetch
+        self.prefetchExecutor = None
+        self.nextRound = None
 
         self.currentState = BotStates.START
         self.currentRound = None
+        self.postIds = set()
+        self.lastClueTime = None
 
     def _changeState(self, newState):
         if newState == self.currentState:
@@ -84,65 +147,214 @@ class BotManager:
         self.currentState = newState
 
     def _onStateStart(self):
-        self.gameState = State(self.history_size)
+        self.gameState = State(self.history_size, self.stateFilename)
         self.gameState.loadFromDisk()
+        self.selector = self._createSelector()
+
+        if self.ownsDataset:
+            self.dataset.loadFromDisk()
+            self.validationCache.loadFromDisk()
+
+            # Uncomment to check all images in the dataset before starting
+            self._load_dataset(self.datasetPath, check=True)
 
-        # Uncomment to check all images in the dataset before starting
-        self._load_dataset(self.datasetPath, check=True)
+        if self.datasetWatcher is not None and not self.datasetWatcher.is_running():
+            self.datasetWatcher.start()
 
+        if self._resumeRound():
+            return
         self._changeState(BotStates.NEW_ROUND)
 
+    def _createSelector(self):
+        if self.selection == 'weighted':
+            return WeightedSelector(self.gameState.getStats())
+
+        selector = DeckSelector(self.stateFilename + DECK_SUFFIX)
+        selector.loadFromDisk()
+        return selector
+
+    def _recordResult(self, solved):
+        '''Updates the stats of the current question with the round result.'''
+
+        filepath = self.currentRound.get_image()
+        difficulty = 1
+        if solved:
+            clues = len(self.currentRound.clues)
+            difficulty = min(1, (self.currentRound.clue_idx - 1) / max(1, clues))
+
+        self.gameState.recordResult(filepath, solved, difficulty)
+        self.selector.update(filepath)
+
+    def _saveRound(self, state):
+        '''Persists the current round, to resume it in the given state.'''
+
+        lastClueTime = None
+        if self.lastClueTime is not None:
+            lastClueTime = self.lastClueTime.isoformat()
+
+        self.gameState.setRound(
+            {
+                'game': self.currentRound.to_dict(),
+                'postIds': list(self.postIds),
+                'lastClueTime': lastClueTime,
+                'state': state.value,
+            }
+        )
+
+    def _resumeRound(self):
+        '''Continues the round saved in the state, if any.
+
+        Returns False if there is no round to resume or it can't be restored.
+        '''
+
+        content = self.gameState.getRound()
+        if content is None:
+            return False
+
+        try:
+            game = ImageGame.from_dict(
+                content['game'],
+                self.outputPath,
+                self.renderOptions,
+                self.clueCache,
+                self.maxEditDistance,
+            )
+        except Exception as e:
+            logger.error('Unable to resume the round. Starting a new one...')
+            logger.error(e, exc_info=True)
+            self.gameState.setRound(None)
+            return False
+
+        self.currentRound = game
+        self.postIds = set(content['postIds'])
+        self.lastClueTime = None
+        if content['lastClueTime'] is not None:
+            self.lastClueTime = datetime.fromisoformat(content['lastClueTime'])
+
+        logger.info('Resuming round: %s', game)
+        self._changeState(BotStates(content['state']))
+        self._prefetchNextRound()
+        return True
+
     def _load_dataset(self, path, check=False):
-        '''Loads quiz questions from a directory.'''
-
-        logger.info('Loading dataset...')
-        definitions = glob.glob(os.path.join(path, '*.json'))
-        logger.debug('Found %d definition files: %s', len(definitions), definitions)
-
-        questions = []
-        for d in definitions:
-            try:
-                logger.debug('Parsing %s...', d)
-                qs = load_definition_from_file(d)
-                questions.extend(qs)
-
-                if check:
-                    for q in qs:
-                        logger.info('Checking %s %s', d, q)
-                        img = ImageGame(q)
-                        img.clean()
-            except Exception as e:
-                logger.error('Unable to parse %s', d)
-                logger.error(e, exc_info=True)
+        '''Returns the quiz questions of the dataset index.
+
+        The index is refreshed first unless the watcher keeps it up to date.
+        '''
+
+        if self.datasetWatcher is None or not self.datasetWatcher.is_running():
+            self.dataset.refresh()
+        questions = self.dataset.getQuestions()
+
+        if check:
+            validationStart = time.monotonic()
+            errors = validate_dataset(
+                self.dataset, self.validationProcesses, self.validationCache
+            )
+            logger.info(
+                'Dataset validated in %.2f seconds', time.monotonic() - validationStart
+            )
+            if errors:
+                logger.error('Found %d problems in the dataset:', len(errors))
+                for error in errors:
+                    logger.error(error)
                 sys.exit(-1)
 
         logger.info('%d questions loaded successfully', len(questions))
         return questions
 
-    def _pickQuestion(self, questions):
-        return random.choice(questions)
-
-    def _new_round(self):
+    def _selectQuestion(self):
         candidates = self._load_dataset(self.datasetPath)
+        try:
+            question, content = self._pickQuestion(candidates)
+        except (OSError, ValueError) as e:
+            # A manifest may change after the last refresh, moving its lines
+            logger.warning('%s. Refreshing the dataset...', e)
+            self.dataset.refresh()
+            question, content = self._pickQuestion(self.dataset.getQuestions())
+
+        self.gameState.addQuestion(question.filepath)
+        return content
+
+    def _pickQuestion(self, candidates):
+        '''Returns a question of candidates and its loaded content.'''
+
         if not candidates:
             msg = 'Unable to find any question'
             logger.error(msg)
             raise ValueError(msg)
 
-        question = self._pickQuestion(candidates)
-        if len(candidates) > self.history_size:
-            while question.filepath in self.gameState.getQuestions():
-                logger.debug('Repeated question: %s', question.filepath)
-                question = self._pickQuestion(candidates)
-
+        question = self.selector.pick(candidates, self.gameState.getQuestions())
         logger.debug('Selected question: %s', question)
-        self.gameState.addQuestion(question.filepath)
-        return ImageGame(question)
+        return question, self.dataset.load(question)
+
+    def _new_round(self):
+        return self._createGame(self._selectQuestion())
+
+    def _createGame(self, question):
+        return ImageGame(
+            question,
+            self.outputPath,
+            self.renderOptions,
+            self.clueCache,
+            self.maxEditDistance,
+        )
+
+    def _prefetchNextRound(self):
+        '''Starts rendering the next round in a background thread.'''
+
+        if not self.prefetch or self.nextRound is not None:
+            return
+
+        if self.prefetchExecutor is None:
+            self.prefetchExecutor = concurrent.futures.ThreadPoolExecutor(
+                max_workers=1, thread_name_prefix='prefetch'
+            )
+
+        question = self._selectQuestion()
+        logger.info('Preparing next round in the background: %s', question)
+        self.nextRound = self.prefetchExecutor.submit(self._prepareRound, question)
+
+    def _prepareRound(self, question):
+        game = self._createGame(question)
+        game.prerender()
+        return game
+
+    def _takeNextRound(self):
+        '''Returns the prefetched round, or creates one if there is none.'''
+
+        if self.nextRound is None:
+            return self._new_round()
+
+        future, self.nextRound = self.nextRound, None
+        try:
+            return future.result()
+        except Exception as e:
+            logger.error('Unable to prepare the round in the background')
+            logger.error(e, exc_info=True)
+            return self._new_round()
+
+    def _discardNextRound(self):
+        '''Cleans the prefetched round, if any.'''
+
+        if self.nextRound is None:
+            return
+
+        future, self.nextRound = self.nextRound, None
+        if future.cancel():
+            return
+        try:
+            future.result().clean()
+        except Exception as e:
+            logger.error(e, exc_info=True)
 
     def _onStateNewRound(self):
-        self.currentRound = self._new_round()
+        self.currentRound = self._takeNextRound()
         self.postIds = set()
+        self.lastClueTime = None
         self._changeState(BotStates.NEW_CLUE)
+        self._saveRound(BotStates.NEW_CLUE)
+        self._prefetchNextRound()
 
     def _publish_new_clue(self, current_game):
         clue = current_game.next_clue()
@@ -165,6 +377,15 @@ class BotManager:
         else:
             self.postIds.add(postId)
             self.lastClueTime = datetime.now()
+            self.scheduler.clue_posted()
+            self._saveRound(BotStates.WAIT)
+
+            if not self.firstPostLogged:
+                self.firstPostLogged = True
+                logger.info(
+                    'Time to first post: %.2f seconds',
+                    time.monotonic() - self.startTime,
+                )
             self._changeState(BotStates.WAIT)
 
     def _checkOwnerCommands(self, response):
@@ -196,29 +417,16 @@ class BotManager:
         logger.info('Checking for responses...')
         responses = self.mastodon_client.get_responses()
         logger.debug('Received %d responses', len(responses))
-        solutionFound = False
-        commandFound = False
+        self.scheduler.record_check(responses)
 
         for r in responses:
-            if r.creator == self.owner:
-                commandFound = self._checkOwnerCommands(r)
-                if commandFound:
-                    break
-
-            if r.in_reply_to_id not in self.postIds:
-                logging.debug('post_id = %s, postIds = %s', r.post_id, self.postIds)
-                logging.info('Response not in current game posts')
-
-            elif self.currentRound.is_valid(r.content):
-                logging.info('Correct response!')
-                # TODO like response
-                solutionFound = True
-            else:
-                logging.info('Invalid response')
-
-        if commandFound:
-            return
-        elif solutionFound:
+            if r.creator == self.owner and self._checkOwnerCommands(r):
+                return
+
+        evaluation = self.currentRound.evaluate(responses, self.postIds)
+        if evaluation.winner is not None:
+            logger.info('Correct response by %s!', evaluation.winner.creator)
+            # TODO like response
             self._changeState(BotStates.SOLUTION_FOUND)
         elif enough_delay(self.clueDelaySeconds, self.lastClueTime):
             self._changeState(BotStates.NEW_CLUE)
@@ -226,17 +434,23 @@ class BotManager:
             self._changeState(BotStates.WAIT)
 
     def _onStateFinishRound(self):
+        self._saveRound(BotStates.FINISH_ROUND)
         solution = self.currentRound.get_solution()
         msg = strings.SOLUTION_NOT_FOUND.format(solution)
         self.mastodon_client.post_with_media(msg, self.currentRound.get_image())
         self.currentRound.clean()
+        self._recordResult(solved=False)
+        self.gameState.setRound(None)
         self._changeState(BotStates.NEW_ROUND)
 
     def _onStateSolutionFound(self):
+        self._saveRound(BotStates.SOLUTION_FOUND)
         solution = self.currentRound.get_solution()
         msg = strings.SOLUTION_FOUND.format(solution)
         self.mastodon_client.post_with_media(msg, self.currentRound.get_image())
         self.currentRound.clean()
+        self._recordResult(solved=True)
+        self.gameState.setRound(None)
         self._changeState(BotStates.NEW_ROUND)
 
     def run(self):
@@ -250,8 +464,9 @@ class BotManager:
             self._onStateStart()
 
         elif self.currentState == BotStates.WAIT:
-            logger.info('Waiting...')
-            time.sleep(self.checkDelaySeconds)
+            timeout = self.scheduler.next_timeout(self.lastClueTime)
+            logger.info('Waiting %.1f seconds...', timeout)
+            self.mastodon_client.wait_for_responses(timeout)
             self._changeState(BotStates.CHECK_RESPONSES)
 
         elif self.currentState == BotStates.NEW_ROUND:
@@ -271,4 +486,5 @@ class BotManager:
 
         elif self.currentState == BotStates.FINISH_EXECUTION:
             logger.info('I have received the command to shut down myself')
+            self._discardNextRound()
             sys.exit(-1)
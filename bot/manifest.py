@@ -0,0 +1,349 @@
+'''Datasets described by JSON Lines manifests instead of one file per title.
+
+A manifest has one question per line:
+
+    {"title": "Stray", "filepath": "stray.jpg", "valid_responses": ["stray"]}
+
+Compiled manifests also have the "sha256" of each image, see compiler.py.
+
+The filepath is relative to the directory of the manifest. The dataset path
+given to the bot can be a single manifest file or a directory with a
+manifest.jsonl. In the latter case the manifest.jsonl of every subdirectory
+is a shard of the same dataset, so big catalogs can be split by folder.
+
+ManifestIndex reads each shard sequentially once and only keeps the filepath
+and the byte offset of every question. The rest of a question is read from
+its line when it is picked. Like DatasetIndex, the offsets can be stored on
+disk and a shard is only read again when its mtime or size changes.
+
+convert_dataset writes the manifest of a dataset in the per-file layout.
+'''
+
+import json
+import logging
+import os
+import tempfile
+import threading
+
+from .dataset import DatasetIndex, _same_stat
+from .image_quiz import ImageData
+from .util import save_json_atomically
+
+logger = logging.getLogger(__name__)
+
+MANIFEST_FILENAME = 'manifest.jsonl'
+MANIFEST_EXTENSION = '.jsonl'
+MANIFEST_INDEX_FORMAT = 'manifest'
+MANIFEST_INDEX_VERSION = 1
+
+
+def is_manifest(path):
+    '''Returns True if path is a manifest or a directory with one.'''
+
+    if os.path.isdir(path):
+        return os.path.isfile(os.path.join(path, MANIFEST_FILENAME))
+    return path.endswith(MANIFEST_EXTENSION) and os.path.isfile(path)
+
+
+def open_dataset(path, filename=None):
+    '''Returns the index for the dataset in path, whatever its layout.'''
+
+    if is_manifest(path):
+        return ManifestIndex(path, filename)
+    return DatasetIndex(path, filename)
+
+
+def parse_line(line, base_path):
+    '''Returns the question dictionary of a manifest line.
+
+    Raises ValueError if the line is not a valid question.
+    '''
+
+    content = json.loads(line)
+    if not isinstance(content, dict):
+        raise ValueError(f'Expected an object, got "{content}"')
+
+    for f in ['title', 'filepath']:
+        value = content.get(f)
+        if not isinstance(value, str) or not value.strip():
+            raise ValueError(f'"{f}" must be a non-empty string in "{content}"')
+
+    responses = content.get('valid_responses')
+    if (
+        not isinstance(responses, list)
+        or not responses
+        or not all(isinstance(r, str) and r.strip() for r in responses)
+    ):
+        raise ValueError(
+            f'"valid_responses" must be a non-empty list of strings in "{content}"'
+        )
+
+    question = {
+        'title': content['title'],
+        'filepath': os.path.join(base_path, content['filepath']),
+        'valid_responses': responses,
+    }
+
+    # Written by compiler.compile_dataset
+    if 'sha256' in content:
+        if not isinstance(content['sha256'], str):
+            raise ValueError(f'"sha256" must be a string in "{content}"')
+        question['sha256'] = content['sha256']
+    return question
+
+
+class ManifestQuestion:
+    '''Position of a question in a manifest, loaded by ManifestIndex.load.'''
+
+    __slots__ = ('filepath', 'shard', 'offset')
+
+    def __init__(self, filepath, shard, offset):
+        self.filepath = filepath
+        self.shard = shard
+        self.offset = offset
+
+    def __repr__(self):
+        return f'ManifestQuestion({self.filepath!r}, {self.shard!r}, {self.offset})'
+
+
+class ManifestIndex:
+    '''Lazily loaded index of the questions in a manifest and its shards.'''
+
+    def __init__(self, path, filename=None):
+        '''Creates an empty index.
+
+        Arguments:
+            - path: manifest file, or directory with a manifest.jsonl
+            - filename: where the index is stored. None keeps it in memory.
+        '''
+
+        self.path = path
+        self.filename = filename
+        # shard path: {'mtime', 'size', 'questions': [[filepath, offset]], 'errors'}
+        self.entries = {}
+        self.questions = []
+        self.errors = {}
+        self.lock = threading.Lock()
+
+    def loadFromDisk(self):
+        '''Loads a previously saved index. Returns False if there is none.'''
+
+        if self.filename is None:
+            return False
+
+        try:
+            with open(self.filename) as fin:
+                content = json.load(fin)
+            if content.get('format') != MANIFEST_INDEX_FORMAT:
+                raise ValueError(f'{self.filename} does not index a manifest')
+            if content.get('version') != MANIFEST_INDEX_VERSION:
+                raise ValueError(f'Unknown index version in {self.filename}')
+            if content.get('path') != self.path:
+                raise ValueError(f'{self.filename} indexes a different dataset')
+        except FileNotFoundError:
+            logger.info('No dataset index found in %s', self.filename)
+            return False
+        except Exception as e:
+            logger.error('Failed to load %s. Rebuilding the index...', self.filename)
+            logger.error(e, exc_info=True)
+            return False
+
+        with self.lock:
+            self.entries = content['shards']
+            self._rebuild_questions()
+        logger.info('Manifest index loaded: %d shards', len(self.entries))
+        return True
+
+    def saveToDisk(self):
+        '''Stores the index in self.filename, if any.'''
+
+        if self.filename is None:
+            return
+
+        with self.lock:
+            content = {
+                'format': MANIFEST_INDEX_FORMAT,
+                'version': MANIFEST_INDEX_VERSION,
+                'path': self.path,
+                'shards': self.entries,
+            }
+            save_json_atomically(self.filename, content)
+        logger.debug('Manifest index saved')
+
+    def refresh(self):
+        '''Reads the shards that are new or changed since the last refresh.
+
+        Lines that are not valid questions are left out and reported in
+        self.errors. Returns True if anything changed.
+        '''
+
+        current = self._scan()
+
+        with self.lock:
+            previous = self.entries
+            entries = {}
+            changed = False
+
+            for shard, (mtime, size) in current.items():
+                entry = previous.get(shard)
+                if not _same_stat(entry, mtime, size):
+                    changed = True
+                    logger.debug('Reading %s...', shard)
+                    entry = self._read_shard(shard, mtime, size)
+                entries[shard] = entry
+
+            changed = changed or previous.keys() != entries.keys()
+            self.entries = entries
+            if changed:
+                self._rebuild_questions()
+
+        if changed:
+            logger.info(
+                'Manifest index updated: %d shards, %d questions',
+                len(self.entries),
+                len(self.questions),
+            )
+            self.saveToDisk()
+        return changed
+
+    def getQuestions(self):
+        '''Returns the list of ManifestQuestion in the index.'''
+
+        return self.questions
+
+    def load(self, question):
+        '''Reads the ImageData of a ManifestQuestion from its shard.'''
+
+        with open(question.shard, 'rb') as fin:
+            fin.seek(question.offset)
+            content = parse_line(fin.readline(), os.path.dirname(question.shard))
+
+        if content['filepath'] != question.filepath:
+            raise ValueError(f'{question.shard} changed since it was indexed')
+        return ImageData(
+            content['title'],
+            content['filepath'],
+            content['valid_responses'],
+            content.get('sha256'),
+        )
+
+    def contents(self):
+        '''Yields the dictionary of every question, reading the shards in order.'''
+
+        for shard in sorted(self.entries):
+            base_path = os.path.dirname(shard)
+            with open(shard, 'rb') as fin:
+                for line in fin:
+                    try:
+                        yield parse_line(line, base_path)
+                    except ValueError:
+                        # Already in self.errors
+                        continue
+
+    def _scan(self):
+        '''Returns {shard path: (mtime, size)} for the dataset.'''
+
+        if not os.path.isdir(self.path):
+            stat = os.stat(self.path)
+            return {self.path: (stat.st_mtime_ns, stat.st_size)}
+
+        candidates = [os.path.join(self.path, MANIFEST_FILENAME)]
+        with os.scandir(self.path) as it:
+            for entry in it:
+                if entry.name.startswith('.') or not entry.is_dir():
+                    continue
+                candidates.append(os.path.join(entry.path, MANIFEST_FILENAME))
+
+        found = {}
+        for shard in candidates:
+            try:
+                stat = os.stat(shard)
+            except FileNotFoundError:
+                continue
+            found[shard] = (stat.st_mtime_ns, stat.st_size)
+        return found
+
+    def _read_shard(self, shard, mtime, size):
+        '''Returns the index entry of a shard with the offset of every question.'''
+
+        base_path = os.path.dirname(shard)
+        questions = []
+        errors = []
+        offset = 0
+        with open(shard, 'rb') as fin:
+            for lineno, line in enumerate(fin, 1):
+                if line.strip():
+                    try:
+                        content = parse_line(line, base_path)
+                        questions.append([content['filepath'], offset])
+                    except ValueError as e:
+                        logger.error('Unable to parse %s:%d', shard, lineno)
+                        errors.append([lineno, str(e)])
+                offset += len(line)
+
+        return {'mtime': mtime, 'size': size, 'questions': questions, 'errors': errors}
+
+    def _rebuild_questions(self):
+        self.questions = [
+            ManifestQuestion(filepath, shard, offset)
+            for shard in sorted(self.entries)
+            for filepath, offset in self.entries[shard]['questions']
+        ]
+        self.errors = {
+            f'{shard}:{lineno}': {'error': error}
+            for shard, entry in self.entries.items()
+            for lineno, error in entry['errors']
+        }
+
+
+def write_manifest(output, contents):
+    '''Writes question dictionaries as a manifest, replacing it atomically.
+
+    The filepaths are rewritten relative to the directory of output.
+    Returns the number of questions written.
+    '''
+
+    base_path = os.path.dirname(os.path.abspath(output))
+    count = 0
+
+    fd, tmp_path = tempfile.mkstemp(dir=base_path, prefix='.tmp-')
+    try:
+        with os.fdopen(fd, 'w') as fout:
+            for content in contents:
+                content = dict(content)
+                content['filepath'] = os.path.relpath(
+                    os.path.abspath(content['filepath']), base_path
+                )
+                fout.write(json.dumps(content) + '\n')
+                count += 1
+        os.replace(tmp_path, output)
+    except BaseException:
+        os.unlink(tmp_path)
+        raise
+
+    logger.info('%d questions written to %s', count, output)
+    return count
+
+
+def convert_dataset(path, output=None):
+    '''Writes the manifest of the per-file definitions in path.
+
+    Arguments:
+        - path: dataset directory with the JSON definitions
+        - output: manifest to write. Defaults to manifest.jsonl in path, so
+          the bot uses it from then on.
+
+    Returns:
+        (number of questions written, {definition path: error} for the
+        definitions that could not be parsed)
+    '''
+
+    if output is None:
+        output = os.path.join(path, MANIFEST_FILENAME)
+
+    index = DatasetIndex(path)
+    index.refresh()
+
+    count = write_manifest(output, index.contents())
+    errors = {filepath: error['error'] for filepath, error in index.errors.items()}
+    return count, errors
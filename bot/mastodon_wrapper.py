@@ -1,15 +1,29 @@
 '''Wrapper to encapsulate the Mastodon client  with a simpler interface.
 
 FakeMastodonWrapper can be instantiated to have a simulated Mastodon client.
+
+Media can be passed as a file path or as an in-memory image with data,
+mime_type and file_name attributes (see image_generation.EncodedImage).
+
+pooled_session returns a requests.Session to share between the clients of
+several games, so their uploads and polls reuse keep-alive connections.
+
+MastodonWrapper.start_streaming subscribes to the notification stream, so
+mentions are received as they arrive instead of waiting for the next poll.
 '''
 
+import hashlib
+import io
+import json
 import logging
+import queue
 import random
+import threading
+import time
 
-from mastodon import Mastodon
-from mastodon.errors import MastodonServiceUnavailableError
+from datetime import datetime
 
-from .util import retry
+from .util import enough_delay, hash_file, retry, save_json_atomically
 
 logger = logging.getLogger(__name__)
 
@@ -20,17 +34,23 @@ class FakeMastodonWrapper:
     def __init__(self):
         self.lastId = 1
 
-    def post_with_media(self, msg, filepath):
+    def post_with_media(self, msg, media):
         '''Simulates the post of an image. Returns random post id'''
 
         # if random.random() < 0.1:  # Fail 10% of the time
+        #    from mastodon.errors import MastodonServiceUnavailableError
         #    logger.info('Throwing fake error')
         #    raise MastodonServiceUnavailableError('Fake error!')
-        logger.info('Posting message "%s" filepath "%s"', msg, filepath)
+        logger.info('Posting message "%s" media "%s"', msg, media)
         logger.info('Returning random postId')
         self.lastId = int(1000000 * random.random())
         return self.lastId
 
+    def wait_for_responses(self, timeout):
+        '''Simulates waiting for new responses.'''
+
+        time.sleep(timeout)
+
     def get_responses(self):
         '''Simulates that some responses have been received.'''
 
@@ -41,46 +61,326 @@ class FakeMastodonWrapper:
         ]
 
 
+# Mastodon deletes media that is not attached to a post after a day
+DEFAULT_MEDIA_CACHE_SECONDS = 60 * 60 * 23
+
+STREAM_RECONNECT_SECONDS = 30
+
+# Maximum page size of the notifications API
+NOTIFICATIONS_PAGE_SIZE = 80
+
+DEFAULT_MAX_CONNECTIONS = 4
+
+
+def media_hash(media):
+    '''Returns the SHA-256 of a file path or in-memory image.'''
+
+    if isinstance(media, str):
+        return hash_file(media)
+    return hashlib.sha256(media.data).hexdigest()
+
+
+def pooled_session(max_connections=DEFAULT_MAX_CONNECTIONS):
+    '''Returns a requests.Session with a pool of keep-alive connections.
+
+    Up to max_connections requests to each instance are in flight at the
+    same time, the rest wait for a free connection. The GameRunner steps the
+    games on different threads, so with a shared session the upload of a
+    game overlaps the polls of the others without opening new connections.
+    '''
+
+    import requests
+
+    session = requests.Session()
+    adapter = requests.adapters.HTTPAdapter(
+        pool_maxsize=max_connections, pool_block=True
+    )
+    session.mount('https://', adapter)
+    session.mount('http://', adapter)
+    return session
+
+
+class MediaCache:
+    '''Ids of uploaded media that is not attached to any post yet.
+
+    Mastodon only accepts media in a new post if it is not attached to
+    another one, so an id is taken out of the cache when it is used.
+    '''
+
+    def __init__(self, expiry_seconds=DEFAULT_MEDIA_CACHE_SECONDS):
+        self.expiry_seconds = expiry_seconds
+        self.entries = {}
+
+    def take(self, digest):
+        '''Removes and returns the media id for the content hash, or None.'''
+
+        entry = self.entries.pop(digest, None)
+        if entry is None:
+            return None
+
+        media_id, uploaded = entry
+        if enough_delay(self.expiry_seconds, uploaded):
+            return None
+        return media_id
+
+    def add(self, digest, media_id):
+        self.entries[digest] = (media_id, datetime.now())
+
+
 class MastodonWrapper:
     '''Wrapper for the Mastodon client.'''
 
     # TODO inject mastodon dependency
-    def __init__(self, api_url, token, visibility):
+    def __init__(
+        self,
+        api_url,
+        token,
+        visibility,
+        media_cache_seconds=DEFAULT_MEDIA_CACHE_SECONDS,
+        session=None,
+        cursor_filename=None,
+    ):
+        '''Creates the Mastodon client.
+
+        Arguments:
+            - api_url: URL of the Mastodon instance
+            - token: access token of the bot account
+            - visibility: visibility of the posts
+            - media_cache_seconds: how long uploaded media ids are reused
+            - session: optional requests.Session for the HTTP requests, see
+              pooled_session
+            - cursor_filename: file to store the id of the last notification
+              read, so that restarts don't read mentions twice
+        '''
+
+        # Mastodon.py is slow to import and not needed in dry run mode
+        from mastodon import Mastodon
+
         self.visibility = visibility
+        self.media_cache = MediaCache(media_cache_seconds)
 
-        self.mastodon = Mastodon(access_token=token, api_base_url=api_url)
+        self.cursor_filename = cursor_filename
+        self.cursor_lock = threading.Lock()
+        # Ids of the streamed mentions that no poll has reached yet
+        self.streamed_ids = set()
+        self.last_notification_id = self._load_cursor()
 
-    @retry(times=10)
-    def post_with_media(self, msg, filepath):
-        '''Creates a post with an image.'''
+        self.mastodon = Mastodon(
+            access_token=token, api_base_url=api_url, session=session
+        )
 
-        upload_result = self.mastodon.media_post(media_file=filepath)
-        media_id = upload_result['id']
-        logger.info('Uploaded media with id %s', media_id)
+        # Mentions received from the stream, see start_streaming
+        self.stream_handle = None
+        self.streamed_responses = queue.Queue()
+        self.new_responses = threading.Event()
+
+    def start_streaming(self):
+        '''Receives mentions from the user stream as they arrive.
+
+        wait_for_responses returns as soon as a mention arrives. The stream
+        reconnects on its own and the mentions sent while it was down are
+        not replayed, so get_responses still polls after the streamed ones
+        and only returns the mentions the stream missed. Returns False if
+        the stream can't be opened.
+        '''
+
+        try:
+            self.stream_handle = self.mastodon.stream_user(
+                _mention_listener(self._on_streamed_mention),
+                run_async=True,
+                reconnect_async=True,
+                reconnect_async_wait_sec=STREAM_RECONNECT_SECONDS,
+            )
+        except Exception as e:
+            logger.error('Unable to open the notification stream, polling instead')
+            logger.error(e, exc_info=True)
+            return False
+
+        logger.info('Listening to the notification stream')
+        return True
+
+    def stop_streaming(self):
+        if self.stream_handle is not None:
+            self.stream_handle.close()
+            self.stream_handle = None
+
+    def is_streaming(self):
+        '''Returns True if mentions are being received from the stream.'''
+
+        return self.stream_handle is not None and self.stream_handle.is_receiving()
+
+    def wait_for_responses(self, timeout):
+        '''Waits up to timeout seconds, less if a mention is streamed.'''
+
+        if not self.is_streaming():
+            time.sleep(timeout)
+            return
+
+        self.new_responses.wait(timeout)
+
+    def _on_streamed_mention(self, notification):
+        # The poll cursor is not moved, or a poll would skip the mentions
+        # sent before this one while the stream was reconnecting
+        with self.cursor_lock:
+            if self._already_read(notification['id']):
+                return
+            self.streamed_ids.add(int(notification['id']))
+        self._save_cursor()
+
+        response = parse_response(notification['status'])
+        logger.info('Streamed response: %s', response)
+        self.streamed_responses.put(response)
+        self.new_responses.set()
+
+    def _take_streamed_responses(self):
+        self.new_responses.clear()
+        responses = []
+        while True:
+            try:
+                responses.append(self.streamed_responses.get_nowait())
+            except queue.Empty:
+                return responses
+
+    @retry(times=10)
+    def post_with_media(self, msg, media):
+        '''Creates a post with an image.
+
+        If a previous attempt uploaded the same content but failed to publish
+        the post, the uploaded media is reused.
+        '''
+
+        digest = media_hash(media)
+        media_id = self.media_cache.take(digest)
+        reused = media_id is not None
+        if reused:
+            logger.info('Reusing uploaded media with id %s', media_id)
+        else:
+            media_id = self.upload_media(media)
+
+        try:
+            post_result = self.mastodon.status_post(
+                msg, media_ids=[media_id], visibility=self.visibility
+            )
+        except Exception:
+            # A reused id may have expired, so it is uploaded again next time
+            if not reused:
+                self.media_cache.add(digest, media_id)
+            raise
 
-        post_result = self.mastodon.status_post(
-            msg, media_ids=[media_id], visibility=self.visibility
-        )
         post_id = post_result['id']
         logger.info('Published post with id %s', post_id)
         return post_id
 
-    @retry(times=10)
+    def upload_media(self, media):
+        '''Uploads a file path or in-memory image. Returns the media id.'''
+
+        if isinstance(media, str):
+            upload_result = self.mastodon.media_post(media_file=media)
+        else:
+            upload_result = self.mastodon.media_post(
+                media_file=io.BytesIO(media.data),
+                mime_type=media.mime_type,
+                file_name=media.file_name,
+            )
+        media_id = upload_result['id']
+        logger.info('Uploaded media with id %s', media_id)
+        return media_id
+
     def get_responses(self):
         '''Returns the list of all mentions to the bot as Response instances.'''
 
-        request_result = self.mastodon.notifications(types=['mention'])
-        statuses = [r['status'] for r in request_result]
-        logger.info('Found %d new notifications', len(statuses))
-        logger.debug(statuses)
-        responses = [parse_response(r) for r in statuses]
-        logger.info('Responses: %s', responses)
+        responses = self._take_streamed_responses()
+        if self.stream_handle is not None and not self.stream_handle.is_receiving():
+            logger.info('Notification stream is down, polling instead')
+        return responses + self._poll_responses()
 
-        logger.info('Clearing notifications...')
-        self.mastodon.notifications_clear()
+    @retry(times=10)
+    def _poll_responses(self):
+        '''Fetches the mentions newer than the last one read.
+
+        All the pages are read, oldest first, so no mention is lost however
+        many arrive between two polls. Without a previous cursor only the
+        latest page is read. The mentions already streamed are skipped.
+        '''
+
+        notifications = []
+        min_id = self.last_notification_id
+        while True:
+            page = self.mastodon.notifications(
+                types=['mention'], min_id=min_id, limit=NOTIFICATIONS_PAGE_SIZE
+            )
+            notifications.extend(page)
+            if min_id is None or len(page) < NOTIFICATIONS_PAGE_SIZE:
+                break
+            min_id = max((n['id'] for n in page), key=int)
+
+        notifications.sort(key=lambda n: int(n['id']))
+        logger.info('Found %d new notifications', len(notifications))
+        logger.debug(notifications)
+
+        responses = []
+        for n in notifications:
+            if self._advance_cursor(n['id']):
+                responses.append(parse_response(n['status']))
+        logger.info('Responses: %s', responses)
 
+        self._save_cursor()
         return responses
 
+    def _advance_cursor(self, notification_id):
+        '''Moves the cursor forward. Returns False if the id was already read.'''
+
+        with self.cursor_lock:
+            if self.last_notification_id is not None and int(notification_id) <= int(
+                self.last_notification_id
+            ):
+                return False
+            self.last_notification_id = notification_id
+
+            # Streamed ids up to the cursor are no longer needed to skip them
+            streamed = int(notification_id) in self.streamed_ids
+            self.streamed_ids = {
+                i for i in self.streamed_ids if i > int(notification_id)
+            }
+            return not streamed
+
+    def _already_read(self, notification_id):
+        # Ids are numeric strings in some versions of the API
+        if int(notification_id) in self.streamed_ids:
+            return True
+        return self.last_notification_id is not None and int(notification_id) <= int(
+            self.last_notification_id
+        )
+
+    def _load_cursor(self):
+        if self.cursor_filename is None:
+            return None
+
+        try:
+            with open(self.cursor_filename) as fin:
+                content = json.load(fin)
+            cursor = content['last_notification_id']
+            self.streamed_ids = set(content.get('streamed_ids', []))
+            logger.info('Last notification read: %s', cursor)
+            return cursor
+        except FileNotFoundError:
+            return None
+        except Exception as e:
+            logger.error('Failed to load %s', self.cursor_filename)
+            logger.error(e, exc_info=True)
+            return None
+
+    def _save_cursor(self):
+        if self.cursor_filename is None:
+            return
+
+        with self.cursor_lock:
+            content = {
+                'last_notification_id': self.last_notification_id,
+                'streamed_ids': sorted(self.streamed_ids),
+            }
+            save_json_atomically(self.cursor_filename, content)
+
 
 class Response:
     '''Encapsulates a response to the quiz.'''
@@ -96,6 +396,22 @@ class Response:
         return f'Response({self.post_id}, {self.creator}, {self.in_reply_to_id}, {self.content})'
 
 
+def _mention_listener(callback):
+    '''Returns a stream listener that calls callback with each mention.'''
+
+    from mastodon import StreamListener
+
+    class MentionListener(StreamListener):
+        def on_notification(self, notification):
+            if notification['type'] == 'mention':
+                callback(notification)
+
+        def on_abort(self, err):
+            logger.error('Notification stream error: %s', err)
+
+    return MentionListener()
+
+
 def parse_response(result):
     '''Converts a notification message from Mastodon into a Response object.'''
 
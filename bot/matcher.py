@@ -0,0 +1,224 @@
+'''Matching of quiz responses against the valid answers.
+
+Responses arrive as the HTML content of Mastodon posts. normalize_response
+strips the markup and the mentions and folds case and accents, so it can be
+compared with answers cleaned by normalize_text.
+
+AnswerMatcher compiles all the answers of a question into an Aho-Corasick
+automaton, which finds whether any of them appears in a response with a
+single pass over the text, however many answers there are.
+
+FuzzyMatcher tolerates typos. The answers are stored in a BK-tree, so each
+group of words of the response is only compared with the few answers whose
+edit distance to it can be small enough.
+'''
+
+import html
+import re
+import string
+import unicodedata
+
+# Line breaks and paragraphs separate words, other tags don't
+_BREAK_TAGS_RE = re.compile(r'<\s*(br|/p|/li)\b[^>]*>', re.IGNORECASE)
+_TAGS_RE = re.compile(r'<[^>]*>')
+_MENTIONS_RE = re.compile(r'(?<![\w@])@[\w.-]+(@[\w.-]+\w)?')
+_SPACES_RE = re.compile(r'\s+')
+
+
+def normalize_text(value):
+    '''Casefolds value, removes accents and collapses the whitespace.'''
+
+    value = unicodedata.normalize('NFKD', value.casefold())
+    value = ''.join(c for c in value if not unicodedata.combining(c))
+    return _SPACES_RE.sub(' ', value).strip()
+
+
+def normalize_response(content):
+    '''Converts the HTML content of a post into normalized plain text.'''
+
+    text = _BREAK_TAGS_RE.sub(' ', content)
+    text = html.unescape(_TAGS_RE.sub('', text))
+    text = _MENTIONS_RE.sub(' ', text)
+    return normalize_text(text)
+
+
+class AnswerMatcher:
+    '''Aho-Corasick automaton over a set of normalized answers.'''
+
+    def __init__(self, answers):
+        '''Compiles the automaton.
+
+        Arguments:
+            - answers: iterable of answers, already normalized
+        '''
+
+        # Node 0 is the root. Each node has its transitions, the node to
+        # continue from when no transition matches, and the answer found
+        # when reaching it, if any.
+        self.transitions = [{}]
+        self.fail = [0]
+        self.output = [None]
+
+        for answer in answers:
+            if answer:
+                self._add(answer)
+        self._link()
+
+    def search(self, text):
+        '''Returns the first answer found in the normalized text, or None.'''
+
+        transitions = self.transitions
+        fail = self.fail
+        output = self.output
+
+        node = 0
+        for c in text:
+            while node and c not in transitions[node]:
+                node = fail[node]
+            node = transitions[node].get(c, 0)
+            if output[node] is not None:
+                return output[node]
+        return None
+
+    def _add(self, answer):
+        node = 0
+        for c in answer:
+            child = self.transitions[node].get(c)
+            if child is None:
+                child = len(self.transitions)
+                self.transitions.append({})
+                self.fail.append(0)
+                self.output.append(None)
+                self.transitions[node][c] = child
+            node = child
+        self.output[node] = answer
+
+    def _link(self):
+        '''Computes the failure links breadth-first.'''
+
+        queue = list(self.transitions[0].values())
+        for node in queue:
+            for c, child in self.transitions[node].items():
+                queue.append(child)
+
+                fallback = self.fail[node]
+                while fallback and c not in self.transitions[fallback]:
+                    fallback = self.fail[fallback]
+                self.fail[child] = self.transitions[fallback].get(c, 0)
+
+                # An answer that ends inside a longer one is also a match
+                if self.output[child] is None:
+                    self.output[child] = self.output[self.fail[child]]
+
+
+def edit_distance(a, b):
+    '''Returns the Levenshtein distance between a and b.'''
+
+    if len(a) < len(b):
+        a, b = b, a
+
+    previous = list(range(len(b) + 1))
+    for i, ca in enumerate(a, 1):
+        current = [i]
+        for j, cb in enumerate(b, 1):
+            current.append(
+                min(
+                    previous[j] + 1,
+                    current[j - 1] + 1,
+                    previous[j - 1] + (ca != cb),
+                )
+            )
+        previous = current
+    return previous[-1]
+
+
+class BKTree:
+    '''Burkhard-Keller tree of strings for edit distance range queries.'''
+
+    def __init__(self, words=()):
+        # Each node is [word, {distance to word: child node}]
+        self.root = None
+        for word in words:
+            self.add(word)
+
+    def add(self, word):
+        if self.root is None:
+            self.root = [word, {}]
+            return
+
+        node = self.root
+        while True:
+            distance = edit_distance(word, node[0])
+            if distance == 0:
+                return
+            child = node[1].get(distance)
+            if child is None:
+                node[1][distance] = [word, {}]
+                return
+            node = child
+
+    def search(self, word, max_distance):
+        '''Returns [(distance, stored word)] within max_distance of word.'''
+
+        found = []
+        if self.root is None:
+            return found
+
+        pending = [self.root]
+        while pending:
+            stored, children = pending.pop()
+            distance = edit_distance(word, stored)
+            if distance <= max_distance:
+                found.append((distance, stored))
+
+            # Triangle inequality: other children are too far from word
+            for d, child in children.items():
+                if distance - max_distance <= d <= distance + max_distance:
+                    pending.append(child)
+        return found
+
+
+class FuzzyMatcher:
+    '''Finds answers written with a few typos inside a response.'''
+
+    def __init__(self, answers, max_distance):
+        '''Builds the index.
+
+        Arguments:
+            - answers: iterable of answers, already normalized
+            - max_distance: maximum number of edits tolerated. Short answers
+              tolerate less, one edit every four characters, so that "mp"
+              doesn't match any two-letter word.
+        '''
+
+        self.max_distance = max_distance
+        answers = [a for a in answers if self.allowed_distance(a) > 0]
+        self.tree = BKTree(answers)
+        self.word_counts = {len(a.split()) for a in answers}
+
+    def allowed_distance(self, answer):
+        return min(self.max_distance, len(answer) // 4)
+
+    def search(self, text):
+        '''Returns the closest answer found in the normalized text, or None.'''
+
+        # Punctuation around the words would count as typos
+        words = [w.strip(string.punctuation) for w in text.split()]
+        words = [w for w in words if w]
+
+        windows = set()
+        for count in self.word_counts:
+            # A missing or extra space changes the number of words
+            for n in range(max(1, count - 1), count + 2):
+                for i in range(len(words) - n + 1):
+                    windows.add(' '.join(words[i : i + n]))
+
+        best = None
+        for window in windows:
+            for distance, answer in self.tree.search(window, self.max_distance):
+                if distance > self.allowed_distance(answer):
+                    continue
+                if best is None or (distance, answer) < best:
+                    best = (distance, answer)
+
+        return None if best is None else best[1]
@@ -0,0 +1,85 @@
+'''Layout of the clues and how they are encoded.
+
+This module doesn't depend on PIL, so the command line, the dataset checks
+and the game logic can use the options without loading it. The images are
+rendered in image_generation.
+'''
+
+OUTPUT_PATH = './output/'
+ROWS = 3
+COLS = 4
+
+EXPECTED_WIDTH = 600
+
+# Format name: (MIME type, file extension)
+IMAGE_FORMATS = {
+    'PNG': ('image/png', 'png'),
+    'JPEG': ('image/jpeg', 'jpg'),
+    'WEBP': ('image/webp', 'webp'),
+}
+
+# See image_generation.RESAMPLING_FILTERS
+RESAMPLING_FILTER_NAMES = (
+    'nearest',
+    'box',
+    'bilinear',
+    'hamming',
+    'bicubic',
+    'lanczos',
+)
+DEFAULT_RESAMPLE = 'bicubic'
+
+
+class RenderOptions:
+    '''How the clue images are scaled and encoded.'''
+
+    def __init__(
+        self,
+        image_format='PNG',
+        quality=None,
+        max_bytes=None,
+        width=EXPECTED_WIDTH,
+        resample=DEFAULT_RESAMPLE,
+    ):
+        '''Validates and stores the options.
+
+        Arguments:
+            - image_format: one of IMAGE_FORMATS
+            - quality: quality of the lossy formats, from 1 to 100
+            - max_bytes: maximum size of each clue. Lossy formats lower the
+              quality until the clue fits, PNG tries an optimized encoding.
+            - width: width of the clues in pixels
+            - resample: name of the filter used to scale, see
+              RESAMPLING_FILTER_NAMES
+        '''
+
+        image_format = image_format.upper()
+        if image_format not in IMAGE_FORMATS:
+            raise ValueError(f'Unsupported image format {image_format}')
+        if quality is not None and not 1 <= quality <= 100:
+            raise ValueError('quality must be between 1 and 100')
+        if resample not in RESAMPLING_FILTER_NAMES:
+            raise ValueError(f'Unsupported resampling filter {resample}')
+        if width < COLS:
+            raise ValueError(f'width must be at least {COLS}')
+
+        self.image_format = image_format
+        self.quality = quality
+        self.max_bytes = max_bytes
+        self.width = width
+        self.resample = resample
+
+    def mime_type(self):
+        return IMAGE_FORMATS[self.image_format][0]
+
+    def extension(self):
+        return IMAGE_FORMATS[self.image_format][1]
+
+    def __repr__(self):
+        return 'RenderOptions({}, {}, {}, {}, {})'.format(
+            repr(self.image_format),
+            repr(self.quality),
+            repr(self.max_bytes),
+            repr(self.width),
+            repr(self.resample),
+        )
@@ -0,0 +1,143 @@
+'''Runs several quiz games in the same process.
+
+Each game is a BotManager with its own Mastodon client, state file and
+delays. The games share the dataset indexes, so every dataset folder is
+parsed and validated once, and the clue cache passed to their constructors.
+
+The state machines are driven from one asyncio event loop. Their steps
+block on network and image work, so they run on a pool of threads with one
+thread per game, and a slow upload in one game never delays the others.
+
+Usage:
+
+    runner = GameRunner(validationProcesses=4)
+    index = runner.dataset('./dataset/')
+    runner.add_game('games', BotManager(..., datasetIndex=index))
+    runner.prepare()
+    asyncio.run(runner.run())
+'''
+
+import asyncio
+import concurrent.futures
+import hashlib
+import logging
+import os
+
+from .dataset import ValidationCache, validate_dataset
+from .manager import BotStates
+from .manifest import open_dataset
+
+logger = logging.getLogger(__name__)
+
+
+def dataset_index_filename(filename, path):
+    '''Returns the index file of the dataset in path, derived from filename.
+
+    dataset_index.json becomes dataset_index.<hash of the path>.json, so the
+    games with different datasets don't overwrite each other's index.
+    '''
+
+    digest = hashlib.sha1(os.path.abspath(path).encode()).hexdigest()[:12]
+    root, extension = os.path.splitext(filename)
+    return f'{root}.{digest}{extension}'
+
+
+class GameRunner:
+    '''Hosts several BotManager state machines on one event loop.'''
+
+    def __init__(self, validationProcesses=None, validationCacheFilename=None):
+        '''Creates a runner without games.
+
+        Arguments:
+            - validationProcesses: processes used to validate the datasets
+            - validationCacheFilename: optional ValidationCache file shared by
+              all the datasets
+        '''
+
+        self.validationProcesses = validationProcesses
+        self.validationCache = ValidationCache(validationCacheFilename)
+
+        # dataset path: DatasetIndex or ManifestIndex
+        self.indexes = {}
+        # game name: BotManager
+        self.games = {}
+        self.executor = None
+
+    def dataset(self, path, indexFilename=None):
+        '''Returns the index of the dataset in path, creating it the first time.
+
+        The index is stored in a file derived from indexFilename and the
+        path, see dataset_index_filename. None keeps it in memory.
+        '''
+
+        key = os.path.abspath(path)
+        index = self.indexes.get(key)
+        if index is None:
+            if indexFilename is not None:
+                indexFilename = dataset_index_filename(indexFilename, path)
+            index = open_dataset(path, indexFilename)
+            index.loadFromDisk()
+            self.indexes[key] = index
+        return index
+
+    def add_game(self, name, game):
+        '''Adds a BotManager to the runner.'''
+
+        if name in self.games:
+            raise ValueError(f'Duplicated game name: {name}')
+        self.games[name] = game
+
+    def prepare(self):
+        '''Refreshes and validates all the datasets once.
+
+        Raises ValueError listing the problems found, if any.
+        '''
+
+        self.validationCache.loadFromDisk()
+
+        errors = []
+        for index in self.indexes.values():
+            index.refresh()
+            errors.extend(
+                validate_dataset(index, self.validationProcesses, self.validationCache)
+            )
+
+        if errors:
+            raise ValueError(
+                f'Found {len(errors)} problems in the datasets:\n' + '\n'.join(errors)
+            )
+
+    async def run(self):
+        '''Runs all the games until every one of them has finished.'''
+
+        if not self.games:
+            raise ValueError('No games to run')
+
+        self.executor = concurrent.futures.ThreadPoolExecutor(
+            max_workers=len(self.games), thread_name_prefix='game'
+        )
+        try:
+            await asyncio.gather(
+                *[self._run_game(name, game) for name, game in self.games.items()]
+            )
+        finally:
+            self.executor.shutdown(wait=True)
+            self.executor = None
+
+    async def _run_game(self, name, game):
+        '''Runs the steps of one game until it is told to finish.'''
+
+        loop = asyncio.get_running_loop()
+        logger.info('Starting game %s', name)
+
+        while game.currentState != BotStates.FINISH_EXECUTION:
+            try:
+                await loop.run_in_executor(self.executor, game._runStep)
+            except Exception as e:
+                # A broken game must not take down the others
+                logger.error('Game %s stopped after an error', name)
+                logger.error(e, exc_info=True)
+                break
+
+        logger.info('Game %s finished', name)
+        await loop.run_in_executor(self.executor, game._discardNextRound)
@@ -0,0 +1,65 @@
+'''Decides when the bot has to wake up next.
+
+The bot has two kinds of pending work while a round is running: publishing
+the next clue, due clueDelaySeconds after the previous one, and checking the
+replies. Sleeping until the earliest of both deadlines means a clue is
+never published late because the bot was waiting for a poll.
+
+Replies come in bursts after each clue, so the poll interval adapts to the
+reply rate: it starts short when a clue is posted, is halved after every
+check that found replies and doubles after every check that found none, up
+to checkDelaySeconds. With a streaming client the wait also ends as soon as
+a mention arrives.
+'''
+
+import logging
+
+from datetime import datetime
+
+logger = logging.getLogger(__name__)
+
+DEFAULT_MIN_POLL_SECONDS = 15
+
+
+class Scheduler:
+    '''Computes how long the bot can wait before its next deadline.'''
+
+    def __init__(self, clueDelaySeconds, maxPollSeconds, minPollSeconds=None):
+        '''Creates the scheduler.
+
+        Arguments:
+            - clueDelaySeconds: time between clues
+            - maxPollSeconds: longest time between two checks of the replies
+            - minPollSeconds: shortest time between two checks. Defaults to
+              DEFAULT_MIN_POLL_SECONDS, or maxPollSeconds if it is shorter.
+        '''
+
+        if minPollSeconds is None:
+            minPollSeconds = DEFAULT_MIN_POLL_SECONDS
+        self.clueDelaySeconds = clueDelaySeconds
+        self.maxPollSeconds = maxPollSeconds
+        self.minPollSeconds = min(minPollSeconds, maxPollSeconds)
+        self.pollSeconds = maxPollSeconds
+
+    def clue_posted(self):
+        '''Polls often again, a new clue usually brings replies.'''
+
+        self.pollSeconds = self.minPollSeconds
+
+    def record_check(self, responses):
+        '''Adapts the poll interval to the number of replies just received.'''
+
+        if responses:
+            self.pollSeconds = max(self.minPollSeconds, self.pollSeconds / 2)
+        else:
+            self.pollSeconds = min(self.maxPollSeconds, self.pollSeconds * 2)
+        logger.debug('Poll interval: %.1f seconds', self.pollSeconds)
+
+    def next_timeout(self, lastClueTime, now=None):
+        '''Returns the seconds until the next poll or clue, whichever is first.'''
+
+        if now is None:
+            now = datetime.now()
+
+        clueDue = self.clueDelaySeconds - (now - lastClueTime).total_seconds()
+        return max(0, min(self.pollSeconds, clueDue))
@@ -0,0 +1,356 @@
+'''Selection of the question for the next round.
+
+DeckSelector deals the questions like a shuffled deck of cards: every
+question is played once before any of them is repeated, and each pick takes
+constant time however big the dataset is. Questions still in the recent
+history are set aside until the end of the deck instead of being retried at
+random, so the pick is quick even when the history covers almost the whole
+dataset.
+
+The deck is stored next to the state file, so the order survives restarts.
+The shuffled deck is only written when it is shuffled; each pick just
+writes the position in it. Questions added to the dataset are shuffled into
+the part of the deck not dealt yet, and deleted ones are skipped when they
+come up.
+
+WeightedSelector favours some questions over others: the ones never played
+and the ones that were hard to solve. It keeps an alias table so each pick
+is also constant time.
+'''
+
+import json
+import logging
+import math
+import random
+
+from .util import save_json_atomically
+
+logger = logging.getLogger(__name__)
+
+SELECTION_MODES = ['deck', 'weighted']
+
+DECK_SUFFIX = '.deck'
+POSITION_SUFFIX = '.pos'
+DECK_VERSION = 1
+
+
+class DeckSelector:
+    '''Picks questions in the order of a persisted shuffled deck.'''
+
+    def __init__(self, filename=None, rng=None):
+        '''Creates an empty deck.
+
+        Arguments:
+            - filename: where the deck is stored. None keeps it in memory.
+            - rng: random.Random instance, for tests
+        '''
+
+        self.filename = filename
+        self.rng = rng if rng is not None else random.Random()
+
+        # Shuffled filepaths, dealt from position pos
+        self.deck = []
+        self.pos = 0
+        # Skipped because they were in the history, dealt after the deck
+        self.deferred = []
+        # Every filepath in the deck, dealt or not
+        self.known = set()
+        # Changes every time the deck is reshuffled
+        self.deckId = 0
+
+        # Last list of questions seen, to skip rebuilding byPath
+        self.questions = None
+        self.byPath = {}
+
+    def loadFromDisk(self):
+        '''Loads the deck saved by a previous run, if any.'''
+
+        if self.filename is None:
+            return
+
+        try:
+            with open(self.filename) as fin:
+                content = json.load(fin)
+            if content.get('version') != DECK_VERSION:
+                raise ValueError(f'Unknown deck version in {self.filename}')
+            self.deck = content['deck']
+            self.deckId = content['id']
+            self.known = set(self.deck)
+        except FileNotFoundError:
+            logger.info('No deck found in %s', self.filename)
+            return
+        except Exception as e:
+            logger.error('Failed to load %s. Shuffling a new deck...', self.filename)
+            logger.error(e, exc_info=True)
+            return
+
+        try:
+            with open(self.filename + POSITION_SUFFIX) as fin:
+                position = json.load(fin)
+            # The position may be older than the deck after a crash
+            if position['id'] == self.deckId:
+                self.pos = position['pos']
+                self.deferred = position['deferred']
+        except Exception as e:
+            logger.error('Failed to load the deck position. Starting over...')
+            logger.error(e, exc_info=True)
+
+        logger.info('Deck loaded: %d questions left', len(self.deck) - self.pos)
+
+    def pick(self, questions, history):
+        '''Returns the next question of the deck.
+
+        Arguments:
+            - questions: non-empty list of ImageData in the dataset
+            - history: set-like with the filepaths of the recent questions.
+              They are avoided if there are more questions than that.
+        '''
+
+        if questions is not self.questions:
+            self.questions = questions
+            self.byPath = {q.filepath: q for q in questions}
+            self._addNew()
+
+        byPath = self.byPath
+        avoidHistory = len(byPath) > len(history)
+
+        # A question set aside is not looked at again until the deck is
+        # reshuffled, so there are at most len(byPath) iterations plus one
+        # reshuffle
+        question = None
+        while question is None:
+            if self.pos == len(self.deck):
+                self._reshuffle()
+
+            filepath = self.deck[self.pos]
+            self.pos += 1
+            if filepath not in byPath:
+                # Deleted from the dataset
+                continue
+            if avoidHistory and filepath in history:
+                self.deferred.append(filepath)
+                continue
+            question = byPath[filepath]
+
+        self._savePosition()
+        return question
+
+    def update(self, filepath):
+        '''Nothing to do, all the questions have the same odds.'''
+
+    def _addNew(self):
+        '''Shuffles the questions that are not in the deck yet into it.'''
+
+        new = [f for f in self.byPath if f not in self.known]
+        if not new:
+            return
+
+        logger.info('Adding %d new questions to the deck', len(new))
+        pending = self.deck[self.pos :] + new
+        self.rng.shuffle(pending)
+
+        # The dealt part doesn't change, so the saved position stays valid
+        self.deck = self.deck[: self.pos] + pending
+        self.known.update(new)
+        self._saveDeck()
+
+    def _reshuffle(self):
+        '''Starts a new deck with all the questions.'''
+
+        logger.info('Shuffling a new deck of %d questions', len(self.byPath))
+        deferred = [f for f in self.deferred if f in self.byPath]
+        rest = set(deferred)
+        deck = [f for f in self.byPath if f not in rest]
+        self.rng.shuffle(deck)
+        # Questions set aside by the history are dealt last
+        self.rng.shuffle(deferred)
+
+        self.deck = deck + deferred
+        self.pos = 0
+        self.deferred = []
+        self.known = set(self.deck)
+        self.deckId += 1
+        self._saveDeck()
+        self._savePosition()
+
+    def _saveDeck(self):
+        if self.filename is None:
+            return
+
+        content = {'version': DECK_VERSION, 'id': self.deckId, 'deck': self.deck}
+        save_json_atomically(self.filename, content)
+
+    def _savePosition(self):
+        if self.filename is None:
+            return
+
+        content = {'id': self.deckId, 'pos': self.pos, 'deferred': self.deferred}
+        save_json_atomically(self.filename + POSITION_SUFFIX, content)
+
+
+# Weight of the questions that were never played
+FRESH_WEIGHT = 4
+# Weights are rounded to powers of 2 ** (1 / LEVELS_PER_DOUBLING)
+LEVELS_PER_DOUBLING = 2
+
+
+def question_weight(stats):
+    '''Returns the weight of a question from its results in past rounds.
+
+    Questions never played weigh FRESH_WEIGHT. The others weigh from 1, if
+    they were always solved with the first clue, to 3, if they were never
+    solved, so hard questions come back more often.
+
+    Arguments:
+        - stats: dictionary with the number of rounds "played" and the sum
+          of the "difficulty" of each one, as kept by State.recordResult.
+          None if the question was never played.
+    '''
+
+    if not stats or not stats['played']:
+        return FRESH_WEIGHT
+    return 1 + 2 * stats['difficulty'] / stats['played']
+
+
+def weight_level(weight):
+    return round(math.log2(weight) * LEVELS_PER_DOUBLING)
+
+
+class AliasTable:
+    '''Samples indexes with the given weights in constant time (Vose).'''
+
+    def __init__(self, weights):
+        count = len(weights)
+        total = sum(weights)
+        scaled = [w * count / total for w in weights]
+
+        self.prob = [1.0] * count
+        self.alias = list(range(count))
+
+        small = [i for i, w in enumerate(scaled) if w < 1]
+        large = [i for i, w in enumerate(scaled) if w >= 1]
+        while small and large:
+            s = small.pop()
+            l = large.pop()
+            self.prob[s] = scaled[s]
+            self.alias[s] = l
+            scaled[l] -= 1 - scaled[s]
+            if scaled[l] < 1:
+                small.append(l)
+            else:
+                large.append(l)
+
+    def sample(self, rng):
+        i = rng.randrange(len(self.prob))
+        return i if rng.random() < self.prob[i] else self.alias[i]
+
+
+class WeightedSelector:
+    '''Picks questions at random with probability proportional to their weight.
+
+    Questions are grouped by their rounded weight, so the alias table only
+    has one entry per group and a pick is a constant-time draw of a group
+    followed by a uniform draw inside it. A new result only moves one
+    question to another group and rebuilds the small table. The questions in
+    the history are taken out of their groups while they are there.
+    '''
+
+    def __init__(self, stats, rng=None):
+        '''Creates the selector.
+
+        Arguments:
+            - stats: dictionary {filepath: stats} kept up to date by State.
+              See question_weight.
+            - rng: random.Random instance, for tests
+        '''
+
+        self.stats = stats
+        self.rng = rng if rng is not None else random.Random()
+
+        # level: list of filepaths
+        self.groups = {}
+        # filepath: (level, index in the group)
+        self.positions = {}
+        # Questions of the dataset taken out because they are in the history
+        self.excluded = set()
+
+        self.table = None
+        self.levels = []
+
+        self.questions = None
+        self.byPath = {}
+
+    def pick(self, questions, history):
+        '''Returns a random question, avoiding the history if possible.
+
+        Arguments:
+            - questions: non-empty list of ImageData in the dataset
+            - history: set-like with the filepaths of the recent questions
+        '''
+
+        if questions is not self.questions:
+            self._sync(questions)
+
+        exclude = set()
+        if len(self.byPath) > len(history):
+            exclude = {f for f in history if f in self.byPath}
+        for filepath in self.excluded - exclude:
+            self._add(filepath)
+        for filepath in exclude - self.excluded:
+            self._remove(filepath)
+        self.excluded = exclude
+
+        if self.table is None:
+            self.levels = list(self.groups)
+            self.table = AliasTable(
+                [
+                    len(self.groups[l]) * 2 ** (l / LEVELS_PER_DOUBLING)
+                    for l in self.levels
+                ]
+            )
+
+        group = self.groups[self.levels[self.table.sample(self.rng)]]
+        return self.byPath[group[self.rng.randrange(len(group))]]
+
+    def update(self, filepath):
+        '''Moves a question to the group of its current weight.'''
+
+        if filepath in self.positions:
+            self._remove(filepath)
+            self._add(filepath)
+
+    def _sync(self, questions):
+        '''Adds the new questions of the dataset and removes the deleted ones.'''
+
+        byPath = {q.filepath: q for q in questions}
+        for filepath in list(self.positions):
+            if filepath not in byPath:
+                self._remove(filepath)
+        self.excluded &= byPath.keys()
+        for filepath in byPath:
+            if filepath not in self.positions and filepath not in self.excluded:
+                self._add(filepath)
+
+        self.questions = questions
+        self.byPath = byPath
+        logger.info('Weighted selection over %d groups', len(self.groups))
+
+    def _add(self, filepath):
+        level = weight_level(question_weight(self.stats.get(filepath)))
+        group = self.groups.setdefault(level, [])
+        self.positions[filepath] = (level, len(group))
+        group.append(filepath)
+        self.table = None
+
+    def _remove(self, filepath):
+        level, index = self.positions.pop(filepath)
+        group = self.groups[level]
+
+        # Swap with the last one to remove in constant time
+        last = group.pop()
+        if last != filepath:
+            group[index] = last
+            self.positions[last] = (level, index)
+        if not group:
+            del self.groups[level]
+        self.table = None
@@ -1,38 +1,212 @@
+'''Persistent state of the bot.
+
+The state is stored in two files: a JSON snapshot (state.json) and an
+append-only log next to it (state.json.log) with one JSON line per change
+since the snapshot. Recording a question only appends a line to the log, so
+its cost doesn't depend on the size of the history. When the log grows
+longer than the history it is compacted into a new snapshot, which is
+written atomically.
+
+Every change has a sequence number and the snapshot remembers the last one
+it includes, so a crash between writing the snapshot and truncating the log
+doesn't apply any change twice. A partially written last line, from a crash
+in the middle of an append, is ignored.
+
+Besides the history, the state keeps the round in progress, so a restarted
+bot can continue it, and the results of the past rounds of each question.
+'''
+
+import collections
 import json
 import logging
+import os
+
+from .util import save_json_atomically
 
 logger = logging.getLogger(__name__)
 
 DEFAULT_STATE_FILENAME = 'state.json'
+LOG_SUFFIX = '.log'
 
 
 class State:
-    def __init__(self, history_size=50):
-        self.history = []
+    '''History of the questions played, stored as a snapshot plus a log.'''
+
+    def __init__(self, history_size=50, filename=DEFAULT_STATE_FILENAME):
         self.history_size = history_size
+        self.filename = filename
+
+        self._history = collections.deque()
+        # Number of times each question appears in the history
+        self._counts = collections.Counter()
+        self.round = None
+        # filepath: {'played': rounds, 'solved': rounds, 'difficulty': sum}
+        self.stats = {}
+
+        # Sequence number of the last change
+        self.seq = 0
+        # Lines in the log since the last snapshot
+        self.logLength = 0
+
+    @property
+    def history(self):
+        '''Questions of the last games, oldest first.'''
+
+        return list(self._history)
+
+    @history.setter
+    def history(self, questions):
+        self._history = collections.deque()
+        self._counts = collections.Counter()
+        for question in questions:
+            self._append(question)
 
     def addQuestion(self, question):
-        self.history.append(question)
-        while len(self.history) > self.history_size:
-            self.history_size.pop(0)
-        self.saveToDisk()
+        '''Records question as played and persists the change.'''
+
+        self._append(question)
+        self._log({'add': question})
+
+    def setRound(self, content):
+        '''Stores the round in progress. None when there is no round.'''
+
+        self.round = content
+        self._log({'round': content})
+
+    def getRound(self):
+        return self.round
+
+    def recordResult(self, question, solved, difficulty):
+        '''Adds the result of a round to the stats of question.
+
+        Arguments:
+            - question: filepath of the question
+            - solved: True if someone found the solution
+            - difficulty: from 0, solved with the first clue, to 1, not solved
+        '''
+
+        self._applyResult(question, solved, difficulty)
+        self._log({'result': [question, solved, difficulty]})
+
+    def getStats(self):
+        return self.stats
 
     def getQuestions(self):
-        return self.history
+        '''Returns the questions in the history as a set-like view.'''
+
+        return self._counts.keys()
 
-    def saveToDisk(self, filename=DEFAULT_STATE_FILENAME):
-        state = {'history': self.history}
-        with open(filename, 'w') as fout:
-            json.dump(state, fout)
-        logger.info('Stated saved')
-        print('Saved state')
+    def saveToDisk(self, filename=None):
+        '''Writes a snapshot of the whole state and empties the log.'''
+
+        if filename is None:
+            filename = self.filename
+
+        state = {
+            'history': self.history,
+            'round': self.round,
+            'stats': self.stats,
+            'seq': self.seq,
+        }
+        save_json_atomically(filename, state)
+
+        # The snapshot includes every change in the log
+        with open(filename + LOG_SUFFIX, 'w'):
+            pass
+        self.logLength = 0
+        logger.info('State saved')
+
+    def loadFromDisk(self, filename=None):
+        '''Loads the snapshot and replays the log written after it.'''
+
+        if filename is None:
+            filename = self.filename
 
-    def loadFromDisk(self, filename=DEFAULT_STATE_FILENAME):
         try:
             with open(filename) as fin:
                 state = json.load(fin)
-                self.history = state['history']
+            self.history = state['history']
+            self.round = state.get('round')
+            self.stats.clear()
+            self.stats.update(state.get('stats', {}))
+            self.seq = state.get('seq', 0)
             logger.info('State loaded')
+        except FileNotFoundError:
+            logger.info('No state found in %s. Using clean state...', filename)
         except Exception as e:
             logger.error(f'Failed to load {filename}. Using clean state...')
             logging.error(e, exc_info=True)
+
+        if not self._replay(filename + LOG_SUFFIX):
+            # Appending after a partial line would corrupt the next change
+            self.saveToDisk(filename)
+
+    def _append(self, question):
+        self._history.append(question)
+        self._counts[question] += 1
+
+        while len(self._history) > self.history_size:
+            old = self._history.popleft()
+            self._counts[old] -= 1
+            if not self._counts[old]:
+                del self._counts[old]
+
+    def _applyResult(self, question, solved, difficulty):
+        stats = self.stats.setdefault(
+            question, {'played': 0, 'solved': 0, 'difficulty': 0}
+        )
+        stats['played'] += 1
+        stats['solved'] += int(solved)
+        stats['difficulty'] += difficulty
+
+    def _log(self, change):
+        '''Appends a change to the log, compacting it when it gets long.'''
+
+        if self.logLength >= max(self.history_size, 1):
+            self.seq += 1
+            self.saveToDisk()
+            return
+
+        self.seq += 1
+        line = json.dumps(dict(change, seq=self.seq))
+        with open(self.filename + LOG_SUFFIX, 'a') as fout:
+            fout.write(line + '\n')
+            fout.flush()
+            os.fsync(fout.fileno())
+        self.logLength += 1
+
+    def _replay(self, logFilename):
+        '''Applies the changes of the log. Returns False if it was damaged.'''
+
+        try:
+            with open(logFilename) as fin:
+                lines = fin.readlines()
+        except FileNotFoundError:
+            return True
+
+        clean = True
+        replayed = 0
+        for line in lines:
+            try:
+                change = json.loads(line)
+            except ValueError:
+                logger.error('Ignoring truncated line in %s', logFilename)
+                clean = False
+                continue
+
+            self.logLength += 1
+            if change['seq'] <= self.seq:
+                continue
+
+            self.seq = change['seq']
+            if 'add' in change:
+                self._append(change['add'])
+            if 'round' in change:
+                self.round = change['round']
+            if 'result' in change:
+                self._applyResult(*change['result'])
+            replayed += 1
+
+        if replayed:
+            logger.info('Replayed %d changes from %s', replayed, logFilename)
+        return clean
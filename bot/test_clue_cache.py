@@ -0,0 +1,140 @@
+'''Tests for clue_cache module.'''
+
+import os
+import tempfile
+import unittest
+
+from unittest.mock import patch
+
+from PIL import Image
+
+from . import image_generation
+from .clue_cache import ClueCache
+
+
+class ClueCacheTest(unittest.TestCase):
+    def setUp(self):
+        self.tmpdir = tempfile.TemporaryDirectory()
+        self.path = os.path.join(self.tmpdir.name, 'cache')
+
+        self.image_path = os.path.join(self.tmpdir.name, 'image.png')
+        Image.effect_noise((80, 60), 64).save(self.image_path)
+
+    def tearDown(self):
+        self.tmpdir.cleanup()
+
+    def test_key(self):
+        '''Keys change with any of the parameters.'''
+
+        cache = ClueCache(self.path)
+        options = image_generation.RenderOptions()
+        key = cache.key('hash', options, 3, 4, 'black', 1)
+
+        self.assertEqual(key, cache.key('hash', options, 3, 4, 'black', 1))
+        self.assertNotEqual(key, cache.key('other', options, 3, 4, 'black', 1))
+        self.assertNotEqual(key, cache.key('hash', options, 3, 4, 'white', 1))
+        self.assertNotEqual(
+            key,
+            cache.key('hash', image_generation.RenderOptions('jpeg'), 3, 4, 'black', 1),
+        )
+
+    def test_reuses_clues(self):
+        '''A repeated image is neither scaled nor rendered again.'''
+
+        cache = ClueCache(self.path)
+        clues = image_generation.generate_clues(self.image_path, None, cache=cache)
+        first = clues[0]
+        self.assertIn(clues.seed, range(image_generation.CLUE_SEEDS))
+
+        with patch.object(image_generation, 'load_image') as mock_load, patch.object(
+            image_generation, 'encode_image'
+        ) as mock_encode:
+            cached = image_generation.generate_clues(
+                self.image_path, None, cache=ClueCache(self.path), seed=clues.seed
+            )
+            self.assertEqual(cached.chunks, clues.chunks)
+            self.assertEqual(cached[0].data, first.data)
+
+            mock_load.assert_not_called()
+            mock_encode.assert_not_called()
+
+    def test_seeds(self):
+        '''Each seed reveals the image in its own order.'''
+
+        cache = ClueCache(self.path)
+        orders = {
+            tuple(
+                image_generation.generate_clues(
+                    self.image_path, None, cache=cache, seed=seed
+                ).chunks
+            )
+            for seed in range(image_generation.CLUE_SEEDS)
+        }
+        self.assertEqual(len(orders), image_generation.CLUE_SEEDS)
+        self.assertEqual(len(cache.entries), image_generation.CLUE_SEEDS)
+
+        # The seed of a round is saved with it
+        clues = image_generation.generate_clues(self.image_path, None, cache=cache)
+        restored = image_generation.restore_clues(
+            self.image_path, clues.to_dict(), None, cache=cache
+        )
+        self.assertEqual(restored.seed, clues.seed)
+        self.assertEqual(restored.chunks, clues.chunks)
+
+    def test_files_owned_by_cache(self):
+        '''Cleaning the clues doesn't delete cached files.'''
+
+        cache = ClueCache(self.path)
+        clues = image_generation.generate_clues(
+            self.image_path, self.tmpdir.name, cache=cache
+        )
+        path = clues[0]
+        clues.clean()
+
+        self.assertTrue(path.startswith(self.path))
+        self.assertTrue(os.path.exists(path))
+
+    def test_live_clues_not_evicted(self):
+        '''The entries of the clues in play are kept until they are cleaned.'''
+
+        other_path = os.path.join(self.tmpdir.name, 'other.png')
+        Image.effect_noise((80, 60), 64).save(other_path)
+
+        cache = ClueCache(self.path)
+        clues = image_generation.generate_clues(
+            self.image_path, self.tmpdir.name, cache=cache
+        )
+        path = clues[0]
+
+        # Only one entry fits in the budget
+        cache.max_bytes = cache.size()
+        other = image_generation.generate_clues(
+            other_path, self.tmpdir.name, cache=cache
+        )
+        other[0]
+        self.assertTrue(os.path.exists(path))
+
+        clues.clean()
+        self.assertFalse(os.path.exists(path))
+        self.assertTrue(os.path.exists(other[0]))
+
+    def test_eviction(self):
+        '''Least recently used entries are evicted to fit in the budget.'''
+
+        cache = ClueCache(self.path, max_bytes=2500)
+        cache.put_clue('a', 0, 'png', b'a' * 1000)
+        cache.put_clue('b', 0, 'png', b'b' * 1000)
+        cache.get_clue('a', 0, 'png')
+        cache.put_clue('c', 0, 'png', b'c' * 1000)
+
+        self.assertIsNotNone(cache.get_clue('a', 0, 'png'))
+        self.assertIsNone(cache.get_clue('b', 0, 'png'))
+        self.assertIsNotNone(cache.get_clue('c', 0, 'png'))
+        self.assertEqual(cache.size(), 2000)
+
+        # The budget is also known after a restart
+        self.assertEqual(ClueCache(self.path, max_bytes=2500).size(), 2000)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,165 @@
+'''Tests for compiler module.'''
+
+import json
+import os
+import tempfile
+import unittest
+
+from unittest.mock import Mock, patch
+
+from PIL import Image
+
+from . import dataset, image_generation, manager
+from .clue_cache import ClueCache
+from .compiler import compile_dataset
+from .dataset import DatasetIndex, ValidationCache
+from .image_generation import RenderOptions
+from .manifest import MANIFEST_FILENAME, ManifestIndex
+from .test_dataset import write_definition
+
+
+class CompileDatasetTest(unittest.TestCase):
+    def setUp(self):
+        self.tmpdir = tempfile.TemporaryDirectory()
+        self.path = os.path.join(self.tmpdir.name, 'dataset')
+        self.output = os.path.join(self.tmpdir.name, 'compiled')
+        os.makedirs(self.path)
+
+        for name in ['a.png', 'b.png']:
+            Image.effect_noise((80, 60), 64).save(os.path.join(self.path, name))
+        write_definition(self.path, 'a.json', 'A', ['a.png'])
+        write_definition(self.path, 'b.json', 'B', ['b.png', 'missing.png'])
+
+        self.options = RenderOptions(width=40)
+        self.cache = ClueCache(os.path.join(self.tmpdir.name, 'cache'))
+
+    def tearDown(self):
+        self.tmpdir.cleanup()
+
+    def compile(self, render_clues=False, validation_cache=None):
+        index = DatasetIndex(self.path)
+        index.refresh()
+        return compile_dataset(
+            index,
+            self.output,
+            self.options,
+            self.cache,
+            1,
+            validation_cache,
+            render_clues,
+        )
+
+    def test_compile(self):
+        '''Valid questions are in the manifest and their images in the cache.'''
+
+        count, errors = self.compile()
+
+        self.assertEqual(count, 2)
+        self.assertEqual(len(errors), 1)
+        self.assertIn('missing.png', errors[0])
+
+        with open(os.path.join(self.output, MANIFEST_FILENAME)) as fin:
+            lines = [json.loads(line) for line in fin]
+        self.assertEqual([line['title'] for line in lines], ['A', 'B'])
+        self.assertTrue(all(len(line['sha256']) == 64 for line in lines))
+
+        index = ManifestIndex(self.output)
+        index.refresh()
+        question = index.load(index.getQuestions()[0])
+        self.assertEqual(
+            question.filepath, os.path.join(self.output, '../dataset/a.png')
+        )
+        self.assertEqual(question.image_hash, lines[0]['sha256'])
+
+        # The bot neither hashes nor scales the compiled images
+        with patch.object(image_generation, 'load_image') as mock_load, patch.object(
+            image_generation, 'hash_file'
+        ) as mock_hash:
+            clues = image_generation.generate_clues(
+                question.filepath, None, self.options, self.cache, question.image_hash
+            )
+            mock_load.assert_not_called()
+            mock_hash.assert_not_called()
+        self.assertEqual(clues.base_image.size[0], 40)
+
+    def test_render_clues(self):
+        '''All the clues can be rendered ahead of time.'''
+
+        self.compile(render_clues=True)
+
+        with open(os.path.join(self.output, MANIFEST_FILENAME)) as fin:
+            image_hash = json.loads(fin.readline())['sha256']
+        for seed in range(image_generation.CLUE_SEEDS):
+            key = image_generation.clue_cache_key(
+                self.cache, image_hash, self.options, seed
+            )
+            clues = image_generation.generate_clues(
+                os.path.join(self.path, 'a.png'),
+                None,
+                self.options,
+                self.cache,
+                None,
+                seed,
+            )
+
+            with patch.object(image_generation, 'encode_image') as mock_encode:
+                for idx in range(len(clues)):
+                    clues[idx]
+                mock_encode.assert_not_called()
+            self.assertEqual(clues.cache_key, key)
+
+    def test_incremental(self):
+        '''Images already compiled are not processed again.'''
+
+        self.compile()
+        entries = [os.path.join(self.cache.path, key) for key in self.cache.entries]
+        mtimes = [os.stat(os.path.join(e, 'base.png')).st_mtime_ns for e in entries]
+
+        count, _ = self.compile()
+
+        self.assertEqual(count, 2)
+        self.assertEqual(
+            [os.stat(os.path.join(e, 'base.png')).st_mtime_ns for e in entries], mtimes
+        )
+
+    def test_incremental_validation(self):
+        '''Compiling again only validates the questions that changed.'''
+
+        cache_filename = os.path.join(self.tmpdir.name, 'validation_cache.json')
+        write_definition(self.path, 'b.json', 'B', ['b.png'])
+        self.compile(validation_cache=ValidationCache(cache_filename))
+
+        with patch.object(
+            dataset.concurrent.futures, 'ProcessPoolExecutor'
+        ) as mock_executor:
+            count, errors = self.compile(
+                validation_cache=ValidationCache(cache_filename)
+            )
+            mock_executor.assert_not_called()
+        self.assertEqual((count, errors), (2, []))
+
+    def test_bot_start(self):
+        '''The bot finds the compiled questions in the validation cache.'''
+
+        cache_filename = os.path.join(self.tmpdir.name, 'validation_cache.json')
+        self.compile(validation_cache=ValidationCache(cache_filename))
+
+        bot = manager.BotManager(
+            Mock(),
+            'owner',
+            self.output,
+            validationCacheFilename=cache_filename,
+            stateFilename=os.path.join(self.tmpdir.name, 'state.json'),
+        )
+        with patch.object(
+            dataset.concurrent.futures, 'ProcessPoolExecutor'
+        ) as mock_executor:
+            bot._onStateStart()
+            mock_executor.assert_not_called()
+
+        self.assertEqual(bot.currentState, manager.BotStates.NEW_ROUND)
+        self.assertEqual(len(bot.dataset.getQuestions()), 2)
+
+
+if __name__ == '__main__':
+    unittest.main()
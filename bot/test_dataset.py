@@ -0,0 +1,233 @@
+'''Tests for dataset module.'''
+
+import json
+import os
+import tempfile
+import unittest
+
+from unittest.mock import patch
+
+from PIL import Image
+
+from . import dataset
+from .dataset import DatasetIndex, ValidationCache, validate_dataset
+
+
+def write_definition(path, name, title, filepaths, valid_responses=None):
+    '''Writes a JSON definition into path.'''
+
+    if valid_responses is None:
+        valid_responses = [title]
+
+    content = {
+        'title': title,
+        'filepaths': filepaths,
+        'valid_responses': valid_responses,
+    }
+    filepath = os.path.join(path, name)
+    with open(filepath, 'w') as fout:
+        json.dump(content, fout)
+    return filepath
+
+
+class DatasetIndexTest(unittest.TestCase):
+    '''Tests for DatasetIndex class.'''
+
+    def setUp(self):
+        self.tmpdir = tempfile.TemporaryDirectory()
+        self.path = self.tmpdir.name
+
+    def tearDown(self):
+        self.tmpdir.cleanup()
+
+    def test_refresh(self):
+        '''Indexes all the definitions in the directory.'''
+
+        write_definition(self.path, 'a.json', 'A', ['a1.jpg', 'a2.jpg'])
+        write_definition(self.path, 'b.json', 'B', ['b.jpg'])
+
+        index = DatasetIndex(self.path)
+        self.assertTrue(index.refresh())
+
+        filepaths = [q.filepath for q in index.getQuestions()]
+        expected = [os.path.join(self.path, f) for f in ['a1.jpg', 'a2.jpg', 'b.jpg']]
+        self.assertEqual(filepaths, expected)
+
+    def test_refresh_incremental(self):
+        '''Only new or modified definitions are parsed again.'''
+
+        write_definition(self.path, 'a.json', 'A', ['a.jpg'])
+        index = DatasetIndex(self.path)
+        index.refresh()
+
+        with patch.object(
+            dataset,
+            'load_definition_from_file',
+            wraps=dataset.load_definition_from_file,
+        ) as mock_load:
+            self.assertFalse(index.refresh())
+            mock_load.assert_not_called()
+
+            b = write_definition(self.path, 'b.json', 'B', ['b.jpg'])
+            self.assertTrue(index.refresh())
+            mock_load.assert_called_once_with(b)
+
+        self.assertEqual(len(index.getQuestions()), 2)
+
+    def test_refresh_deleted(self):
+        '''Deleted definitions are removed from the index.'''
+
+        a = write_definition(self.path, 'a.json', 'A', ['a.jpg'])
+        write_definition(self.path, 'b.json', 'B', ['b.jpg'])
+        index = DatasetIndex(self.path)
+        index.refresh()
+
+        os.remove(a)
+        self.assertTrue(index.refresh())
+        self.assertEqual([q.title for q in index.getQuestions()], ['B'])
+
+    def test_refresh_errors(self):
+        '''Broken definitions are reported and left out of the index.'''
+
+        write_definition(self.path, 'a.json', 'A', ['a.jpg'])
+        broken = os.path.join(self.path, 'broken.json')
+        with open(broken, 'w') as fout:
+            fout.write('{')
+
+        index = DatasetIndex(self.path)
+        index.refresh()
+
+        self.assertEqual(list(index.errors), [broken])
+        self.assertEqual([q.title for q in index.getQuestions()], ['A'])
+
+    def test_save_and_load(self):
+        '''A saved index is loaded without parsing the definitions again.'''
+
+        write_definition(self.path, 'a.json', 'A', ['a.jpg'], ['a', 'Aaa'])
+        filename = os.path.join(self.path, 'index.db')
+        DatasetIndex(self.path, filename).refresh()
+
+        index = DatasetIndex(self.path, filename)
+        self.assertTrue(index.loadFromDisk())
+
+        with patch.object(dataset, 'load_definition_from_file') as mock_load:
+            self.assertFalse(index.refresh())
+            mock_load.assert_not_called()
+
+        question = index.getQuestions()[0]
+        self.assertEqual(question.title, 'A')
+        self.assertEqual(question.valid_responses, {'a', 'aaa'})
+
+    def test_load_other_dataset(self):
+        '''An index from a different dataset directory is ignored.'''
+
+        write_definition(self.path, 'a.json', 'A', ['a.jpg'])
+        filename = os.path.join(self.path, 'index.db')
+        DatasetIndex(self.path, filename).refresh()
+
+        index = DatasetIndex('/other', filename)
+        self.assertFalse(index.loadFromDisk())
+
+
+class ValidateDatasetTest(unittest.TestCase):
+    '''Tests for validate_dataset.'''
+
+    def setUp(self):
+        self.tmpdir = tempfile.TemporaryDirectory()
+        self.path = self.tmpdir.name
+
+    def tearDown(self):
+        self.tmpdir.cleanup()
+
+    def test_valid_dataset(self):
+        '''A dataset with usable images has no errors.'''
+
+        Image.new('RGB', (40, 30)).save(os.path.join(self.path, 'a.png'))
+        write_definition(self.path, 'a.json', 'A', ['a.png'])
+
+        index = DatasetIndex(self.path)
+        index.refresh()
+
+        self.assertEqual(validate_dataset(index, processes=2), [])
+
+    def test_reports_all_errors(self):
+        '''All the broken questions and definitions are reported.'''
+
+        Image.new('RGB', (40, 30)).save(os.path.join(self.path, 'a.png'))
+        Image.new('RGB', (2, 2)).save(os.path.join(self.path, 'small.png'))
+        with open(os.path.join(self.path, 'corrupt.png'), 'wb') as fout:
+            fout.write(b'not an image')
+        write_definition(
+            self.path, 'a.json', 'A', ['a.png', 'small.png', 'corrupt.png', 'no.png']
+        )
+        write_definition(self.path, 'b.json', 'B', [])
+
+        index = DatasetIndex(self.path)
+        index.refresh()
+        errors = validate_dataset(index, processes=2)
+
+        self.assertEqual(len(errors), 4)
+        for name in ['small.png', 'corrupt.png', 'no.png', 'b.json']:
+            self.assertTrue(any(name in e for e in errors), name)
+
+    def test_validation_cache(self):
+        '''Unchanged questions are not validated again.'''
+
+        image_path = os.path.join(self.path, 'a.png')
+        Image.new('RGB', (40, 30)).save(image_path)
+        write_definition(self.path, 'a.json', 'A', ['a.png'])
+        cache_filename = os.path.join(self.path, 'cache.db')
+
+        index = DatasetIndex(self.path)
+        index.refresh()
+        self.assertEqual(
+            validate_dataset(index, 1, ValidationCache(cache_filename)), []
+        )
+
+        cache = ValidationCache(cache_filename)
+        cache.loadFromDisk()
+        with patch.object(dataset, 'validate_question') as mock_validate:
+            self.assertEqual(validate_dataset(index, 1, cache), [])
+            mock_validate.assert_not_called()
+
+        # Changing the image invalidates the cached result
+        with open(image_path, 'wb') as fout:
+            fout.write(b'not an image')
+        errors = validate_dataset(index, 1, cache)
+        self.assertEqual(len(errors), 1)
+        self.assertFalse(cache.valid)
+
+    def test_shared_validation_cache(self):
+        '''Datasets sharing a cache keep each other's questions.'''
+
+        cache_filename = os.path.join(self.path, 'cache.db')
+        indexes = []
+        for name in ['a', 'b']:
+            path = os.path.join(self.path, name)
+            os.makedirs(path)
+            Image.new('RGB', (40, 30)).save(os.path.join(path, 'a.png'))
+            write_definition(path, 'a.json', name, ['a.png'])
+            indexes.append(DatasetIndex(path))
+            indexes[-1].refresh()
+
+        cache = ValidationCache(cache_filename)
+        for index in indexes:
+            self.assertEqual(validate_dataset(index, 1, cache), [])
+
+        cache = ValidationCache(cache_filename)
+        cache.loadFromDisk()
+        self.assertEqual(len(cache.valid), 2)
+        with patch.object(dataset, 'validate_question') as mock_validate:
+            for index in indexes:
+                self.assertEqual(validate_dataset(index, 1, cache), [])
+            mock_validate.assert_not_called()
+
+        # Removing a question only drops it from its own dataset
+        os.remove(os.path.join(self.path, 'a', 'a.json'))
+        indexes[0].refresh()
+        validate_dataset(indexes[0], 1, cache)
+        self.assertEqual(list(cache.files), [os.path.join(self.path, 'b', 'a.png')])
+
+
+if __name__ == '__main__':
+    unittest.main()
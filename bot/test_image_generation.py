@@ -1,9 +1,15 @@
 '''Tests for image_generation module.'''
 
+import io
+import json
+import os
+import tempfile
 import unittest
 
 from unittest.mock import patch, Mock
 
+from PIL import Image
+
 from . import image_generation
 
 
@@ -33,3 +39,258 @@ class ImageGenerationTest(unittest.TestCase):
         chunks = image_generation.compute_chunks(10, 10, 2, 1)
         self.assertEqual(len(chunks), 2)
         self.assertEqual(chunks, [(0, 0, 9, 4), (0, 5, 9, 9)])
+
+
+class ClueSetTest(unittest.TestCase):
+    def setUp(self):
+        self.tmpdir = tempfile.TemporaryDirectory()
+        self.output_path = self.tmpdir.name
+
+        self.base_image = Image.new('RGB', (40, 30), 'white')
+        self.chunks = image_generation.compute_chunks(30, 40, 3, 4)
+        self.chunks.pop()
+        self.clues = image_generation.ClueSet(
+            'key', self.base_image, self.chunks, self.output_path
+        )
+
+    def tearDown(self):
+        self.tmpdir.cleanup()
+
+    def test_lazy(self):
+        '''Only the requested clues are rendered.'''
+
+        self.assertEqual(len(self.clues), 11)
+        self.clues[1]
+        self.clues[1]
+
+        self.assertEqual(os.listdir(self.output_path), ['key.2.png'])
+
+    def test_same_as_generate_step_images(self):
+        '''Each clue matches the eagerly generated one.'''
+
+        eager_path = os.path.join(self.output_path, 'eager')
+        os.mkdir(eager_path)
+        expected = image_generation.generate_step_images(
+            'eager', self.base_image.copy(), self.chunks, eager_path
+        )
+
+        for idx in [0, 5, 10]:
+            with Image.open(expected[idx]) as e, Image.open(self.clues[idx]) as c:
+                self.assertEqual(list(e.getdata()), list(c.getdata()))
+
+    def test_clean(self):
+        '''Deletes the rendered clues.'''
+
+        self.clues[0]
+        self.clues[3]
+        self.clues.clean()
+
+        self.assertEqual(os.listdir(self.output_path), [])
+
+    def test_restore(self):
+        '''Restored clues keep the chunk order and the rendered files.'''
+
+        image_path = os.path.join(self.output_path, 'image.png')
+        Image.effect_noise((40, 30), 64).save(image_path)
+        options = image_generation.RenderOptions(width=40)
+
+        clues = image_generation.generate_clues(image_path, self.output_path, options)
+        first = clues[0]
+        content = json.loads(json.dumps(clues.to_dict()))
+
+        with patch.object(image_generation.ClueSet, 'draw') as mock_draw:
+            restored = image_generation.restore_clues(
+                image_path, content, self.output_path, options
+            )
+            self.assertEqual(restored[0], first)
+            mock_draw.assert_not_called()
+
+        self.assertEqual(restored.chunks, clues.chunks)
+        self.assertEqual(restored.key, str(clues.key))
+
+        restored.clean()
+        self.assertFalse(os.path.exists(first))
+
+    def test_restore_other_size(self):
+        '''Clues of an image that changed size can't be restored.'''
+
+        image_path = os.path.join(self.output_path, 'image.png')
+        Image.effect_noise((40, 30), 64).save(image_path)
+        content = self.clues.to_dict()
+        content['size'] = [600, 450]
+
+        with self.assertRaises(ValueError):
+            image_generation.restore_clues(
+                image_path, content, None, image_generation.RenderOptions(width=40)
+            )
+
+    def test_in_memory(self):
+        '''Without output path clues are encoded in memory.'''
+
+        clues = image_generation.ClueSet('key', self.base_image, self.chunks, None)
+        clue = clues[2]
+
+        self.assertEqual(clue.mime_type, 'image/png')
+        self.assertEqual(clue.file_name, 'key.3.png')
+        with Image.open(io.BytesIO(clue.data)) as image:
+            self.assertEqual(image.size, (40, 30))
+
+        clues.clean()
+        self.assertEqual(os.listdir(self.output_path), [])
+
+    def test_jpeg(self):
+        '''Clues can be encoded as JPEG.'''
+
+        options = image_generation.RenderOptions('jpeg', quality=70)
+        clues = image_generation.ClueSet(
+            'key', self.base_image, self.chunks, None, options
+        )
+        clue = clues[0]
+
+        self.assertEqual(clue.mime_type, 'image/jpeg')
+        self.assertEqual(clue.file_name, 'key.1.jpg')
+        with Image.open(io.BytesIO(clue.data)) as image:
+            self.assertEqual(image.format, 'JPEG')
+
+
+class EncodeImageTest(unittest.TestCase):
+    def setUp(self):
+        # Noise compresses badly, so the quality matters
+        self.image = Image.effect_noise((200, 150), 64).convert('RGB')
+
+    def test_invalid_options(self):
+        '''Unknown formats and qualities are rejected.'''
+
+        with self.assertRaises(ValueError):
+            image_generation.RenderOptions('bmp')
+
+        with self.assertRaises(ValueError):
+            image_generation.RenderOptions('jpeg', quality=0)
+
+    def test_max_bytes(self):
+        '''Lossy clues are reduced until they fit in the byte budget.'''
+
+        for image_format in ['JPEG', 'WEBP']:
+            full = image_generation.encode_image(
+                self.image, image_generation.RenderOptions(image_format, 95)
+            )
+            max_bytes = len(full) // 2
+            options = image_generation.RenderOptions(image_format, 95, max_bytes)
+            data = image_generation.encode_image(self.image, options)
+
+            self.assertLessEqual(len(data), max_bytes, image_format)
+
+    def test_max_bytes_unreachable(self):
+        '''Returns the smallest encoding if the budget can't be met.'''
+
+        options = image_generation.RenderOptions('JPEG', 95, 10)
+        data = image_generation.encode_image(self.image, options)
+
+        smallest = image_generation.encode_image(
+            self.image,
+            image_generation.RenderOptions('JPEG', image_generation.MIN_QUALITY),
+        )
+        self.assertEqual(data, smallest)
+
+
+class LoadImageTest(unittest.TestCase):
+    def setUp(self):
+        self.tmpdir = tempfile.TemporaryDirectory()
+
+    def tearDown(self):
+        self.tmpdir.cleanup()
+
+    def save(self, name, size):
+        path = os.path.join(self.tmpdir.name, name)
+        Image.new('RGB', size, 'white').save(path)
+        return path
+
+    def test_same_size_as_scale_image(self):
+        '''Scales to the same size as scale_image.'''
+
+        for name in ['big.jpg', 'big.png', 'small.png']:
+            size = (3001, 2000) if name.startswith('big') else (300, 201)
+            path = self.save(name, size)
+            with Image.open(path) as image:
+                expected = image_generation.scale_image(image).size
+
+            self.assertEqual(image_generation.load_image(path).size, expected, name)
+
+    def test_jpeg_draft(self):
+        '''Large JPEG images are decoded at a reduced scale.'''
+
+        path = self.save('big.jpg', (4800, 3600))
+        options = image_generation.RenderOptions(width=600, resample='lanczos')
+
+        with patch.object(
+            image_generation.Image.Image, 'resize', autospec=True
+        ) as mock_resize:
+            image_generation.load_image(path, options)
+
+        decoded, size, resample = mock_resize.call_args.args
+        self.assertEqual(decoded.size, (600, 450))
+        self.assertEqual(size, (600, 450))
+        self.assertEqual(resample, image_generation.Image.Resampling.LANCZOS)
+
+    def test_reduce(self):
+        '''Other formats are reduced before resizing.'''
+
+        path = self.save('big.png', (2400, 1800))
+
+        with patch.object(
+            image_generation.Image.Image, 'resize', autospec=True
+        ) as mock_resize:
+            image_generation.load_image(path)
+
+        decoded = mock_resize.call_args.args[0]
+        self.assertEqual(decoded.size, (600, 450))
+
+    def test_palette(self):
+        '''Palette and bilevel images are converted before scaling.'''
+
+        for name, mode in [('big.png', 'P'), ('big.gif', 'P'), ('bw.png', '1')]:
+            path = os.path.join(self.tmpdir.name, name)
+            Image.effect_noise((2400, 1800), 64).convert(mode).save(path)
+
+            image = image_generation.load_image(path)
+            self.assertEqual(image.size, (600, 450), name)
+            self.assertIn(image.mode, image_generation.SCALABLE_MODES, name)
+
+        path = os.path.join(self.tmpdir.name, 'transparent.png')
+        Image.new('P', (1200, 900)).save(path, transparency=0)
+        self.assertEqual(image_generation.load_image(path).mode, 'RGBA')
+
+        path = os.path.join(self.tmpdir.name, 'small.gif')
+        Image.new('P', (300, 200)).save(path)
+        self.assertEqual(image_generation.load_image(path).size, (600, 400))
+
+
+class RenderFramesTest(unittest.TestCase):
+    def setUp(self):
+        # Not a multiple of the grid, so some pixels are never covered
+        self.base_image = Image.effect_noise((43, 31), 64).convert('RGB')
+        self.chunks = image_generation.compute_chunks(31, 43, 3, 4)
+        self.chunks.pop(4)
+
+    def assertSameFrames(self, base_image, frames, indexes):
+        for idx, frame in zip(indexes, frames):
+            expected = image_generation.draw_frame(base_image, self.chunks, idx)
+            self.assertEqual(frame.mode, expected.mode)
+            self.assertEqual(list(frame.getdata()), list(expected.getdata()), idx)
+
+    def test_draw(self):
+        '''By default each frame is drawn with ImageDraw.'''
+
+        frames = image_generation.render_frames(self.base_image, self.chunks)
+
+        self.assertEqual(len(frames), len(self.chunks))
+        self.assertSameFrames(self.base_image, frames, range(len(self.chunks)))
+
+    def test_single_frame(self):
+        '''Any frame can be rendered on its own.'''
+
+        frames = image_generation.render_frames(self.base_image, self.chunks, [7, 2])
+
+        self.assertEqual(len(frames), 2)
+        self.assertSameFrames(self.base_image, frames, [7, 2])
+        self.assertEqual(self.base_image.getpixel((0, 0)), frames[0].getpixel((0, 0)))
@@ -3,10 +3,11 @@
 import json
 import unittest
 
-from unittest.mock import patch, mock_open, call
+from unittest.mock import patch, mock_open, MagicMock
 
 from . import image_quiz
 from .image_quiz import ImageData, load_definition_from_file, ImageGame
+from .mastodon_wrapper import Response
 
 
 class ImageDataTest(unittest.TestCase):
@@ -38,6 +39,24 @@ class ImageDataTest(unittest.TestCase):
             definition.valid_responses, expected_definition.valid_responses
         )
 
+    def test_check(self):
+        '''Finds the valid responses in the content of a post.'''
+
+        definition = ImageData('Pokémon', 'path', ['Pokémon Snap', 'snap'])
+
+        self.assertTrue(definition.check('<p>@bot POKEMON snap</p>'))
+        self.assertTrue(definition.check('<p>@bot oh, snap!</p>'))
+        self.assertFalse(definition.check('<p>@snap pokemon</p>'))
+
+    def test_check_fuzzy(self):
+        '''Typos are only accepted with a maximum edit distance.'''
+
+        definition = ImageData('Bayonetta', 'path', ['Bayonetta'])
+
+        self.assertFalse(definition.check('bayoneta'))
+        self.assertTrue(definition.check('bayoneta', max_edit_distance=1))
+        self.assertFalse(definition.check('bajoneta', max_edit_distance=1))
+
 
 class LoadDefinitionFromFileTest(unittest.TestCase):
     '''Tests for test_load_definition_from_file.'''
@@ -67,14 +86,22 @@ class LoadDefinitionFromFileTest(unittest.TestCase):
 class ImageGameTest(unittest.TestCase):
     '''Tests for ImageGame class.'''
 
-    @patch.object(image_quiz, 'generate_images')
+    @patch.object(image_quiz, 'generate_clues')
     def test_constructor(self, mock):
         '''With mocked image generation, it constructs the object.'''
 
         mock.return_value = ['a', 'b', 'c']
         ImageGame(ImageData('title', 'path', ['r1', 'r2']))
 
-        mock.assert_called_with('path')
+        mock.assert_called_with('path', image_quiz.OUTPUT_PATH, None, None, None)
+
+    @patch.object(image_quiz, 'generate_clues')
+    def test_constructor_in_memory(self, mock):
+        '''Without output path the clues are generated in memory.'''
+
+        ImageGame(ImageData('title', 'path', ['r1', 'r2']), output_path=None)
+
+        mock.assert_called_with('path', None, None, None, None)
 
     def test_is_valid(self):
         '''Checks responses correctly.'''
@@ -118,21 +145,97 @@ class ImageGameTest(unittest.TestCase):
 
         self.assertEqual(game.get_image(), 'path')
 
-    @patch('os.remove')
-    def test_clean(self, mock_remove):
+    def test_next_clue_lazy(self):
+        '''Clues are only requested when they are needed.'''
+
+        game = create_game()
+        game.next_clue()
+
+        game.clues.__getitem__.assert_called_once_with(0)
+
+    def test_prerender(self):
+        '''Prerender requests the upcoming clue.'''
+
+        game = create_game()
+        game.next_clue()
+        game.prerender()
+
+        game.clues.__getitem__.assert_called_with(1)
+
+    def test_clean(self):
         '''Cleans the generated images.'''
 
         game = create_game()
         game.clean()
 
-        mock_remove.assert_has_calls([call('a'), call('b'), call('c')])
+        game.clues.clean.assert_called_once_with()
+
+    def test_to_dict(self):
+        '''A saved game is restored at the same clue.'''
+
+        game = create_game()
+        game.clues.to_dict.return_value = {'key': 'k'}
+        game.next_clue()
+
+        content = json.loads(json.dumps(game.to_dict()))
+        with patch.object(image_quiz, 'restore_clues') as mock_restore:
+            restored = ImageGame.from_dict(content, None, max_edit_distance=1)
+
+        mock_restore.assert_called_once_with('path', {'key': 'k'}, None, None, None)
+        self.assertIs(restored.clues, mock_restore.return_value)
+        self.assertEqual(restored.clue_idx, 1)
+        self.assertEqual(restored.max_edit_distance, 1)
+        self.assertEqual(restored.definition.valid_responses, {'r1', 'r2'})
+
+    def test_evaluate(self):
+        '''The first correct response to a game post wins.'''
+
+        game = create_game()
+        responses = [
+            Response(14, 1, 'r2', 'late'),
+            Response(11, 2, 'r1', 'other game'),
+            Response(12, 1, 'wrong', 'wrong'),
+            Response(13, 3, 'r1', 'first'),
+        ]
+
+        evaluation = game.evaluate(responses, {1, 3})
+
+        self.assertEqual(evaluation.winner.creator, 'first')
+        self.assertEqual(evaluation.received, 4)
+        self.assertEqual(evaluation.ignored, 1)
+        self.assertEqual(evaluation.checked, 2)
+
+    def test_evaluate_stops_at_winner(self):
+        '''Responses after the winner are not checked.'''
+
+        game = create_game()
+        responses = [Response(i, 1, 'r1', f'user{i}') for i in range(5)]
+
+        with patch.object(game, 'is_valid', return_value=True) as mock_valid:
+            evaluation = game.evaluate(responses, {1})
+
+        self.assertEqual(evaluation.winner.creator, 'user0')
+        mock_valid.assert_called_once_with('r1')
+
+    def test_evaluate_no_winner(self):
+        '''Without correct responses there is no winner.'''
+
+        game = create_game()
+        evaluation = game.evaluate([Response(1, 1, 'wrong', 'user')], {1})
+
+        self.assertIsNone(evaluation.winner)
+        self.assertEqual(evaluation.checked, 1)
 
 
 def create_game():
     '''Creates an ImageGame instances.'''
 
-    with patch.object(image_quiz, 'generate_images') as mock:
-        mock.return_value = ['a', 'b', 'c']
+    clues = MagicMock()
+    clues.__len__.return_value = 3
+    clues.__getitem__.side_effect = ['a', 'b', 'c'].__getitem__
+
+    with patch.object(image_quiz, 'generate_clues') as mock:
+        mock.return_value = clues
         return ImageGame(ImageData('title', 'path', ['r1', 'r2']))
 
 
@@ -1,11 +1,18 @@
 '''Tests for manager module.'''
 
+import json
+import os
+import tempfile
 import unittest
 
+from datetime import datetime, timedelta
 from unittest.mock import patch, Mock
 
 from . import manager
 from . import state
+from .manifest import ManifestIndex
+from .mastodon_wrapper import Response
+from .test_manifest import write_manifest
 
 
 class BotManagerTest(unittest.TestCase):
@@ -35,18 +42,103 @@ class BotManagerTest(unittest.TestCase):
     def test_onStateStart(self):
         '''State start handler works.'''
 
-        mock_state = Mock()
-        manager.State = mock_state
         m = manager.BotManager(Mock(), 'test_owner', '/tmp')
         expected_state = manager.BotStates.NEW_ROUND
 
-        m._onStateStart()
+        with patch.object(manager, 'State') as mock_state:
+            mock_state.return_value.getRound.return_value = None
+            m._onStateStart()
         self.assertEqual(expected_state, m.currentState)
         self.assertTrue(mock_state.called)
 
+    def test_onStateStart_resume(self):
+        '''A round in progress is resumed after a restart.'''
+
+        with tempfile.TemporaryDirectory() as path:
+            stateFilename = os.path.join(path, 'state.json')
+
+            m = manager.BotManager(Mock(), 'owner', path, stateFilename=stateFilename)
+            m._onStateStart()
+            m.currentRound = Mock()
+            m.currentRound.to_dict.return_value = {'clue_idx': 3}
+            m.postIds = {10, 11}
+            m.lastClueTime = datetime(2024, 1, 2, 3, 4, 5)
+            m._saveRound(manager.BotStates.WAIT)
+
+            restarted = manager.BotManager(
+                Mock(), 'owner', path, stateFilename=stateFilename
+            )
+            with patch.object(manager, 'ImageGame') as mock_game:
+                restarted._onStateStart()
+
+        mock_game.from_dict.assert_called_once_with(
+            {'clue_idx': 3},
+            m.outputPath,
+            m.renderOptions,
+            m.clueCache,
+            m.maxEditDistance,
+        )
+        self.assertIs(restarted.currentRound, mock_game.from_dict.return_value)
+        self.assertEqual(restarted.postIds, {10, 11})
+        self.assertEqual(restarted.lastClueTime, m.lastClueTime)
+        self.assertEqual(restarted.currentState, manager.BotStates.WAIT)
+
+    def test_onStateStart_resume_failed(self):
+        '''A round that can't be restored is replaced by a new one.'''
+
+        with tempfile.TemporaryDirectory() as path:
+            stateFilename = os.path.join(path, 'state.json')
+            m = manager.BotManager(Mock(), 'owner', path, stateFilename=stateFilename)
+            m._onStateStart()
+            m.gameState.setRound({'game': {}})
+
+            with patch.object(manager, 'ImageGame') as mock_game:
+                mock_game.from_dict.side_effect = ValueError('image changed')
+                m._onStateStart()
+
+        self.assertEqual(m.currentState, manager.BotStates.NEW_ROUND)
+        self.assertIsNone(m.gameState.getRound())
+
+    def test_onStateStart_shared_dataset(self):
+        '''A shared dataset index is left to its owner.'''
+
+        index = Mock()
+        with patch.object(manager, 'State') as mock_state:
+            mock_state.return_value.getRound.return_value = None
+            m = manager.BotManager(
+                Mock(),
+                'test_owner',
+                '/tmp',
+                stateFilename='state_a.json',
+                datasetIndex=index,
+            )
+            m._onStateStart()
+
+        mock_state.assert_called_once_with(m.history_size, 'state_a.json')
+        index.loadFromDisk.assert_not_called()
+        index.refresh.assert_not_called()
+        self.assertIsNone(m.datasetWatcher)
+        self.assertEqual(m.currentState, manager.BotStates.NEW_ROUND)
+
     def test_onStateNewRound_JSON(self):
         '''Loads all JSON files.'''
-        self.assertTrue(False)
+
+        with tempfile.TemporaryDirectory() as path:
+            for name in ['a', 'b']:
+                with open(os.path.join(path, f'{name}.json'), 'w') as fout:
+                    json.dump(
+                        {
+                            'title': name,
+                            'filepaths': [f'{name}.jpg'],
+                            'valid_responses': [name],
+                        },
+                        fout,
+                    )
+
+            m = manager.BotManager(Mock(), 'test_owner', path)
+            questions = m._load_dataset(path)
+
+        self.assertEqual(sorted(q.title for q in questions), ['a', 'b'])
 
     def test_onStateNewRound_NoQuestions(self):
         '''Can't load any questions.'''
@@ -60,7 +152,15 @@ class BotManagerTest(unittest.TestCase):
     def test_onStateNewRound(self):
         '''State new round works fine.'''
 
-        m = manager.BotManager(Mock(), 'test_owner', '/tmp')
+        stateDir = tempfile.TemporaryDirectory()
+        self.addCleanup(stateDir.cleanup)
+        m = manager.BotManager(
+            Mock(),
+            'test_owner',
+            stateDir.name,
+            stateFilename=os.path.join(stateDir.name, 'state.json'),
+        )
+        m._onStateStart()
 
         # Mock question loading
         q1 = Mock()
@@ -69,18 +169,27 @@ class BotManagerTest(unittest.TestCase):
         m._load_dataset = lambda s: questions
 
         # Mock image generation
-        mock_image = Mock()
-        manager.ImageGame = mock_image
-
-        m._onStateNewRound()
+        with patch.object(manager, 'ImageGame') as mock_image:
+            mock_image.return_value.to_dict.return_value = {}
+            m._onStateNewRound()
 
         # Check mock calls
-        mock_image.assert_called_with(q1)
+        mock_image.assert_called_with(
+            q1, m.outputPath, m.renderOptions, m.clueCache, m.maxEditDistance
+        )
 
     def test_onStateNewRound_NoRepeat(self):
         '''Does not repeat a question if it is in the history.'''
 
-        m = manager.BotManager(Mock(), 'test_owner', '/tmp', 1)
+        stateDir = tempfile.TemporaryDirectory()
+        self.addCleanup(stateDir.cleanup)
+        m = manager.BotManager(
+            Mock(),
+            'test_owner',
+            stateDir.name,
+            1,
+            stateFilename=os.path.join(stateDir.name, 'state.json'),
+        )
         m._onStateStart()
 
         # Mock question loading
@@ -95,10 +204,125 @@ class BotManagerTest(unittest.TestCase):
         m.gameState.history = [q1.filepath]
 
         # Mock image generation
-        mock_image = Mock()
-        manager.ImageGame = mock_image
-
-        m._onStateNewRound()
+        with patch.object(manager, 'ImageGame') as mock_image:
+            mock_image.return_value.to_dict.return_value = {}
+            m._onStateNewRound()
 
         # Check mock calls
-        mock_image.assert_called_with(q2)
+        mock_image.assert_called_with(
+            q2, m.outputPath, m.renderOptions, m.clueCache, m.maxEditDistance
+        )
+
+    def test_onStateNewRound_prefetch(self):
+        '''The next round is prepared in the background and used next.'''
+
+        m = manager.BotManager(Mock(), 'test_owner', '/tmp', prefetch=True)
+        m.gameState = Mock()
+        m.gameState.getQuestions.return_value = []
+
+        q1 = Mock()
+        q2 = Mock()
+        questions = iter([q1, q2])
+        m._selectQuestion = lambda: next(questions)
+
+        with patch.object(
+            manager, 'ImageGame', side_effect=lambda q, *args: q
+        ) as mock_image:
+            m._onStateNewRound()
+            self.assertIs(m.currentRound, q1)
+            self.assertIsNotNone(m.nextRound)
+
+            # Waits for the background round instead of creating a new one
+            m._selectQuestion = Mock(side_effect=AssertionError)
+            m.nextRound.result()
+            m._prefetchNextRound = Mock()
+            m._onStateNewRound()
+            self.assertIs(m.currentRound, q2)
+            self.assertIsNone(m.nextRound)
+            self.assertEqual(mock_image.call_count, 2)
+
+    def test_selectQuestion_changed_manifest(self):
+        '''A manifest rewritten since the last refresh is indexed again.'''
+
+        with tempfile.TemporaryDirectory() as path:
+            dataset = os.path.join(path, 'dataset')
+            write_manifest(dataset, [('A', 'a.jpg')])
+            index = ManifestIndex(dataset)
+            index.refresh()
+
+            m = manager.BotManager(
+                Mock(),
+                'owner',
+                dataset,
+                stateFilename=os.path.join(path, 'state.json'),
+                datasetIndex=index,
+            )
+            m._onStateStart()
+
+            # The watcher has not seen the change yet
+            m.datasetWatcher = Mock()
+            m.datasetWatcher.is_running.return_value = True
+            write_manifest(dataset, [('New', 'new.jpg'), ('A', 'a.jpg')])
+
+            with patch.object(index, 'refresh', wraps=index.refresh) as mock_refresh:
+                question = m._selectQuestion()
+                mock_refresh.assert_called_once()
+
+            self.assertIn(question.title, ['New', 'A'])
+            self.assertEqual(list(m.gameState.getQuestions()), [question.filepath])
+
+
+class CheckResponsesTest(unittest.TestCase):
+    '''Tests for the CHECK_RESPONSES state.'''
+
+    def setUp(self):
+        self.m = manager.BotManager(Mock(), 'owner', '/tmp')
+        self.m.currentRound = Mock()
+        self.m.postIds = {1}
+        self.m.lastClueTime = datetime.now()
+
+    def test_solution_found(self):
+        '''A winner ends the round.'''
+
+        responses = [Response(2, 1, 'answer', 'user')]
+        self.m.mastodon_client.get_responses.return_value = responses
+        self.m.currentRound.evaluate.return_value.winner = responses[0]
+
+        self.m._onStateCheckResponses()
+
+        self.m.currentRound.evaluate.assert_called_once_with(responses, {1})
+        self.assertEqual(self.m.currentState, manager.BotStates.SOLUTION_FOUND)
+
+    def test_owner_command_first(self):
+        '''Owner commands are handled before evaluating the responses.'''
+
+        responses = [Response(2, 1, '\\next', 'owner')]
+        self.m.mastodon_client.get_responses.return_value = responses
+
+        self.m._onStateCheckResponses()
+
+        self.m.currentRound.evaluate.assert_not_called()
+        self.assertEqual(self.m.currentState, manager.BotStates.NEW_CLUE)
+
+    def test_no_winner(self):
+        '''Without winner the bot keeps waiting.'''
+
+        self.m.mastodon_client.get_responses.return_value = []
+        self.m.currentRound.evaluate.return_value.winner = None
+
+        self.m._onStateCheckResponses()
+
+        self.assertEqual(self.m.currentState, manager.BotStates.WAIT)
+
+    def test_wait_until_clue_due(self):
+        '''Waits no longer than the time left for the next clue.'''
+
+        m = manager.BotManager(Mock(), 'owner', '/tmp', clueDelaySeconds=60)
+        m.lastClueTime = datetime.now() - timedelta(seconds=50)
+        m.currentState = manager.BotStates.WAIT
+
+        m._runStep()
+
+        timeout = m.mastodon_client.wait_for_responses.call_args.args[0]
+        self.assertLessEqual(timeout, 10)
+        self.assertEqual(m.currentState, manager.BotStates.CHECK_RESPONSES)
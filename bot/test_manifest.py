@@ -0,0 +1,199 @@
+'''Tests for manifest module.'''
+
+import json
+import os
+import tempfile
+import unittest
+
+from unittest.mock import patch
+
+from PIL import Image
+
+from . import manifest
+from .dataset import DatasetIndex, validate_dataset
+from .image_quiz import question_to_dict
+from .manifest import (
+    MANIFEST_FILENAME,
+    ManifestIndex,
+    convert_dataset,
+    is_manifest,
+    open_dataset,
+)
+from .test_dataset import write_definition
+
+
+def write_manifest(path, questions, filename=MANIFEST_FILENAME):
+    '''Writes a manifest with (title, filepath) questions into path.'''
+
+    os.makedirs(path, exist_ok=True)
+    filepath = os.path.join(path, filename)
+    with open(filepath, 'w') as fout:
+        for title, image in questions:
+            content = {'title': title, 'filepath': image, 'valid_responses': [title]}
+            fout.write(json.dumps(content) + '\n')
+    return filepath
+
+
+class ManifestIndexTest(unittest.TestCase):
+    '''Tests for ManifestIndex class.'''
+
+    def setUp(self):
+        self.tmpdir = tempfile.TemporaryDirectory()
+        self.path = self.tmpdir.name
+
+    def tearDown(self):
+        self.tmpdir.cleanup()
+
+    def test_open_dataset(self):
+        '''The layout is detected from the dataset path.'''
+
+        self.assertIsInstance(open_dataset(self.path), DatasetIndex)
+
+        filepath = write_manifest(self.path, [('A', 'a.jpg')])
+        self.assertTrue(is_manifest(filepath))
+        self.assertIsInstance(open_dataset(self.path), ManifestIndex)
+
+    def test_lazy_load(self):
+        '''Only positions are indexed and questions are read when loaded.'''
+
+        write_manifest(self.path, [('A', 'a.jpg'), ('Bé', 'b.jpg')])
+        index = ManifestIndex(self.path)
+        self.assertTrue(index.refresh())
+
+        questions = index.getQuestions()
+        self.assertEqual(
+            [q.filepath for q in questions],
+            [os.path.join(self.path, 'a.jpg'), os.path.join(self.path, 'b.jpg')],
+        )
+
+        question = index.load(questions[1])
+        self.assertEqual(question.title, 'Bé')
+        self.assertEqual(question.filepath, questions[1].filepath)
+        self.assertEqual(question.valid_responses, {'be'})
+
+    def test_shards(self):
+        '''The manifests of the subdirectories are part of the dataset.'''
+
+        write_manifest(self.path, [('A', 'a.jpg')])
+        write_manifest(os.path.join(self.path, 'more'), [('B', 'b.jpg')])
+        index = ManifestIndex(self.path)
+        index.refresh()
+
+        questions = index.getQuestions()
+        self.assertEqual(len(questions), 2)
+        self.assertEqual(
+            index.load(questions[1]).filepath,
+            os.path.join(self.path, 'more', 'b.jpg'),
+        )
+
+    def test_errors(self):
+        '''Broken lines are reported and the rest of the shard is indexed.'''
+
+        filepath = write_manifest(self.path, [('A', 'a.jpg')])
+        with open(filepath, 'a') as fout:
+            fout.write('{"title": "B"}\n\n')
+            fout.write('{"title": "C", "filepath": "c.jpg", "valid_')
+        index = ManifestIndex(self.path)
+        index.refresh()
+
+        self.assertEqual(len(index.getQuestions()), 1)
+        self.assertEqual(sorted(index.errors), [f'{filepath}:2', f'{filepath}:4'])
+
+    def test_save_and_load(self):
+        '''A saved index is loaded without reading the shards again.'''
+
+        write_manifest(self.path, [('A', 'a.jpg')])
+        filename = os.path.join(self.tmpdir.name, 'index.db')
+        ManifestIndex(self.path, filename).refresh()
+
+        index = ManifestIndex(self.path, filename)
+        self.assertTrue(index.loadFromDisk())
+
+        with patch.object(manifest, 'parse_line') as mock_parse:
+            self.assertFalse(index.refresh())
+            mock_parse.assert_not_called()
+        self.assertEqual(len(index.getQuestions()), 1)
+
+        # Indexes of the other layout are not mixed up
+        self.assertFalse(DatasetIndex(self.path, filename).loadFromDisk())
+
+    def test_changed_shard(self):
+        '''Only the modified shards are read again.'''
+
+        write_manifest(self.path, [('A', 'a.jpg')])
+        write_manifest(os.path.join(self.path, 'more'), [('B', 'b.jpg')])
+        index = ManifestIndex(self.path)
+        index.refresh()
+
+        write_manifest(
+            os.path.join(self.path, 'more'), [('B', 'b.jpg'), ('C', 'c.jpg')]
+        )
+        with patch.object(index, '_read_shard', wraps=index._read_shard) as mock:
+            self.assertTrue(index.refresh())
+            self.assertEqual(mock.call_count, 1)
+        self.assertEqual(index.load(index.getQuestions()[2]).title, 'C')
+
+    def test_validate(self):
+        '''Manifest datasets are validated like the per-file ones.'''
+
+        Image.new('RGB', (40, 30)).save(os.path.join(self.path, 'a.png'))
+        write_manifest(self.path, [('A', 'a.png'), ('B', 'missing.png')])
+        index = ManifestIndex(self.path)
+        index.refresh()
+
+        errors = validate_dataset(index, processes=1)
+        self.assertEqual(len(errors), 1)
+        self.assertIn('missing.png', errors[0])
+
+
+class ConvertDatasetTest(unittest.TestCase):
+    '''Tests for convert_dataset.'''
+
+    def setUp(self):
+        self.tmpdir = tempfile.TemporaryDirectory()
+        self.path = self.tmpdir.name
+
+    def tearDown(self):
+        self.tmpdir.cleanup()
+
+    def test_convert(self):
+        '''The manifest has the same questions as the definitions.'''
+
+        write_definition(self.path, 'a.json', 'A', ['a.jpg', 'a2.jpg'])
+        write_definition(self.path, 'b.json', 'B', ['b.jpg'], ['b', 'bee'])
+        write_definition(self.path, 'broken.json', 'C', [])
+
+        expected = DatasetIndex(self.path)
+        expected.refresh()
+
+        count, errors = convert_dataset(self.path)
+        self.assertEqual(count, 3)
+        self.assertEqual(list(errors), [os.path.join(self.path, 'broken.json')])
+
+        index = open_dataset(self.path)
+        index.refresh()
+        questions = [question_to_dict(index.load(q)) for q in index.getQuestions()]
+        self.assertEqual(
+            questions, [question_to_dict(q) for q in expected.getQuestions()]
+        )
+
+    def test_convert_elsewhere(self):
+        '''Image paths are relative to the manifest written.'''
+
+        write_definition(self.path, 'a.json', 'A', ['a.jpg'])
+        output = os.path.join(self.path, 'out', 'catalog.jsonl')
+        os.makedirs(os.path.dirname(output))
+
+        convert_dataset(self.path, output)
+
+        index = ManifestIndex(output)
+        index.refresh()
+        question = index.getQuestions()[0]
+        self.assertEqual(
+            os.path.normpath(question.filepath),
+            os.path.join(self.path, 'a.jpg'),
+        )
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,367 @@
+'''Tests for mastodon_wrapper module.'''
+
+import concurrent.futures
+import http.server
+import json
+import tempfile
+import threading
+import unittest
+
+from datetime import datetime, timedelta
+from unittest.mock import patch
+
+from . import mastodon_wrapper, util
+from .image_generation import EncodedImage
+from .mastodon_wrapper import MastodonWrapper, MediaCache, pooled_session
+
+
+def create_wrapper(cursor_filename=None):
+    '''Creates a MastodonWrapper with a mocked Mastodon client.'''
+
+    with patch('mastodon.Mastodon') as mock_mastodon:
+        wrapper = MastodonWrapper(
+            'https://example.com', 'token', 'public', cursor_filename=cursor_filename
+        )
+
+    client = mock_mastodon.return_value
+    client.media_post.return_value = {'id': 10}
+    client.status_post.return_value = {'id': 20}
+    return wrapper, client
+
+
+def mention(notification_id, post_id=None):
+    '''Returns a mention notification.'''
+
+    return {
+        'id': notification_id,
+        'type': 'mention',
+        'status': {
+            'id': post_id or notification_id,
+            'in_reply_to_id': 1,
+            'content': 'answer',
+            'account': {'acct': 'user', 'note': ''},
+        },
+    }
+
+
+class MastodonWrapperTest(unittest.TestCase):
+    def test_post_with_media_file(self):
+        '''Uploads a file path and publishes the post.'''
+
+        wrapper, client = create_wrapper()
+
+        with tempfile.NamedTemporaryFile(suffix='.png') as image:
+            self.assertEqual(wrapper.post_with_media('msg', image.name), 20)
+            client.media_post.assert_called_once_with(media_file=image.name)
+        client.status_post.assert_called_once_with(
+            'msg', media_ids=[10], visibility='public'
+        )
+
+    def test_post_with_media_in_memory(self):
+        '''Uploads an in-memory image without touching the disk.'''
+
+        wrapper, client = create_wrapper()
+        media = EncodedImage(b'data', 'image/png', 'clue.png')
+
+        self.assertEqual(wrapper.post_with_media('msg', media), 20)
+
+        kwargs = client.media_post.call_args.kwargs
+        self.assertEqual(kwargs['media_file'].read(), b'data')
+        self.assertEqual(kwargs['mime_type'], 'image/png')
+        self.assertEqual(kwargs['file_name'], 'clue.png')
+
+    @patch.object(util.time, 'sleep')
+    def test_post_with_media_retry_reuses_upload(self, mock_sleep):
+        '''A failed post is retried without uploading the media again.'''
+
+        wrapper, client = create_wrapper()
+        client.status_post.side_effect = [Exception('unavailable'), {'id': 20}]
+        media = EncodedImage(b'data', 'image/png', 'clue.png')
+
+        self.assertEqual(wrapper.post_with_media('msg', media), 20)
+        self.assertEqual(client.media_post.call_count, 1)
+        self.assertEqual(client.status_post.call_count, 2)
+
+    def test_post_with_media_attached_not_reused(self):
+        '''Media attached to a post is uploaded again for the next one.'''
+
+        wrapper, client = create_wrapper()
+        media = EncodedImage(b'data', 'image/png', 'clue.png')
+
+        wrapper.post_with_media('msg', media)
+        wrapper.post_with_media('msg', media)
+
+        self.assertEqual(client.media_post.call_count, 2)
+
+
+class StreamingTest(unittest.TestCase):
+    '''Tests for the streaming mode of MastodonWrapper.'''
+
+    def setUp(self):
+        self.wrapper, self.client = create_wrapper()
+        self.client.notifications.return_value = []
+        self.wrapper.start_streaming()
+
+        listener = self.client.stream_user.call_args.args[0]
+        self.notify = listener.on_notification
+        self.handle = self.client.stream_user.return_value
+        self.handle.is_receiving.return_value = True
+
+    def mention(self, post_id):
+        return mention(post_id)
+
+    def test_streamed_responses(self):
+        '''Streamed mentions are returned once, even if a poll finds them.'''
+
+        self.notify(self.mention(10))
+        self.notify({'type': 'favourite'})
+        self.notify(self.mention(11))
+        self.client.notifications.return_value = [self.mention(11), self.mention(10)]
+
+        responses = self.wrapper.get_responses()
+
+        self.assertEqual([r.post_id for r in responses], [10, 11])
+        self.assertEqual(self.wrapper.get_responses(), [])
+        self.assertEqual(self.wrapper.last_notification_id, 11)
+        self.assertEqual(self.wrapper.streamed_ids, set())
+
+    def test_stream_drop_between_polls(self):
+        '''Mentions sent while the stream reconnects are found by the poll.'''
+
+        self.wrapper.last_notification_id = 9
+
+        # 10 is sent while the stream reconnects, unnoticed between polls
+        self.notify(self.mention(11))
+        self.client.notifications.return_value = [self.mention(11), self.mention(10)]
+
+        responses = self.wrapper.get_responses()
+
+        self.assertEqual([r.post_id for r in responses], [11, 10])
+        self.assertEqual(self.client.notifications.call_args.kwargs['min_id'], 9)
+        self.assertEqual(self.wrapper.last_notification_id, 11)
+
+    def test_wait_wakes_up(self):
+        '''Waiting returns as soon as a mention arrives.'''
+
+        timer = threading.Timer(0.1, self.notify, [self.mention(10)])
+        timer.start()
+
+        start = datetime.now()
+        self.wrapper.wait_for_responses(30)
+        timer.join()
+
+        self.assertLess((datetime.now() - start).total_seconds(), 10)
+
+    def test_fallback_to_polling(self):
+        '''Polls while the stream is down.'''
+
+        self.notify(self.mention(10))
+        self.handle.is_receiving.return_value = False
+        self.client.notifications.return_value = [self.mention(12)]
+
+        responses = self.wrapper.get_responses()
+
+        self.assertEqual([r.post_id for r in responses], [10, 12])
+
+    def test_stream_unavailable(self):
+        '''If the stream can't be opened the wrapper keeps polling.'''
+
+        wrapper, client = create_wrapper()
+        client.stream_user.side_effect = Exception('no streaming')
+
+        self.assertFalse(wrapper.start_streaming())
+        self.assertFalse(wrapper.is_streaming())
+
+
+class NotificationsCursorTest(unittest.TestCase):
+    '''Tests for the cursor-based notification polling.'''
+
+    def setUp(self):
+        self.tmpdir = tempfile.TemporaryDirectory()
+        self.filename = f'{self.tmpdir.name}/cursor.json'
+
+    def tearDown(self):
+        self.tmpdir.cleanup()
+
+    def test_first_poll(self):
+        '''Without a cursor only the latest page is read.'''
+
+        wrapper, client = create_wrapper(self.filename)
+        client.notifications.return_value = [mention(3), mention(2)]
+
+        responses = wrapper.get_responses()
+
+        self.assertEqual([r.post_id for r in responses], [2, 3])
+        client.notifications.assert_called_once()
+        client.notifications_clear.assert_not_called()
+        self.assertEqual(wrapper.last_notification_id, 3)
+
+    def test_pages(self):
+        '''All the pages after the cursor are read, oldest first.'''
+
+        wrapper, client = create_wrapper(self.filename)
+        wrapper.last_notification_id = 100
+        page_size = mastodon_wrapper.NOTIFICATIONS_PAGE_SIZE
+        first = [mention(i) for i in range(100 + page_size, 100, -1)]
+        second = [mention(100 + page_size + 1)]
+        client.notifications.side_effect = [first, second]
+
+        responses = wrapper.get_responses()
+
+        self.assertEqual(
+            [r.post_id for r in responses], list(range(101, 102 + page_size))
+        )
+        min_ids = [c.kwargs['min_id'] for c in client.notifications.call_args_list]
+        self.assertEqual(min_ids, [100, 100 + page_size])
+
+    def test_cursor_persisted(self):
+        '''A restarted wrapper continues from the last notification read.'''
+
+        wrapper, client = create_wrapper(self.filename)
+        client.notifications.return_value = [mention('12')]
+        wrapper.get_responses()
+
+        wrapper, client = create_wrapper(self.filename)
+        client.notifications.return_value = [mention('12'), mention('13')]
+
+        responses = wrapper.get_responses()
+
+        self.assertEqual([r.post_id for r in responses], ['13'])
+        self.assertEqual(client.notifications.call_args.kwargs['min_id'], '12')
+
+    def test_streamed_mentions_persisted(self):
+        '''Mentions read from the stream are not returned again by a poll.'''
+
+        wrapper, client = create_wrapper(self.filename)
+        wrapper.start_streaming()
+        listener = client.stream_user.call_args.args[0]
+        client.stream_user.return_value.is_receiving.return_value = True
+        client.notifications.return_value = []
+
+        listener.on_notification(mention(5))
+        listener.on_notification(mention(5))
+        self.assertEqual([r.post_id for r in wrapper.get_responses()], [5])
+
+        client.stream_user.return_value.is_receiving.return_value = False
+        client.notifications.return_value = [mention(5)]
+        self.assertEqual(wrapper.get_responses(), [])
+
+        # Not even after a restart
+        wrapper, client = create_wrapper(self.filename)
+        client.notifications.return_value = [mention(5)]
+        self.assertEqual(wrapper.get_responses(), [])
+
+
+class MediaCacheTest(unittest.TestCase):
+    def test_expiry(self):
+        '''Expired media ids are not returned.'''
+
+        cache = MediaCache(expiry_seconds=60)
+        cache.add('a', 1)
+        cache.entries['a'] = (1, datetime.now() - timedelta(seconds=61))
+
+        self.assertIsNone(cache.take('a'))
+
+    def test_take(self):
+        '''A media id can only be taken once.'''
+
+        cache = MediaCache()
+        cache.add('a', 1)
+
+        self.assertEqual(cache.take('a'), 1)
+        self.assertIsNone(cache.take('a'))
+
+
+class StandInMastodonHandler(http.server.BaseHTTPRequestHandler):
+    '''Answers the few Mastodon API calls used by the bot.'''
+
+    protocol_version = 'HTTP/1.1'
+
+    def do_GET(self):
+        if self.path.startswith('/api/v1/instance'):
+            self._reply({'version': '4.1.0'})
+        elif self.path.startswith('/api/v1/notifications'):
+            self._reply([])
+        else:
+            self._reply({'error': 'not found'}, 404)
+
+    def do_POST(self):
+        length = int(self.headers.get('Content-Length', 0))
+        self.rfile.read(length)
+
+        if self.path == '/api/v2/media':
+            self._reply({'id': 10, 'url': None})
+        elif self.path == '/api/v1/statuses':
+            self._reply({'id': 20})
+        else:
+            self._reply({})
+
+    def _reply(self, content, status=200):
+        with self.server.lock:
+            self.server.connections.add(self.client_address)
+            self.server.requests += 1
+
+        body = json.dumps(content).encode('utf-8')
+        self.send_response(status)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        pass
+
+
+class PooledSessionTest(unittest.TestCase):
+    '''Tests the shared session against a local stand-in server.'''
+
+    def setUp(self):
+        self.server = http.server.ThreadingHTTPServer(
+            ('127.0.0.1', 0), StandInMastodonHandler
+        )
+        self.server.lock = threading.Lock()
+        self.server.connections = set()
+        self.server.requests = 0
+        self.thread = threading.Thread(target=self.server.serve_forever)
+        self.thread.start()
+
+        self.session = pooled_session(max_connections=2)
+        host, port = self.server.server_address
+        self.clients = [
+            MastodonWrapper(
+                f'http://{host}:{port}', 'token', 'public', session=self.session
+            )
+            for _ in range(2)
+        ]
+
+    def tearDown(self):
+        self.session.close()
+        self.server.shutdown()
+        self.server.server_close()
+        self.thread.join()
+
+    def test_overlapping_requests(self):
+        '''Games on different threads share the pooled connections.'''
+
+        media = EncodedImage(b'data', 'image/png', 'clue.png')
+        with concurrent.futures.ThreadPoolExecutor(max_workers=8) as executor:
+            posts = [
+                executor.submit(client.post_with_media, 'msg', media)
+                for client in self.clients * 3
+            ]
+            polls = [
+                executor.submit(client.get_responses) for client in self.clients * 3
+            ]
+            post_ids = [f.result() for f in posts]
+            responses = [f.result() for f in polls]
+
+        self.assertEqual(post_ids, [20] * 6)
+        self.assertEqual(responses, [[]] * 6)
+
+        # 2 x instance + 6 x (media, status) + 6 x notifications
+        self.assertEqual(self.server.requests, 20)
+        self.assertLessEqual(len(self.server.connections), 2)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,123 @@
+'''Tests for matcher module.'''
+
+import unittest
+
+from .matcher import (
+    AnswerMatcher,
+    BKTree,
+    FuzzyMatcher,
+    edit_distance,
+    normalize_response,
+    normalize_text,
+)
+
+
+class NormalizeTest(unittest.TestCase):
+    def test_normalize_text(self):
+        '''Case, accents and extra whitespace are removed.'''
+
+        self.assertEqual(normalize_text('  Pokémon\tÉMERALD  '), 'pokemon emerald')
+        self.assertEqual(normalize_text('STRASSE'), normalize_text('Straße'))
+
+    def test_normalize_response(self):
+        '''Markup and mentions are removed from the post content.'''
+
+        content = (
+            '<p><span class="h-card"><a href="https://example.com/@bot" '
+            'class="u-url mention">@<span>bot</span></a></span> '
+            'Chrono&nbsp;Trigger<br>@friend@example.com</p><p>maybe?</p>'
+        )
+
+        self.assertEqual(normalize_response(content), 'chrono trigger maybe?')
+
+    def test_email_is_not_a_mention(self):
+        '''Only words starting with @ are mentions.'''
+
+        self.assertEqual(normalize_response('me@example.com'), 'me@example.com')
+
+
+class AnswerMatcherTest(unittest.TestCase):
+    def test_search(self):
+        '''Finds any of the answers inside the text.'''
+
+        matcher = AnswerMatcher(['chrono trigger', 'chrono cross', 'ct'])
+
+        self.assertEqual(matcher.search('is it chrono cross?'), 'chrono cross')
+        self.assertEqual(matcher.search('chrono trigger'), 'chrono trigger')
+        self.assertEqual(matcher.search('act'), 'ct')
+        self.assertIsNone(matcher.search('chrono'))
+        self.assertIsNone(matcher.search(''))
+
+    def test_overlapping_answers(self):
+        '''Answers are found after a failed partial match of another one.'''
+
+        matcher = AnswerMatcher(['abcd', 'bce', 'aab'])
+
+        self.assertEqual(matcher.search('xabce'), 'bce')
+        self.assertEqual(matcher.search('aaab'), 'aab')
+        self.assertIsNone(matcher.search('abcbca'))
+
+    def test_answer_inside_another(self):
+        '''A short answer contained in a longer one matches.'''
+
+        matcher = AnswerMatcher(['super mario', 'mario kart'])
+
+        self.assertEqual(matcher.search('super mario kart'), 'super mario')
+        self.assertEqual(matcher.search('new mario kart'), 'mario kart')
+
+    def test_empty(self):
+        '''Without answers nothing matches.'''
+
+        self.assertIsNone(AnswerMatcher([]).search('anything'))
+        self.assertIsNone(AnswerMatcher(['']).search('anything'))
+
+
+class FuzzyMatcherTest(unittest.TestCase):
+    def test_edit_distance(self):
+        '''Counts insertions, deletions and substitutions.'''
+
+        self.assertEqual(edit_distance('bayonetta', 'bayoneta'), 1)
+        self.assertEqual(edit_distance('kitten', 'sitting'), 3)
+        self.assertEqual(edit_distance('', 'abc'), 3)
+        self.assertEqual(edit_distance('same', 'same'), 0)
+
+    def test_bk_tree(self):
+        '''Returns the words within the distance, and only those.'''
+
+        words = ['book', 'books', 'cake', 'boo', 'cape', 'cart', 'boon']
+        tree = BKTree(words)
+
+        for query in ['bo', 'cake', 'bork', 'xyz']:
+            for max_distance in range(4):
+                expected = sorted(
+                    (edit_distance(query, w), w)
+                    for w in words
+                    if edit_distance(query, w) <= max_distance
+                )
+                self.assertEqual(
+                    sorted(tree.search(query, max_distance)), expected, query
+                )
+
+    def test_typos(self):
+        '''Answers with a few typos are found among other words.'''
+
+        matcher = FuzzyMatcher(["yoshi's island", 'bayonetta'], 2)
+
+        self.assertEqual(matcher.search('is it yoshi island?'), "yoshi's island")
+        self.assertEqual(matcher.search('bayoneta'), 'bayonetta')
+        self.assertEqual(matcher.search('yoshis island'), "yoshi's island")
+        self.assertEqual(matcher.search('bayo netta'), 'bayonetta')
+        self.assertIsNone(matcher.search('mario island'))
+
+    def test_short_answers(self):
+        '''Short answers tolerate fewer typos.'''
+
+        matcher = FuzzyMatcher(['mp', 'zelda'], 3)
+
+        self.assertIsNone(matcher.search('mr'))
+        self.assertEqual(matcher.search('zelsa'), 'zelda')
+        self.assertIsNone(matcher.search('zesla'))
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,34 @@
+'''Tests for render_options module.'''
+
+import subprocess
+import sys
+import unittest
+
+from .render_options import RESAMPLING_FILTER_NAMES, RenderOptions
+
+
+class RenderOptionsTest(unittest.TestCase):
+    def test_resample(self):
+        '''Only the known filters are accepted.'''
+
+        for name in RESAMPLING_FILTER_NAMES:
+            self.assertEqual(RenderOptions(resample=name).resample, name)
+        with self.assertRaises(ValueError):
+            RenderOptions(resample='sinc')
+
+    def test_without_pil(self):
+        '''The game logic is imported without loading PIL.'''
+
+        code = (
+            'import sys\n'
+            'import bot.clue_cache, bot.manager, bot.runner\n'
+            'print("PIL" in sys.modules)\n'
+        )
+        output = subprocess.run(
+            [sys.executable, '-c', code], capture_output=True, text=True, check=True
+        )
+        self.assertEqual(output.stdout.strip(), 'False')
+
+
+if __name__ == '__main__':
+    unittest.main()
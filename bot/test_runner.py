@@ -0,0 +1,119 @@
+'''Tests for runner module.'''
+
+import asyncio
+import os
+import tempfile
+import threading
+import unittest
+
+from unittest.mock import Mock
+
+from PIL import Image
+
+from .manager import BotStates
+from .runner import GameRunner
+from .test_dataset import write_definition
+
+
+class StandInGame:
+    '''Runs the given steps and then finishes.'''
+
+    def __init__(self, steps):
+        self.steps = list(steps)
+        self.currentState = BotStates.START
+        self._discardNextRound = Mock()
+
+    def _runStep(self):
+        step = self.steps.pop(0)
+        step()
+        if not self.steps:
+            self.currentState = BotStates.FINISH_EXECUTION
+
+
+class GameRunnerTest(unittest.TestCase):
+    def test_games_run_concurrently(self):
+        '''A game blocked in a step doesn't stop the others.'''
+
+        event = threading.Event()
+        waiting = StandInGame([lambda: event.wait(10)])
+        other = StandInGame([lambda: None, event.set])
+
+        runner = GameRunner()
+        runner.add_game('waiting', waiting)
+        runner.add_game('other', other)
+        asyncio.run(runner.run())
+
+        self.assertTrue(event.is_set())
+        waiting._discardNextRound.assert_called_once_with()
+        other._discardNextRound.assert_called_once_with()
+
+    def test_broken_game(self):
+        '''An error only stops the game that raised it.'''
+
+        def fail():
+            raise RuntimeError('broken')
+
+        broken = StandInGame([fail, lambda: None])
+        working = StandInGame([lambda: None, lambda: None])
+
+        runner = GameRunner()
+        runner.add_game('broken', broken)
+        runner.add_game('working', working)
+        asyncio.run(runner.run())
+
+        self.assertEqual(len(broken.steps), 1)
+        self.assertEqual(working.steps, [])
+
+    def test_duplicated_name(self):
+        '''Game names must be unique.'''
+
+        runner = GameRunner()
+        runner.add_game('a', StandInGame([]))
+
+        with self.assertRaises(ValueError):
+            runner.add_game('a', StandInGame([]))
+
+    def test_shared_dataset(self):
+        '''Each dataset is indexed and validated once for all the games.'''
+
+        with tempfile.TemporaryDirectory() as path:
+            Image.new('RGB', (40, 30)).save(os.path.join(path, 'a.png'))
+            write_definition(path, 'a.json', 'A', ['a.png'])
+
+            runner = GameRunner(validationProcesses=1)
+            index = runner.dataset(path)
+            self.assertIs(runner.dataset(path), index)
+
+            runner.prepare()
+            self.assertEqual([q.title for q in index.getQuestions()], ['A'])
+
+            write_definition(path, 'b.json', 'B', ['missing.png'])
+            with self.assertRaises(ValueError):
+                runner.prepare()
+
+    def test_index_per_dataset(self):
+        '''Each dataset is stored in its own index file.'''
+
+        with tempfile.TemporaryDirectory() as path:
+            filename = os.path.join(path, 'dataset_index.json')
+            for name, title in [('one', 'A'), ('two', 'B')]:
+                os.makedirs(os.path.join(path, name))
+                Image.new('RGB', (40, 30)).save(os.path.join(path, name, 'a.png'))
+                write_definition(os.path.join(path, name), 'a.json', title, ['a.png'])
+
+            runner = GameRunner(validationProcesses=1)
+            one = runner.dataset(os.path.join(path, 'one'), filename)
+            two = runner.dataset(os.path.join(path, 'two'), filename)
+            self.assertIs(runner.dataset(os.path.join(path, 'one/'), filename), one)
+            self.assertNotEqual(one.filename, two.filename)
+            runner.prepare()
+
+            runner = GameRunner(validationProcesses=1)
+            for name, title in [('one', 'A'), ('two', 'B')]:
+                index = runner.dataset(os.path.join(path, name), filename)
+                self.assertTrue(index.loadFromDisk())
+                self.assertEqual([q.title for q in index.getQuestions()], [title])
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,55 @@
+'''Tests for scheduler module.'''
+
+import unittest
+
+from datetime import datetime, timedelta
+
+from .scheduler import Scheduler
+
+
+class SchedulerTest(unittest.TestCase):
+    def test_clue_deadline(self):
+        '''Wakes up when the next clue is due if it comes before the poll.'''
+
+        scheduler = Scheduler(clueDelaySeconds=600, maxPollSeconds=300)
+        now = datetime.now()
+
+        self.assertEqual(scheduler.next_timeout(now - timedelta(seconds=570), now), 30)
+        self.assertEqual(scheduler.next_timeout(now - timedelta(seconds=100), now), 300)
+        self.assertEqual(scheduler.next_timeout(now - timedelta(seconds=900), now), 0)
+
+    def test_adaptive_poll(self):
+        '''Polls often after a clue and while replies arrive.'''
+
+        scheduler = Scheduler(600, maxPollSeconds=300, minPollSeconds=20)
+        now = datetime.now()
+
+        scheduler.clue_posted()
+        self.assertEqual(scheduler.next_timeout(now, now), 20)
+
+        scheduler.record_check([])
+        scheduler.record_check([])
+        self.assertEqual(scheduler.next_timeout(now, now), 80)
+
+        scheduler.record_check(['reply'])
+        self.assertEqual(scheduler.next_timeout(now, now), 40)
+
+        for _ in range(10):
+            scheduler.record_check([])
+        self.assertEqual(scheduler.next_timeout(now, now), 300)
+
+        for _ in range(10):
+            scheduler.record_check(['reply'])
+        self.assertEqual(scheduler.next_timeout(now, now), 20)
+
+    def test_min_poll_bounded(self):
+        '''The minimum poll interval never exceeds the maximum one.'''
+
+        scheduler = Scheduler(600, maxPollSeconds=5)
+        scheduler.clue_posted()
+
+        self.assertEqual(scheduler.pollSeconds, 5)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,155 @@
+'''Tests for selection module.'''
+
+import collections
+import os
+import random
+import tempfile
+import unittest
+
+from .image_quiz import ImageData
+from .selection import FRESH_WEIGHT, AliasTable, DeckSelector, WeightedSelector
+
+
+def create_questions(count):
+    return [ImageData(str(i), f'{i}.png', [str(i)]) for i in range(count)]
+
+
+class DeckSelectorTest(unittest.TestCase):
+    def setUp(self):
+        self.tmpdir = tempfile.TemporaryDirectory()
+        self.filename = os.path.join(self.tmpdir.name, 'state.json.deck')
+
+    def tearDown(self):
+        self.tmpdir.cleanup()
+
+    def test_no_repeats_in_a_deck(self):
+        '''Every question is dealt once before any is repeated.'''
+
+        questions = create_questions(20)
+        selector = DeckSelector(rng=random.Random(1))
+
+        first = [selector.pick(questions, set()).title for _ in range(20)]
+        second = [selector.pick(questions, set()).title for _ in range(20)]
+
+        self.assertEqual(sorted(first), sorted(q.title for q in questions))
+        self.assertEqual(sorted(second), sorted(first))
+
+    def test_history_avoided(self):
+        '''Questions in the history are not picked, even if it is almost full.'''
+
+        questions = create_questions(10)
+        selector = DeckSelector(rng=random.Random(2))
+        history = []
+
+        for _ in range(100):
+            question = selector.pick(questions, set(history))
+            self.assertNotIn(question.filepath, history)
+            history = (history + [question.filepath])[-9:]
+
+    def test_small_dataset(self):
+        '''With fewer questions than the history, they are repeated.'''
+
+        questions = create_questions(2)
+        selector = DeckSelector(rng=random.Random(3))
+        history = {q.filepath for q in questions}
+
+        self.assertIn(selector.pick(questions, history), questions)
+
+    def test_restart(self):
+        '''A restarted selector continues the same deck.'''
+
+        questions = create_questions(10)
+        selector = DeckSelector(self.filename, random.Random(4))
+        for _ in range(4):
+            selector.pick(questions, set())
+        expected = selector.deck[4:]
+
+        restarted = DeckSelector(self.filename)
+        restarted.loadFromDisk()
+        picked = [restarted.pick(questions, set()).filepath for _ in range(6)]
+
+        self.assertEqual(picked, expected)
+
+    def test_dataset_changes(self):
+        '''New questions join the deck and deleted ones are skipped.'''
+
+        questions = create_questions(10)
+        selector = DeckSelector(rng=random.Random(5))
+        dealt = [selector.pick(questions, set()).title for _ in range(5)]
+
+        deleted = next(q for q in questions if q.title not in dealt)
+        changed = [q for q in questions if q is not deleted]
+        changed += [ImageData('new', 'new.png', ['new'])]
+        pending = {q.title for q in changed} - set(dealt)
+        self.assertEqual(len(pending), 5)
+
+        rest = [selector.pick(changed, set()).title for _ in range(len(pending))]
+        self.assertEqual(set(rest), pending)
+
+
+class AliasTableTest(unittest.TestCase):
+    def test_distribution(self):
+        '''Indexes are sampled in proportion to their weights.'''
+
+        rng = random.Random(6)
+        table = AliasTable([1, 2, 5, 0])
+        counts = collections.Counter(table.sample(rng) for _ in range(8000))
+
+        self.assertNotIn(3, counts)
+        self.assertAlmostEqual(counts[0] / 8000, 1 / 8, delta=0.02)
+        self.assertAlmostEqual(counts[1] / 8000, 2 / 8, delta=0.02)
+        self.assertAlmostEqual(counts[2] / 8000, 5 / 8, delta=0.02)
+
+
+class WeightedSelectorTest(unittest.TestCase):
+    def test_history_avoided(self):
+        '''Questions in the history are not picked while there are others.'''
+
+        questions = create_questions(10)
+        selector = WeightedSelector({}, random.Random(7))
+        history = []
+
+        for _ in range(100):
+            question = selector.pick(questions, set(history))
+            self.assertNotIn(question.filepath, history)
+            history = (history + [question.filepath])[-9:]
+
+        self.assertIn(selector.pick(questions[:2], {'0.png', '1.png'}), questions)
+
+    def test_weights(self):
+        '''Fresh and hard questions are picked more often than easy ones.'''
+
+        questions = create_questions(3)
+        stats = {
+            '0.png': {'played': 4, 'solved': 4, 'difficulty': 0},
+            '1.png': {'played': 2, 'solved': 0, 'difficulty': 2},
+        }
+        selector = WeightedSelector(stats, random.Random(8))
+
+        counts = collections.Counter(
+            selector.pick(questions, set()).filepath for _ in range(8000)
+        )
+        total = 1 + 3 + FRESH_WEIGHT
+        self.assertAlmostEqual(counts['0.png'] / 8000, 1 / total, delta=0.02)
+        self.assertGreater(counts['2.png'], counts['1.png'])
+        self.assertGreater(counts['1.png'], counts['0.png'])
+
+    def test_update(self):
+        '''A new result changes the odds of the question.'''
+
+        questions = create_questions(2)
+        stats = {}
+        selector = WeightedSelector(stats, random.Random(9))
+        selector.pick(questions, set())
+
+        stats['0.png'] = {'played': 1, 'solved': 1, 'difficulty': 0}
+        selector.update('0.png')
+
+        counts = collections.Counter(
+            selector.pick(questions, set()).filepath for _ in range(5000)
+        )
+        self.assertAlmostEqual(counts['0.png'] / 5000, 1 / 5, delta=0.02)
+
+
+if __name__ == '__main__':
+    unittest.main()
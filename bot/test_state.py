@@ -0,0 +1,141 @@
+'''Tests for state module.'''
+
+import json
+import os
+import tempfile
+import unittest
+
+from .state import LOG_SUFFIX, State
+
+
+class StateTest(unittest.TestCase):
+    def setUp(self):
+        self.tmpdir = tempfile.TemporaryDirectory()
+        self.filename = os.path.join(self.tmpdir.name, 'state.json')
+
+    def tearDown(self):
+        self.tmpdir.cleanup()
+
+    def load(self, history_size=3):
+        state = State(history_size, self.filename)
+        state.loadFromDisk()
+        return state
+
+    def test_history_trimmed(self):
+        '''Only the last history_size questions are kept.'''
+
+        state = State(3, self.filename)
+        for question in 'abcde':
+            state.addQuestion(question)
+
+        self.assertEqual(state.history, ['c', 'd', 'e'])
+        self.assertIn('e', state.getQuestions())
+        self.assertNotIn('a', state.getQuestions())
+
+    def test_repeated_question(self):
+        '''A question stays in the history while any of its copies does.'''
+
+        state = State(2, self.filename)
+        state.history = ['a', 'a']
+        state.addQuestion('b')
+
+        self.assertIn('a', state.getQuestions())
+
+        state.addQuestion('b')
+        self.assertNotIn('a', state.getQuestions())
+
+    def test_append_only(self):
+        '''Adding a question appends to the log without rewriting the snapshot.'''
+
+        state = State(3, self.filename)
+        state.addQuestion('a')
+        state.addQuestion('b')
+
+        self.assertFalse(os.path.exists(self.filename))
+        with open(self.filename + LOG_SUFFIX) as fin:
+            self.assertEqual(len(fin.readlines()), 2)
+
+        self.assertEqual(self.load().history, ['a', 'b'])
+
+    def test_compaction(self):
+        '''A long log is compacted into the snapshot.'''
+
+        state = State(3, self.filename)
+        for question in 'abcdefg':
+            state.addQuestion(question)
+
+        with open(self.filename + LOG_SUFFIX) as fin:
+            self.assertLessEqual(len(fin.readlines()), 3)
+        self.assertEqual(self.load().history, ['e', 'f', 'g'])
+
+    def test_crash_after_snapshot(self):
+        '''Changes already in the snapshot are not applied twice.'''
+
+        state = State(3, self.filename)
+        state.addQuestion('a')
+        state.addQuestion('b')
+        with open(self.filename + LOG_SUFFIX) as fin:
+            log = fin.read()
+
+        # Snapshot written but the log was not truncated
+        state.saveToDisk()
+        with open(self.filename + LOG_SUFFIX, 'w') as fout:
+            fout.write(log)
+
+        self.assertEqual(self.load().history, ['a', 'b'])
+
+    def test_truncated_log(self):
+        '''A partially written change is ignored and doesn't break appends.'''
+
+        state = State(3, self.filename)
+        state.addQuestion('a')
+        with open(self.filename + LOG_SUFFIX, 'a') as fout:
+            fout.write('{"add": "b", "se')
+
+        state = self.load()
+        self.assertEqual(state.history, ['a'])
+
+        state.addQuestion('c')
+        self.assertEqual(self.load().history, ['a', 'c'])
+
+    def test_load_old_format(self):
+        '''Loads state files written before the log existed.'''
+
+        with open(self.filename, 'w') as fout:
+            json.dump({'history': ['a', 'b']}, fout)
+
+        state = self.load()
+        state.addQuestion('c')
+
+        self.assertEqual(self.load().history, ['a', 'b', 'c'])
+
+    def test_round(self):
+        '''The round in progress survives restarts and compactions.'''
+
+        state = State(2, self.filename)
+        state.setRound({'clue_idx': 1})
+        self.assertEqual(self.load(2).getRound(), {'clue_idx': 1})
+
+        for idx in range(2, 6):
+            state.setRound({'clue_idx': idx})
+        self.assertEqual(self.load(2).getRound(), {'clue_idx': 5})
+
+        state.setRound(None)
+        self.assertIsNone(self.load(2).getRound())
+
+    def test_results(self):
+        '''The results of the rounds are added up and persisted.'''
+
+        state = State(2, self.filename)
+        state.recordResult('a', True, 0.5)
+        state.recordResult('a', False, 1)
+        for question in 'bcd':
+            state.addQuestion(question)
+
+        expected = {'a': {'played': 2, 'solved': 1, 'difficulty': 1.5}}
+        self.assertEqual(state.getStats(), expected)
+        self.assertEqual(self.load(2).getStats(), expected)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -2,7 +2,11 @@
 Utility functions.
 '''
 
+import hashlib
+import json
 import logging
+import os
+import tempfile
 import time
 
 from datetime import datetime
@@ -48,3 +52,33 @@ def enough_delay(delay_seconds, start, end=None):
     if end is None:
         end = datetime.now()
     return (end - start).total_seconds() > delay_seconds
+
+
+def save_json_atomically(filename, content):
+    '''Writes content as JSON to filename without leaving partial files.
+
+    The data is written to a temporary file in the same directory and then
+    renamed over filename, so readers see either the old or the new version.
+    '''
+
+    dirname = os.path.dirname(os.path.abspath(filename))
+    fd, tmp_path = tempfile.mkstemp(dir=dirname, prefix='.tmp-')
+    try:
+        with os.fdopen(fd, 'w') as fout:
+            json.dump(content, fout)
+            fout.flush()
+            os.fsync(fout.fileno())
+        os.replace(tmp_path, filename)
+    except BaseException:
+        os.unlink(tmp_path)
+        raise
+
+
+def hash_file(filepath, chunk_size=1024 * 1024):
+    '''Returns the SHA-256 hex digest of the contents of filepath.'''
+
+    digest = hashlib.sha256()
+    with open(filepath, 'rb') as fin:
+        while chunk := fin.read(chunk_size):
+            digest.update(chunk)
+    return digest.hexdigest()
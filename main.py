@@ -6,14 +6,38 @@ Mastodon bot for image-based quizes.
 See Readme.md for more info on how to setup and run it.
 '''
 
+import time
+
+# Measured before the heavy imports to report the time to first post
+START_TIME = time.monotonic()
+
 import argparse
+import asyncio
+import json
 import logging
 import os
 import random
 import sys
 
-from bot.manager import BotManager
-from bot.mastodon_wrapper import MastodonWrapper, FakeMastodonWrapper
+from bot.render_options import (
+    EXPECTED_WIDTH,
+    DEFAULT_RESAMPLE,
+    IMAGE_FORMATS,
+    RESAMPLING_FILTER_NAMES,
+    RenderOptions,
+)
+from bot.clue_cache import ClueCache
+from bot.manager import BotManager, HISTORY_SIZE
+from bot.dataset import ValidationCache
+from bot.manifest import convert_dataset, open_dataset
+from bot.mastodon_wrapper import (
+    DEFAULT_MAX_CONNECTIONS,
+    MastodonWrapper,
+    FakeMastodonWrapper,
+    pooled_session,
+)
+from bot.runner import GameRunner
+from bot.selection import SELECTION_MODES
 
 logger = logging.getLogger(__name__)
 
@@ -23,14 +47,20 @@ DEFAULT_OUTPUT_PATH = './output/'
 DEFAULT_CLUE_DELAY_SECONDS = 60 * 60 * 2
 DEFAULT_CHECK_DELAY_SECONDS = 60 * 5
 DEFAULT_MASTODON_VISIBILITY = 'public'
+DEFAULT_NOTIFICATIONS_CURSOR = 'notifications_cursor.json'
+DEFAULT_DATASET_INDEX = 'dataset_index.json'
+DEFAULT_WATCH_DATASET_SECONDS = 0
+DEFAULT_VALIDATION_CACHE = 'validation_cache.json'
+DEFAULT_CLUE_CACHE_MB = 500
+DEFAULT_COMPILED_PATH = './compiled/'
 
 TOKEN_ENVIRON_VAR = 'MASTODON_TOKEN'
 
 
-def get_auth_token():
+def get_auth_token(environ_var=TOKEN_ENVIRON_VAR):
     '''Fetches the auth token from the env var.'''
     try:
-        token = os.environ[TOKEN_ENVIRON_VAR].strip()
+        token = os.environ[environ_var].strip()
         if not token:
             raise ValueError()
         return token
@@ -40,6 +70,162 @@ def get_auth_token():
         sys.exit(-1)
 
 
+def create_session(args):
+    '''Returns the HTTP session shared by the Mastodon clients, if any.'''
+
+    if args.no_dry_run:
+        return None
+    return pooled_session(args.mastodon_connections)
+
+
+def create_mastodon_client(
+    args, endpoint, visibility, token, cursor, streaming, session=None
+):
+    '''Creates the Mastodon client of a game.'''
+
+    if args.no_dry_run:
+        logger.info("Dry run mode. Won't publish anything!")
+        return FakeMastodonWrapper()
+
+    mastodon_client = MastodonWrapper(
+        api_url=endpoint,
+        token=token,
+        visibility=visibility,
+        session=session,
+        cursor_filename=cursor,
+    )
+    if streaming:
+        mastodon_client.start_streaming()
+    return mastodon_client
+
+
+def run_games(args, render_options, clue_cache):
+    '''Runs all the games of the --games file in this process.
+
+    The file has a list of objects. Each one needs a "name" and can override
+    the options dataset, history_size, clue_delay_seconds,
+    check_delay_seconds, min_check_delay_seconds, selection,
+    mastodon_endpoint, mastodon_owner, mastodon_visibility and
+    mastodon_streaming. "token_environ_var" names the environment variable
+    with the token of the account, MASTODON_TOKEN by default. Every game
+    keeps its state in state_<name>.json and notifications_cursor_<name>.json.
+    '''
+
+    with open(args.games) as fin:
+        games = json.load(fin)
+
+    runner = GameRunner(args.validation_processes, args.validation_cache)
+    session = create_session(args)
+    token_vars = set()
+    for config in games:
+        name = config['name']
+        get = lambda key, default=None: config.get(key, getattr(args, key, default))
+        logger.info('Game %s: %s', name, config)
+
+        token = None
+        if not args.no_dry_run:
+            token_var = config.get('token_environ_var', TOKEN_ENVIRON_VAR)
+            token = get_auth_token(token_var)
+            token_vars.add(token_var)
+
+        mastodon_client = create_mastodon_client(
+            args,
+            get('mastodon_endpoint'),
+            get('mastodon_visibility'),
+            token,
+            f'notifications_cursor_{name}.json',
+            get('mastodon_streaming'),
+            session,
+        )
+
+        dataset = get('dataset')
+        runner.add_game(
+            name,
+            BotManager(
+                mastodon_client,
+                get('mastodon_owner'),
+                dataset,
+                history_size=get('history_size', HISTORY_SIZE),
+                clueDelaySeconds=get('clue_delay_seconds'),
+                checkDelaySeconds=get('check_delay_seconds'),
+                minCheckDelaySeconds=get('min_check_delay_seconds'),
+                startTime=START_TIME,
+                prefetch=not args.no_prefetch,
+                outputPath=None if args.in_memory else args.output,
+                renderOptions=render_options,
+                clueCache=clue_cache,
+                maxEditDistance=args.max_edit_distance,
+                selection=get('selection'),
+                stateFilename=f'state_{name}.json',
+                datasetIndex=runner.dataset(dataset, args.dataset_index),
+            ),
+        )
+
+    for token_var in token_vars:
+        del os.environ[token_var]
+
+    try:
+        runner.prepare()
+    except ValueError as e:
+        logger.error(e)
+        sys.exit(-1)
+
+    logger.info('Running %d games...', len(games))
+    asyncio.run(runner.run())
+
+
+def convert(args):
+    '''Writes the manifest of the per-file definitions in --dataset.'''
+
+    count, errors = convert_dataset(args.dataset, args.manifest)
+    for filepath, error in errors.items():
+        logger.error('%s: %s', filepath, error)
+    logger.info('Converted %d questions, %d definitions skipped', count, len(errors))
+    if errors:
+        sys.exit(-1)
+
+
+def precompile(args, render_options):
+    '''Compiles --dataset for the render options into a manifest and a cache.'''
+
+    # Loads PIL, which the other commands only need once a round starts
+    from bot.compiler import compile_dataset
+
+    clue_cache_path = args.clue_cache
+    if clue_cache_path is None:
+        clue_cache_path = os.path.join(args.compiled, 'cache')
+    clue_cache = ClueCache(clue_cache_path, args.clue_cache_mb * 1024 * 1024)
+
+    index = open_dataset(args.dataset)
+    index.refresh()
+
+    start = time.monotonic()
+    count, errors = compile_dataset(
+        index,
+        args.compiled,
+        render_options,
+        clue_cache,
+        args.validation_processes,
+        ValidationCache(args.validation_cache),
+        args.render_clues,
+    )
+    for error in errors:
+        logger.error(error)
+    logger.info(
+        'Compiled %d questions in %.2f seconds, %d problems found',
+        count,
+        time.monotonic() - start,
+        len(errors),
+    )
+    logger.info(
+        'Run the bot with --dataset=%s --clue_cache=%s and the same clue options',
+        args.compiled,
+        clue_cache_path,
+    )
+    if errors:
+        sys.exit(-1)
+
+
 def main():
     '''Setup and run the bot.'''
 
@@ -53,42 +239,134 @@ def main():
         prog="Quiz Bot", description="Mastodon bot for image-based quizs"
     )
     parser.add_argument('-d', '--dataset', default=DEFAULT_DATASET_PATH)
+    parser.add_argument('--dataset_index', default=DEFAULT_DATASET_INDEX)
+    parser.add_argument(
+        '--watch_dataset_seconds', default=DEFAULT_WATCH_DATASET_SECONDS, type=int
+    )
+    parser.add_argument('--validation_processes', type=int)
+    parser.add_argument('--validation_cache', default=DEFAULT_VALIDATION_CACHE)
     parser.add_argument('-o', '--output', default=DEFAULT_OUTPUT_PATH)
+    parser.add_argument('--in_memory', action='store_true')
+    parser.add_argument(
+        '--clue_format', default='png', choices=[f.lower() for f in IMAGE_FORMATS]
+    )
+    parser.add_argument('--clue_quality', type=int)
+    parser.add_argument('--clue_max_bytes', type=int)
+    parser.add_argument('--clue_cache')
+    parser.add_argument('--clue_cache_mb', default=DEFAULT_CLUE_CACHE_MB, type=int)
+    parser.add_argument('--max_edit_distance', default=0, type=int)
+    parser.add_argument('--selection', default='deck', choices=SELECTION_MODES)
+    parser.add_argument('--clue_width', default=EXPECTED_WIDTH, type=int)
+    parser.add_argument(
+        '--resample', default=DEFAULT_RESAMPLE, choices=list(RESAMPLING_FILTER_NAMES)
+    )
     parser.add_argument('--no_dry_run', action='store_false')
+    parser.add_argument('--no_prefetch', action='store_true')
     parser.add_argument(
         '--clue_delay_seconds', default=DEFAULT_CLUE_DELAY_SECONDS, type=int
     )
     parser.add_argument(
         '--check_delay_seconds', default=DEFAULT_CHECK_DELAY_SECONDS, type=int
     )
+    parser.add_argument('--min_check_delay_seconds', type=int)
     parser.add_argument('--mastodon_endpoint')
     parser.add_argument('--mastodon_owner')
     parser.add_argument('--mastodon_visibility', default=DEFAULT_MASTODON_VISIBILITY)
+    parser.add_argument('--mastodon_streaming', action='store_true')
+    parser.add_argument(
+        '--mastodon_connections', default=DEFAULT_MAX_CONNECTIONS, type=int
+    )
+    parser.add_argument('--notifications_cursor', default=DEFAULT_NOTIFICATIONS_CURSOR)
+    parser.add_argument('--games')
+
+    subparsers = parser.add_subparsers(dest='command')
+    convert_parser = subparsers.add_parser(
+        'convert', help='write a manifest for the dataset definitions'
+    )
+    convert_parser.add_argument('--manifest')
+    compile_parser = subparsers.add_parser(
+        'compile', help='prepare the dataset images ahead of time'
+    )
+    compile_parser.add_argument('--compiled', default=DEFAULT_COMPILED_PATH)
+    compile_parser.add_argument('--render_clues', action='store_true')
     args = parser.parse_args()
 
+    if args.command == 'convert':
+        convert(args)
+        return
+
     logger.info('Starting the bot...')
     logger.info('dataset = %s', args.dataset)
+    logger.info('dataset index = %s', args.dataset_index)
+    logger.info('watch dataset seconds = %d', args.watch_dataset_seconds)
+    logger.info('validation processes = %s', args.validation_processes)
+    logger.info('validation cache = %s', args.validation_cache)
     logger.info('output = %s', args.output)
+    logger.info('in memory? = %s', args.in_memory)
+    logger.info('clue format = %s', args.clue_format)
+    logger.info('clue quality = %s', args.clue_quality)
+    logger.info('clue max bytes = %s', args.clue_max_bytes)
+    logger.info('clue cache = %s', args.clue_cache)
+    logger.info('clue cache MB = %d', args.clue_cache_mb)
+    logger.info('max edit distance = %d', args.max_edit_distance)
+    logger.info('selection = %s', args.selection)
+    logger.info('clue width = %d', args.clue_width)
+    logger.info('resample = %s', args.resample)
     logger.info('no dry run? = %s', args.no_dry_run)
+    logger.info('no prefetch? = %s', args.no_prefetch)
     logger.info('clue delay in seconds = %d', args.clue_delay_seconds)
     logger.info('check delay in seconds = %d', args.check_delay_seconds)
+    logger.info('min check delay in seconds = %s', args.min_check_delay_seconds)
     logger.info('mastodon endpoint = %s', args.mastodon_endpoint)
     logger.info('mastodon owner = %s', args.mastodon_owner)
     logger.info('mastodon visibility = %s', args.mastodon_visibility)
+    logger.info('mastodon streaming? = %s', args.mastodon_streaming)
+    logger.info('mastodon connections = %s', args.mastodon_connections)
+    logger.info('notifications cursor = %s', args.notifications_cursor)
+    logger.info('games = %s', args.games)
 
     logger.info('Setting up dependencies and data...')
     random.seed()
 
-    if args.no_dry_run:
-        logger.info("Dry run mode. Won't publish anything!")
-        mastodon_client = FakeMastodonWrapper()
-    else:
+    render_options = RenderOptions(
+        args.clue_format,
+        args.clue_quality,
+        args.clue_max_bytes,
+        args.clue_width,
+        args.resample,
+    )
+
+    if args.command == 'compile':
+        precompile(args, render_options)
+        return
+
+    clue_cache = None
+    if args.clue_cache:
+        clue_cache = ClueCache(args.clue_cache, args.clue_cache_mb * 1024 * 1024)
+
+    if args.games:
+        try:
+            run_games(args, render_options, clue_cache)
+        except Exception as e:
+            logging.error('UNHANDLED EXCEPTION')
+            logging.error(e, exc_info=True)
+            logging.info('Shutting down...')
+            sys.exit(-1)
+        return
+
+    token = None
+    if not args.no_dry_run:
         token = get_auth_token()
-        mastodon_client = MastodonWrapper(
-            api_url=args.mastodon_endpoint,
-            token=token,
-            visibility=args.mastodon_visibility,
-        )
+    mastodon_client = create_mastodon_client(
+        args,
+        args.mastodon_endpoint,
+        args.mastodon_visibility,
+        token,
+        args.notifications_cursor,
+        args.mastodon_streaming,
+        create_session(args),
+    )
+    if token is not None:
         del os.environ[TOKEN_ENVIRON_VAR]
         del token
 
@@ -98,6 +376,18 @@ def main():
         args.dataset,
         clueDelaySeconds=args.clue_delay_seconds,
         checkDelaySeconds=args.check_delay_seconds,
+        minCheckDelaySeconds=args.min_check_delay_seconds,
+        datasetIndexFilename=args.dataset_index,
+        watchDatasetSeconds=args.watch_dataset_seconds,
+        validationProcesses=args.validation_processes,
+        validationCacheFilename=args.validation_cache,
+        startTime=START_TIME,
+        prefetch=not args.no_prefetch,
+        outputPath=None if args.in_memory else args.output,
+        renderOptions=render_options,
+        clueCache=clue_cache,
+        maxEditDistance=args.max_edit_distance,
+        selection=args.selection,
     )
 
     logger.info('Running game...')